@@ -0,0 +1,415 @@
+"""
+Offline rendering benchmark for the microscope simulator.
+
+Drives VideoTransformTrack.recv() of server.py (and of server_sync.py) with
+no network and no Hypha server, over a matrix of resolutions, object counts
+and simulated viewers, and writes the results as JSON. Pass a previous
+result file with --baseline to fail on frame rate regressions. With
+--encode it measures the CPU time of encoding rendered frames per codec,
+bitrate and keyframe interval instead.
+
+    python benchmark.py --output bench.json
+    python benchmark.py --baseline bench.json --variants async
+    python benchmark.py --encode --codecs vp8 h264 --bitrates 0 500000
+"""
+import argparse
+import asyncio
+import contextlib
+import importlib
+import json
+import math
+import platform
+import random
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+from aiortc import RTCRtpCodecParameters
+from aiortc.codecs import get_encoder
+from av import VideoFrame
+
+from encoding import DEFAULT_ENCODER_SETTINGS, VIDEO_CODECS, PeerEncoder, update_encoder_settings
+from producer import VIDEO_TIME_BASE, FrameProducer
+from render import lap, render_view
+from scheduler import FrameScheduler
+from specimen import SpecimenWorld
+
+STAGES = ["cull", "background", "objects", "grid_hud", "convert", "video_frame"]
+
+
+def parse_resolution(value):
+    width, height = value.lower().split("x")
+    return int(width), int(height)
+
+
+def make_objects(count, stage_width=480, stage_height=360, seed=0):
+    """Deterministic specimen objects spread over the stage"""
+    rng = random.Random(seed)
+    return [
+        {
+            "x": rng.uniform(0, stage_width),
+            "y": rng.uniform(0, stage_height),
+            "color": [rng.randint(80, 255) for _ in range(3)],
+            "size": rng.randint(15, 35),
+        }
+        for _ in range(count)
+    ]
+
+
+def make_world(count, width=480, height=360):
+    """A slide with `count` objects spread evenly over `width` x `height` stage units"""
+    return SpecimenWorld(make_objects(count, width, height), width, height)
+
+
+def make_state(world, count):
+    """Stage state for frame `count`, panning slowly around the slide center so the visible set changes"""
+    x = world.width / 2 + 120 * math.sin(count / 45)
+    y = world.height / 2 + 90 * math.cos(count / 60)
+    return {
+        "x": x,
+        "y": y,
+        "stage_width": world.width,
+        "stage_height": world.height,
+        "objects": world.visible(x, y, 240, 180),
+    }
+
+
+class UnpacedScheduler(FrameScheduler):
+    """
+    A FrameScheduler that ignores the clock and produces frames as fast as
+    the subscribers of `producer` pull them, so no frame is rendered in vain.
+    """
+
+    def __init__(self, producer):
+        super().__init__(producer.fps)
+        self.producer = producer
+
+    async def wait(self, lead_ns=0):
+        while any(subscription.queue.full() for subscription in self.producer.subscribers):
+            await asyncio.sleep(0)
+        return 0
+
+    async def wait_deadline(self):
+        pass
+
+
+class BenchmarkProducer(FrameProducer):
+    """A FrameProducer rendering unpaced that adds up the time spent in each stage"""
+
+    def __init__(self, world, **kwargs):
+        super().__init__(self.snapshot, self.render_timed, **kwargs)
+        self.world = world
+        self.scheduler = UnpacedScheduler(self)
+        self.timings = {}
+
+    def snapshot(self, count):
+        start = time.perf_counter()
+        state = make_state(self.world, count)
+        lap(self.timings, "cull", start)
+        return state
+
+    def render_timed(self, state, count, width, height, fps, pixel_format, t):
+        return render_view(state, count, width, height, fps, pixel_format, t, timings=self.timings)
+
+    def _to_video_frame(self, img, pts):
+        start = time.perf_counter()
+        frame = super()._to_video_frame(img, pts)
+        lap(self.timings, "video_frame", start)
+        return frame
+
+
+async def pull_frames(tracks, frames):
+    """Let every track receive `frames` frames, viewers pulling concurrently"""
+    for _ in range(frames):
+        await asyncio.gather(*(track.recv() for track in tracks))
+
+
+async def time_frames(tracks, frames):
+    """Seconds it takes every track to receive `frames` frames"""
+    start = time.perf_counter()
+    await pull_frames(tracks, frames)
+    return time.perf_counter() - start
+
+
+async def trace_allocations(tracks, frames=10):
+    """Peak memory allocated while receiving a frame, and memory retained after `frames` frames"""
+    tracemalloc.start()
+    try:
+        baseline = tracemalloc.get_traced_memory()[0]
+        peak_total = 0
+        for _ in range(frames):
+            tracemalloc.reset_peak()
+            current = tracemalloc.get_traced_memory()[0]
+            await pull_frames(tracks, 1)
+            peak_total += tracemalloc.get_traced_memory()[1] - current
+        retained = tracemalloc.get_traced_memory()[0] - baseline
+    finally:
+        tracemalloc.stop()
+    return {"alloc_peak_kb_per_frame": peak_total / frames / 1024, "retained_kb": retained / 1024}
+
+
+async def bench_async(width, height, world, viewers, frames, warmup, pixel_format, allocations):
+    """Benchmark the shared FrameProducer path of server.py"""
+    import server
+
+    producer = BenchmarkProducer(world, width=width, height=height, fps=30, pixel_format=pixel_format)
+    tracks = [server.VideoTransformTrack(producer) for _ in range(viewers)]
+    try:
+        await pull_frames(tracks, warmup)
+        # Only count the stage timings of the measured frames
+        producer.timings.clear()
+        rendered = producer.count
+        result = {"elapsed_s": await time_frames(tracks, frames)}
+        rendered = producer.count - rendered
+        timings = dict(producer.timings)
+        if allocations:
+            result.update(await trace_allocations(tracks))
+    finally:
+        for track in tracks:
+            track.stop()
+        if producer._task is not None:
+            with contextlib.suppress(Exception):
+                await producer._task
+
+    result["rendered"] = rendered
+    result["stages_ms"] = {stage: timings.get(stage, 0.0) / max(1, rendered) * 1000 for stage in STAGES}
+    return result
+
+
+async def bench_sync(width, height, world, viewers, frames, warmup, pixel_format, allocations):
+    """Benchmark server_sync.py, which renders bgr24 at 480x360 only and has no spatial index"""
+    if (width, height) != (480, 360) or pixel_format != "bgr24" or (world.width, world.height) != (480, 360):
+        return None
+    import server_sync
+
+    server_sync.microscope_state["objects"] = [
+        {"x": x, "y": y, "color": color, "size": size}
+        for x, y, color, size in zip(world.x.tolist(), world.y.tolist(), world.color.tolist(), world.size.tolist())
+    ]
+    renderer = server_sync.frame_renderer
+    # Don't reuse the last frame of the previous cell
+    renderer.last_count = None
+    tracks = [server_sync.VideoTransformTrack(paced=False) for _ in range(viewers)]
+    try:
+        await pull_frames(tracks, warmup)
+        rendered = renderer.frames_rendered
+        result = {"elapsed_s": await time_frames(tracks, frames)}
+        rendered = renderer.frames_rendered - rendered
+        if allocations:
+            result.update(await trace_allocations(tracks))
+    finally:
+        for track in tracks:
+            track.stop()
+    result["rendered"] = rendered
+    result["stages_ms"] = None
+    return result
+
+
+VARIANTS = {"async": bench_async, "sync": bench_sync}
+# The server module each variant drives
+VARIANT_MODULES = {"async": "server", "sync": "server_sync"}
+
+
+def available_variants(variants):
+    """The variants whose server module can be imported here, reporting the others"""
+    available = []
+    for variant in variants:
+        try:
+            importlib.import_module(VARIANT_MODULES[variant])
+        except ImportError as e:
+            print(f"Skipping the {variant} variant, {VARIANT_MODULES[variant]}.py can't be imported: {e}", file=sys.stderr)
+            continue
+        available.append(variant)
+    return available
+
+
+def render_clip(width, height, world, frames, fps=30):
+    """`frames` consecutive yuv420p VideoFrames of the panning view"""
+    clip = []
+    for count in range(frames):
+        img = render_view(make_state(world, count), count, width, height, fps, "yuv420p")
+        frame = VideoFrame.from_ndarray(img, format="yuv420p")
+        frame.pts = round(count / fps / VIDEO_TIME_BASE)
+        frame.time_base = VIDEO_TIME_BASE
+        clip.append(frame)
+    return clip
+
+
+def bench_encode(clip, codec, bitrate, keyframe_interval, fps=30):
+    """Encode `clip` like a peer's sender does, at a fixed `bitrate` (0 for aiortc's default)"""
+    settings = update_encoder_settings(
+        dict(DEFAULT_ENCODER_SETTINGS), min_bitrate=bitrate, max_bitrate=bitrate, keyframe_interval=keyframe_interval
+    )
+    parameters = RTCRtpCodecParameters(mimeType=VIDEO_CODECS[codec], clockRate=90000, payloadType=96)
+    encoder = PeerEncoder(get_encoder(parameters), codec, settings)
+    # The first frame opens the codec, don't count it
+    encoder.encode(clip[0])
+    size = 0
+    cpu_start, start = time.process_time(), time.perf_counter()
+    for frame in clip[1:]:
+        payloads, _ = encoder.encode(frame)
+        size += sum(len(payload) for payload in payloads)
+    cpu, elapsed = time.process_time() - cpu_start, time.perf_counter() - start
+    frames = len(clip) - 1
+    return {
+        "cpu_ms_per_frame": cpu / frames * 1000,
+        "encode_ms_per_frame": elapsed / frames * 1000,
+        "fps": frames / elapsed,
+        # Peers one core can encode for at the stream frame rate
+        "peers_per_core": frames / max(cpu, 1e-9) / fps,
+        "encoded_kbps": size * 8 * fps / frames / 1000,
+        "target_bitrate": encoder.target_bitrate,
+        "keyframes": encoder.keyframes - 1,
+    }
+
+
+def run_encode_matrix(args):
+    results = []
+    for width, height in args.resolutions:
+        for object_count in args.objects:
+            clip = render_clip(width, height, make_world(object_count, *args.world_size), args.frames + 1)
+            for codec in args.codecs:
+                for bitrate in args.bitrates:
+                    for keyframe_interval in args.keyframe_intervals:
+                        result = bench_encode(clip, codec, bitrate, keyframe_interval)
+                        result.update({
+                            "variant": "encode",
+                            "codec": codec,
+                            "bitrate": bitrate,
+                            "keyframe_interval": keyframe_interval,
+                            "width": width,
+                            "height": height,
+                            "pixel_format": "yuv420p",
+                            "objects": object_count,
+                            "world_width": args.world_size[0],
+                            "world_height": args.world_size[1],
+                            "viewers": 1,
+                            "frames": args.frames,
+                        })
+                        results.append(result)
+                        print(
+                            f"encode {codec:4} {width}x{height} objects={object_count:<4} "
+                            f"bitrate={bitrate or 'default':<8} keyframes every {keyframe_interval or '-':<4} "
+                            f"{result['cpu_ms_per_frame']:6.2f} ms cpu/frame  {result['encoded_kbps']:7.0f} kbps  "
+                            f"{result['peers_per_core']:6.1f} peers/core",
+                            file=sys.stderr,
+                        )
+    return results
+
+
+async def run_matrix(args):
+    results = []
+    for variant in available_variants(args.variants):
+        for width, height in args.resolutions:
+            for object_count in args.objects:
+                world = make_world(object_count, *args.world_size)
+                for viewers in args.viewers:
+                    # bgr24 is the only format of server_sync.py
+                    pixel_format = "bgr24" if variant == "sync" else args.pixel_format
+                    result = await VARIANTS[variant](
+                        width, height, world, viewers, args.frames, args.warmup, pixel_format, args.allocations
+                    )
+                    if result is None:
+                        continue
+                    elapsed = result.pop("elapsed_s")
+                    result.update({
+                        "variant": variant,
+                        "width": width,
+                        "height": height,
+                        "pixel_format": pixel_format,
+                        "objects": object_count,
+                        "world_width": world.width,
+                        "world_height": world.height,
+                        "viewers": viewers,
+                        "frames": args.frames,
+                        "fps": args.frames / elapsed,
+                        "render_ms_per_frame": elapsed / max(1, result["rendered"]) * 1000,
+                    })
+                    results.append(result)
+                    print(
+                        f"{variant:5} {width}x{height} objects={object_count:<4} viewers={viewers:<3} "
+                        f"{result['fps']:8.1f} fps  {result['render_ms_per_frame']:6.2f} ms/render",
+                        file=sys.stderr,
+                    )
+    return results
+
+
+def result_key(result):
+    return (result["variant"], result["width"], result["height"], result["pixel_format"],
+            result["objects"], result.get("world_width", 480), result.get("world_height", 360), result["viewers"],
+            result.get("codec"), result.get("bitrate"), result.get("keyframe_interval"))
+
+
+def find_regressions(results, baseline, tolerance):
+    """Cells whose frame rate dropped by more than `tolerance` against the baseline"""
+    previous = {result_key(result): result for result in baseline["results"]}
+    regressions = []
+    for result in results:
+        before = previous.get(result_key(result))
+        if before is not None and result["fps"] < before["fps"] * (1 - tolerance):
+            regressions.append({"cell": result_key(result), "fps": result["fps"], "baseline_fps": before["fps"]})
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline rendering benchmark for the microscope simulator")
+    parser.add_argument("--variants", nargs="+", choices=sorted(VARIANTS), default=["async", "sync"],
+                        help="Server implementations to benchmark")
+    parser.add_argument("--resolutions", nargs="+", type=parse_resolution,
+                        default=[(480, 360), (960, 540), (1920, 1080)], help="Resolutions as WIDTHxHEIGHT")
+    parser.add_argument("--objects", nargs="+", type=int, default=[5, 50, 200], help="Object counts")
+    parser.add_argument("--world-size", type=parse_resolution, default=(480, 360),
+                        help="Slide the objects are spread over in stage units, WIDTHxHEIGHT")
+    parser.add_argument("--viewers", nargs="+", type=int, default=[1, 4, 16], help="Simulated viewer counts")
+    parser.add_argument("--frames", type=int, default=60, help="Measured frames per cell")
+    parser.add_argument("--warmup", type=int, default=10, help="Unmeasured frames before each cell")
+    parser.add_argument("--pixel-format", choices=["bgr24", "yuv420p"], default="yuv420p",
+                        help="Pixel format rendered by the async server")
+    parser.add_argument("--allocations", action=argparse.BooleanOptionalAction, default=True,
+                        help="Trace allocations per frame with tracemalloc")
+    parser.add_argument("--encode", action="store_true",
+                        help="Benchmark encoding the rendered frames instead of rendering them")
+    parser.add_argument("--codecs", nargs="+", choices=sorted(VIDEO_CODECS), default=["vp8", "h264"],
+                        help="Codecs to benchmark with --encode")
+    parser.add_argument("--bitrates", nargs="+", type=int, default=[0, 500000, 1500000],
+                        help="Target bitrates in bits per second with --encode (0 is aiortc's default)")
+    parser.add_argument("--keyframe-intervals", nargs="+", type=int, default=[0, 30],
+                        help="Keyframe intervals in frames with --encode (0 only encodes the first keyframe)")
+    parser.add_argument("--output", type=str, default=None, help="Write the JSON report here instead of stdout")
+    parser.add_argument("--baseline", type=str, default=None, help="Previous JSON report to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="Allowed relative frame rate drop against the baseline")
+    args = parser.parse_args()
+
+    # The servers log to stdout, keep it for the report
+    with contextlib.redirect_stdout(sys.stderr):
+        results = run_encode_matrix(args) if args.encode else asyncio.run(run_matrix(args))
+
+    report = {
+        "meta": {
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "machine": platform.machine(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        },
+        "results": results,
+    }
+    if args.baseline:
+        with open(args.baseline, "r") as file:
+            report["regressions"] = find_regressions(results, json.load(file), args.tolerance)
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+    if report.get("regressions"):
+        print(f"{len(report['regressions'])} benchmark cells regressed", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+"""
+Still image capture of rendered frames for snap().
+"""
+import asyncio
+import fractions
+import time
+
+import av
+
+from metrics import SNAPSHOT_ENCODE_SECONDS, SNAPSHOTS
+
+SNAP_FORMATS = ("raw", "png", "jpeg")
+
+
+def encode_png(frame):
+    codec = av.CodecContext.create("png", "w")
+    codec.width, codec.height = frame.width, frame.height
+    codec.pix_fmt = "rgb24"
+    packets = codec.encode(frame.reformat(format="rgb24")) + codec.encode(None)
+    return b"".join(bytes(packet) for packet in packets)
+
+
+def encode_jpeg(frame, quality=90):
+    codec = av.CodecContext.create("mjpeg", "w")
+    codec.width, codec.height = frame.width, frame.height
+    codec.pix_fmt = "yuvj420p"
+    codec.time_base = fractions.Fraction(1, 1)
+    # Map quality 1-100 onto the JPEG quantiser scale, 31 (worst) to 2 (best)
+    codec.qmin = codec.qmax = round(2 + (100 - quality) * 29 / 99)
+    packets = codec.encode(frame.reformat(format="yuvj420p")) + codec.encode(None)
+    return b"".join(bytes(packet) for packet in packets)
+
+
+def encode_frame(frame, image_format="png", quality=90):
+    """
+    Encode a VideoFrame as PNG or JPEG bytes, or convert it to a read-only
+    (height, width, 3) rgb24 uint8 array for "raw". The raw array is a
+    converted copy, the streamed frames are yuv420p (or bgr24).
+    """
+    start = time.perf_counter()
+    if image_format == "raw":
+        result = frame.to_ndarray(format="rgb24")
+        # Converted once per frame and shared by every snap of it
+        result.flags.writeable = False
+    elif image_format == "png":
+        result = encode_png(frame)
+    elif image_format == "jpeg":
+        result = encode_jpeg(frame, quality)
+    else:
+        raise ValueError(f"Unknown image format {image_format!r}, use one of {', '.join(SNAP_FORMATS)}")
+    SNAPSHOT_ENCODE_SECONDS.labels(format=image_format).observe(time.perf_counter() - start)
+    return result
+
+
+class SnapshotCache:
+    """
+    Encoded stills of the most recent frame.
+
+    Each format and quality of a frame is encoded once, in `executor` (the
+    loop's default executor when None) so the event loop keeps streaming.
+    Concurrent requests for the same frame share the pending encode, and the
+    cache is emptied when a newer frame is requested.
+    """
+
+    def __init__(self, executor=None):
+        self.executor = executor
+        self.frame = None
+        self.encoded = {}
+
+    async def get(self, frame, image_format="png", quality=90):
+        if image_format not in SNAP_FORMATS:
+            raise ValueError(f"Unknown image format {image_format!r}, use one of {', '.join(SNAP_FORMATS)}")
+        if frame is not self.frame:
+            self.frame = frame
+            self.encoded = {}
+        key = (image_format, quality if image_format == "jpeg" else None)
+        future = self.encoded.get(key)
+        if future is None:
+            SNAPSHOTS.labels(format=image_format, cache="miss").inc()
+            loop = asyncio.get_running_loop()
+            future = loop.run_in_executor(self.executor, encode_frame, frame, image_format, quality)
+            future.add_done_callback(lambda done: self._encoded(frame, key, done))
+            self.encoded[key] = future
+        else:
+            SNAPSHOTS.labels(format=image_format, cache="hit").inc()
+        # One caller giving up must not cancel the encode the others wait for
+        return await asyncio.shield(future)
+
+    def _encoded(self, frame, key, future):
+        # Don't keep failed encodes, the next request tries again
+        if (future.cancelled() or future.exception() is not None) and frame is self.frame:
+            self.encoded.pop(key, None)
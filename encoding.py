@@ -0,0 +1,201 @@
+"""
+Per-peer video encoder settings: codec preference, bitrate caps and keyframe interval.
+"""
+import time
+
+from aiortc.codecs import get_encoder
+
+from metrics import ENCODE_SECONDS, KEYFRAMES
+
+# Codec names of the preference order, with their mime types
+VIDEO_CODECS = {"vp8": "video/VP8", "h264": "video/H264"}
+
+# Bitrates are in bits per second; 0 leaves a limit to aiortc, which keeps
+# the target bitrate between fixed limits per codec (0.25-1.5 Mbps for VP8,
+# 0.5-3 Mbps for H.264). A keyframe_interval of 0 only sends keyframes when
+# the receiver asks for one.
+DEFAULT_ENCODER_SETTINGS = {
+    "codecs": [],
+    "min_bitrate": 0,
+    "max_bitrate": 0,
+    "keyframe_interval": 0,
+}
+
+# aiortc has no public API for any of this, so these are its private
+# attributes as of the versions pinned in requirements.txt: the encoder
+# RTCRtpSender creates for its first frame, the coroutine encoding frames
+# with it, and the codecs a transceiver negotiated. Every use checks that
+# they exist and falls back to aiortc's own behaviour if they don't.
+SENDER_ENCODER = "_RTCRtpSender__encoder"
+SENDER_ENCODE = "_next_encoded_frame"
+TRANSCEIVER_CODECS = "_codecs"
+
+
+def missing_internal(owner, attribute, feature):
+    """Print why `feature` is off when aiortc lacks a private attribute; returns True if it does"""
+    if hasattr(owner, attribute):
+        return False
+    print(f"Error: {type(owner).__name__}.{attribute} is missing from this aiortc version, "
+          f"{feature} is disabled (see requirements.txt for the supported versions)")
+    return True
+
+
+def update_encoder_settings(settings, codecs=None, min_bitrate=None, max_bitrate=None, keyframe_interval=None):
+    """
+    Validate the given settings and apply them to the `settings` dict in
+    place; None leaves a setting unchanged. `codecs` is a list of names
+    (or a comma separated string) in order of preference.
+    """
+    changes = {}
+    if codecs is not None:
+        if isinstance(codecs, str):
+            codecs = codecs.split(",")
+        codecs = [name.strip().lower() for name in codecs if name.strip()]
+        for name in codecs:
+            if name not in VIDEO_CODECS:
+                raise ValueError(f"Unknown codec {name!r}, use one of {', '.join(VIDEO_CODECS)}")
+        changes["codecs"] = codecs
+    for name, value in (("min_bitrate", min_bitrate), ("max_bitrate", max_bitrate), ("keyframe_interval", keyframe_interval)):
+        if value is not None:
+            if value < 0:
+                raise ValueError(f"{name} can't be negative")
+            changes[name] = int(value)
+    merged = dict(settings, **changes)
+    if merged["min_bitrate"] and merged["max_bitrate"] and merged["min_bitrate"] > merged["max_bitrate"]:
+        raise ValueError("min_bitrate is above max_bitrate")
+    settings.update(changes)
+    return settings
+
+
+def prefer_codecs(transceiver, codecs):
+    """
+    Reorder the codecs `transceiver` negotiated with the remote offer, so the
+    answer lists (and the sender uses) the first of `codecs` the peer supports.
+    Codecs not in `codecs` stay available after them.
+    """
+    if not codecs or missing_internal(transceiver, TRANSCEIVER_CODECS, "the codec preference"):
+        return
+    order = [VIDEO_CODECS[name].lower() for name in codecs]
+    by_payload_type = {codec.payloadType: codec for codec in transceiver._codecs}
+
+    def rank(codec):
+        # Retransmission codecs go with the codec they carry
+        if codec.mimeType.lower() == "video/rtx":
+            codec = by_payload_type.get(codec.parameters.get("apt"), codec)
+        mime_type = codec.mimeType.lower()
+        return order.index(mime_type) if mime_type in order else len(order)
+
+    transceiver._codecs = sorted(transceiver._codecs, key=rank)
+
+
+class PeerEncoder:
+    """
+    An aiortc video encoder with the bitrate caps and keyframe interval of one peer.
+
+    The receiver's bandwidth estimates (RTCP REMB) still set the target
+    bitrate, but within `min_bitrate` and `max_bitrate` instead of aiortc's
+    limits for the codec. The keyframe interval of `settings` is read on
+    every frame; call `apply_bitrate` after changing the caps.
+    """
+
+    def __init__(self, encoder, codec, settings):
+        self.encoder = encoder
+        self.codec = codec
+        self.settings = settings
+        # The latest estimate of the receiver, or aiortc's default until one arrives
+        self.estimate = encoder.target_bitrate
+        self.frames = 0
+        self.keyframes = 0
+        self._since_keyframe = 0
+        # The value behind the target_bitrate setter, which clamps to aiortc's limits
+        self._bitrate_attribute = f"_{type(encoder).__name__}__target_bitrate"
+        if missing_internal(encoder, self._bitrate_attribute, "bitrate caps outside aiortc's limits"):
+            self._bitrate_attribute = None
+        self.apply_bitrate()
+
+    @property
+    def target_bitrate(self):
+        return self.encoder.target_bitrate
+
+    @target_bitrate.setter
+    def target_bitrate(self, bitrate):
+        # Set by the sender when a REMB packet arrives
+        self.estimate = bitrate
+        self.apply_bitrate()
+
+    def apply_bitrate(self):
+        """Set the latest estimate, within the caps, as the target bitrate"""
+        min_bitrate, max_bitrate = self.settings["min_bitrate"], self.settings["max_bitrate"]
+        if not min_bitrate and not max_bitrate:
+            self.encoder.target_bitrate = self.estimate
+            return
+        bitrate = self.estimate
+        if max_bitrate:
+            bitrate = min(bitrate, max_bitrate)
+        if min_bitrate:
+            bitrate = max(bitrate, min_bitrate)
+        # The target_bitrate setter would clamp to aiortc's limits again, so
+        # set the value behind it; the encoder recreates its codec context
+        # when the value changes by more than 10%
+        if self._bitrate_attribute is not None:
+            setattr(self.encoder, self._bitrate_attribute, int(bitrate))
+        else:
+            self.encoder.target_bitrate = int(bitrate)
+
+    def encode(self, frame, force_keyframe=False):
+        """Encode `frame`, forcing a keyframe every `keyframe_interval` frames"""
+        interval = self.settings["keyframe_interval"]
+        if force_keyframe:
+            KEYFRAMES.labels(reason="requested").inc()
+        elif interval and self._since_keyframe >= interval:
+            force_keyframe = True
+            KEYFRAMES.labels(reason="interval").inc()
+        if force_keyframe or self.frames == 0:
+            self.keyframes += 1
+            self._since_keyframe = 0
+        self._since_keyframe += 1
+        self.frames += 1
+        start = time.perf_counter()
+        try:
+            return self.encoder.encode(frame, force_keyframe)
+        finally:
+            ENCODE_SECONDS.labels(codec=self.codec).observe(time.perf_counter() - start)
+
+    def pack(self, packet):
+        return self.encoder.pack(packet)
+
+    def info(self):
+        return {
+            "codec": self.codec,
+            "target_bitrate": self.target_bitrate,
+            "estimated_bitrate": self.estimate,
+            "frames": self.frames,
+            "keyframes": self.keyframes,
+        }
+
+
+def install_encoder(sender, settings):
+    """
+    Make the RTCRtpSender `sender` encode with a PeerEncoder for `settings`,
+    created like aiortc's own encoder for the codec negotiated with the peer.
+    Returns False, leaving aiortc's encoder in place, if that isn't possible.
+    """
+    feature = "the per-peer encoder settings"
+    if missing_internal(sender, SENDER_ENCODE, feature) or missing_internal(sender, SENDER_ENCODER, feature):
+        return False
+    next_encoded_frame = getattr(sender, SENDER_ENCODE)
+
+    async def encode_next(codec):
+        if getattr(sender, SENDER_ENCODER) is None:
+            name = codec.mimeType.split("/")[-1].lower()
+            setattr(sender, SENDER_ENCODER, PeerEncoder(get_encoder(codec), name, settings))
+        return await next_encoded_frame(codec)
+
+    setattr(sender, SENDER_ENCODE, encode_next)
+    return True
+
+
+def sender_encoder(sender):
+    """The PeerEncoder of `sender`, or None before it encoded its first frame"""
+    encoder = getattr(sender, SENDER_ENCODER, None)
+    return encoder if isinstance(encoder, PeerEncoder) else None
@@ -0,0 +1,136 @@
+"""
+ICE server list from the coturn service, cached on disk and refreshed in the background.
+"""
+import asyncio
+import json
+import os
+import time
+
+import aiohttp
+
+ICE_SERVERS_URL = "https://ai.imjoy.io/public/services/coturn/get_rtc_ice_servers"
+FALLBACK_ICE_SERVERS = [{"urls": ["stun:stun.l.google.com:19302"]}]
+
+
+class IceServerCache:
+    """
+    The ICE servers (with their TURN credentials) of the coturn service.
+
+    The last fetched list is kept in the JSON file at `path` together with
+    the time it was fetched, so a restart can register the RTC service
+    without waiting for coturn. A list older than `ttl` seconds is still
+    used while a fresh one is fetched in the background, and `start_refresh`
+    keeps fetching a new list before the current one expires. All requests
+    share one HTTP session and give up after `timeout` seconds.
+    """
+
+    def __init__(self, path="ice_servers.json", ttl=3600, url=ICE_SERVERS_URL, timeout=5.0):
+        self.path = path
+        self.ttl = ttl
+        self.url = url
+        self.timeout = timeout
+        self.ice_servers = None
+        self.fetched_at = 0.0
+        # fetched_at of the list last returned by get()
+        self._served_at = 0.0
+        self._session = None
+        self._fetching = None
+        self._task = None
+
+    @property
+    def age(self):
+        return time.time() - self.fetched_at
+
+    def load(self):
+        """Read the cached list from disk, if there is one"""
+        try:
+            with open(self.path, "r") as file:
+                cached = json.load(file)
+            self.ice_servers = cached["ice_servers"]
+            self.fetched_at = float(cached["fetched_at"])
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            print(f"IceServerCache: ignoring unreadable cache {self.path}: {e}")
+
+    def _save(self):
+        # Write a temporary file first so a crash never leaves a truncated cache
+        temporary = self.path + ".tmp"
+        with open(temporary, "w") as file:
+            json.dump({"fetched_at": self.fetched_at, "ice_servers": self.ice_servers}, file)
+        os.replace(temporary, self.path)
+
+    async def fetch(self):
+        """Fetch a new list from the coturn service; returns True on success"""
+        # Concurrent callers share one request
+        if self._fetching is None or self._fetching.done():
+            self._fetching = asyncio.ensure_future(self._fetch())
+        return await asyncio.shield(self._fetching)
+
+    async def _fetch(self):
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=self.timeout))
+        try:
+            async with self._session.get(self.url) as response:
+                if response.status != 200:
+                    print(f"Failed to fetch ICE servers, status: {response.status}")
+                    return False
+                ice_servers = await response.json(content_type=None)
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            print(f"Error fetching ICE servers: {type(e).__name__}: {e}")
+            return False
+        if not ice_servers:
+            print("Fetched an empty ICE server list")
+            return False
+        self.ice_servers = ice_servers
+        self.fetched_at = time.time()
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, self._save)
+        except OSError as e:
+            print(f"IceServerCache: could not write {self.path}: {e}")
+        print(f"Fetched {len(ice_servers)} ICE servers")
+        return True
+
+    async def get(self):
+        """
+        The ICE servers to use now: the cached list if there is one (fetching
+        a fresh one in the background when it is older than `ttl`), otherwise
+        a newly fetched list, or a public STUN server if coturn can't be reached
+        """
+        if self.ice_servers is None:
+            await asyncio.get_running_loop().run_in_executor(None, self.load)
+        if self.ice_servers is None:
+            if not await self.fetch():
+                print("Using fallback ICE servers")
+                self._served_at = 0.0
+                return FALLBACK_ICE_SERVERS
+        elif self.age >= self.ttl:
+            print(f"Using cached ICE servers from {self.age:.0f}s ago while fetching new ones")
+            asyncio.ensure_future(self.fetch())
+        else:
+            print(f"Using cached ICE servers from {self.age:.0f}s ago")
+        self._served_at = self.fetched_at
+        return self.ice_servers
+
+    def start_refresh(self, on_refresh):
+        """Fetch a new list before the current one expires and pass it to `on_refresh(ice_servers)`"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._refresh(on_refresh, self._served_at))
+
+    async def _refresh(self, on_refresh, fetched_at):
+        while True:
+            # Pass on a list fetched since the served one right away, e.g. by
+            # the background fetch of get() for an expired cache
+            if self.fetched_at != fetched_at:
+                fetched_at = self.fetched_at
+                on_refresh(self.ice_servers)
+            # Refresh at 80% of the lifetime, retrying failures every tenth of it
+            await asyncio.sleep(max(1.0, self.ttl * 0.8 - self.age))
+            if self.fetched_at == fetched_at and not await self.fetch():
+                await asyncio.sleep(max(1.0, self.ttl * 0.1))
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+        if self._session is not None:
+            await self._session.close()
@@ -0,0 +1,304 @@
+"""
+Headless WebRTC load test for the microscope service.
+
+Opens N peer connections on one machine against a server started with
+`python server.py --local`, pulls the video streams like a browser would and
+calls microscope-control over each connection's data channel. Reports the
+received frame rate, decode stalls and control round-trip times as JSON.
+
+    python server.py --local
+    python loadtest.py --peers 8 --duration 30 --output load.json
+"""
+import argparse
+import asyncio
+import fractions
+import json
+import random
+import sys
+import time
+
+import aiohttp
+import numpy as np
+from aiortc import MediaStreamTrack, RTCConfiguration, RTCPeerConnection, RTCSessionDescription
+from aiortc.mediastreams import MediaStreamError
+from av import VideoFrame
+
+from local_signaling import CONTROL_CHANNEL
+
+RTP_TIMESTAMP_WRAP = 1 << 32
+
+
+def percentile_ms(values, q):
+    """The q-th percentile of durations in seconds, in milliseconds"""
+    if not values:
+        return None
+    return float(np.percentile(values, q)) * 1000
+
+
+class PlaceholderTrack(MediaStreamTrack):
+    """A tiny black video track standing in for the canvas stream the browser sends"""
+
+    kind = "video"
+
+    def __init__(self, width=64, height=48, fps=5):
+        super().__init__()
+        self.fps = fps
+        self.count = 0
+        self.start = None
+        self.image = np.zeros((height, width, 3), dtype=np.uint8)
+
+    async def recv(self):
+        if self.start is None:
+            self.start = time.monotonic()
+        delay = self.start + self.count / self.fps - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        frame = VideoFrame.from_ndarray(self.image, format="bgr24")
+        frame.pts = self.count
+        frame.time_base = fractions.Fraction(1, self.fps)
+        self.count += 1
+        return frame
+
+
+class LoadTestPeer:
+    """One headless viewer: a peer connection receiving video and sending control calls"""
+
+    def __init__(self, index, url, stall_seconds):
+        self.index = index
+        self.url = url
+        self.stall_seconds = stall_seconds
+        self.pc = RTCPeerConnection(configuration=RTCConfiguration(iceServers=[]))
+        self.channel = self.pc.createDataChannel(CONTROL_CHANNEL)
+        self.channel_open = asyncio.Event()
+        self.pending = {}
+        self.next_call_id = 0
+        self.frame_times = []
+        self.stalls = []
+        self.rtts = []
+        self.position_updates = []
+        self.errors = 0
+        self.connect_time = None
+        self.first_frame_time = None
+        self.frame_size = None
+        self.tasks = []
+
+        @self.channel.on("open")
+        def on_open():
+            self.channel_open.set()
+
+        @self.channel.on("message")
+        def on_message(message):
+            reply = json.loads(message)
+            if "callback" in reply:
+                self.position_updates.append(time.monotonic())
+                return
+            future = self.pending.pop(reply["id"], None)
+            if future is not None and not future.done():
+                future.set_result(reply)
+
+        @self.pc.on("track")
+        def on_track(track):
+            if track.kind == "video":
+                self.tasks.append(asyncio.ensure_future(self.consume(track)))
+
+    async def connect(self, session):
+        self.pc.addTrack(PlaceholderTrack())
+        start = time.monotonic()
+        offer = await self.pc.createOffer()
+        await self.pc.setLocalDescription(offer)
+        async with session.post(f"{self.url}/offer", json={
+            "sdp": self.pc.localDescription.sdp,
+            "type": self.pc.localDescription.type,
+        }) as response:
+            response.raise_for_status()
+            answer = await response.json()
+        await self.pc.setRemoteDescription(RTCSessionDescription(sdp=answer["sdp"], type=answer["type"]))
+        self.connect_time = start
+
+    async def consume(self, track):
+        """
+        Receive decoded frames, recording arrival times and stalls. A stall is
+        a frame arriving more than stall_seconds later than its timestamp says
+        after the previous one, so the slow frame rate of an idle server
+        doesn't count; frames the server skips are in its own stats.
+        """
+        last = None
+        try:
+            while True:
+                frame = await track.recv()
+                self.frame_size = (frame.width, frame.height)
+                now = time.monotonic()
+                if self.first_frame_time is None:
+                    self.first_frame_time = now
+                if last is not None:
+                    # RTP timestamps wrap around at 32 bits
+                    media_gap = float(((frame.pts - last[1]) % RTP_TIMESTAMP_WRAP) * frame.time_base)
+                    delay = now - last[0] - media_gap
+                    if delay > self.stall_seconds:
+                        self.stalls.append((now, delay))
+                self.frame_times.append(now)
+                last = (now, frame.pts)
+        except MediaStreamError:
+            pass
+
+    async def call(self, method, callbacks=(), **kwargs):
+        """Call a microscope-control function over the data channel and return the reply"""
+        self.next_call_id += 1
+        call_id = self.next_call_id
+        future = asyncio.get_running_loop().create_future()
+        self.pending[call_id] = future
+        start = time.monotonic()
+        self.channel.send(json.dumps({"id": call_id, "method": method, "kwargs": kwargs, "callbacks": list(callbacks)}))
+        try:
+            reply = await asyncio.wait_for(future, timeout=5)
+        finally:
+            self.pending.pop(call_id, None)
+        self.rtts.append(time.monotonic() - start)
+        if "error" in reply:
+            self.errors += 1
+        return reply
+
+    async def control_loop(self, interval, move_every=4, position_updates=False, view_size=None):
+        """
+        Poll the position and move the stage now and then, like an operator
+        would. With `position_updates` the position is pushed by the server
+        instead of polled, `view_size` (width, height) asks for a smaller stream.
+        """
+        await self.channel_open.wait()
+        if view_size:
+            await self.call("set_view_size", width=view_size[0], height=view_size[1])
+        if position_updates:
+            await self.call("subscribe_position", callbacks=["callback"], max_rate=20)
+        calls = 0
+        while True:
+            try:
+                if calls % move_every == move_every - 1:
+                    await self.call(
+                        "move", value=random.uniform(-50, 50), axis=random.choice("XY"), is_absolute=False, is_blocking=False,
+                    )
+                elif not position_updates:
+                    await self.call("get_position")
+            except asyncio.TimeoutError:
+                self.errors += 1
+            calls += 1
+            await asyncio.sleep(interval)
+
+    async def close(self):
+        for task in self.tasks:
+            task.cancel()
+        await self.pc.close()
+
+    def report(self, start, end):
+        frames = [t for t in self.frame_times if start <= t <= end]
+        fps = (len(frames) - 1) / (frames[-1] - frames[0]) if len(frames) > 1 else 0.0
+        gaps = np.diff(frames) if len(frames) > 1 else np.array([])
+        stalls = [gap for t, gap in self.stalls if start <= t <= end]
+        return {
+            "peer": self.index,
+            "frames": len(frames),
+            "fps": fps,
+            "time_to_first_frame_s": (self.first_frame_time - self.connect_time) if self.first_frame_time else None,
+            "stalls": len(stalls),
+            "stall_time_s": sum(stalls),
+            "max_frame_gap_ms": float(gaps.max() * 1000) if len(gaps) else None,
+            "frame_size": self.frame_size,
+            "position_updates": len([t for t in self.position_updates if start <= t <= end]),
+            "control_calls": len(self.rtts),
+            "control_errors": self.errors,
+            "rtt_p50_ms": percentile_ms(self.rtts, 50),
+            "rtt_p95_ms": percentile_ms(self.rtts, 95),
+            "rtt_max_ms": max(self.rtts) * 1000 if self.rtts else None,
+        }
+
+
+async def producer_stats(peer):
+    """The server's frame pacing counters (frames it rendered late or skipped), or None"""
+    try:
+        reply = await peer.call("get_stream_stats")
+    except asyncio.TimeoutError:
+        return None
+    return (reply.get("result") or {}).get("producer")
+
+
+async def run(args):
+    peers = [LoadTestPeer(index, args.url, args.stall_ms / 1000) for index in range(args.peers)]
+    async with aiohttp.ClientSession() as session:
+        await asyncio.gather(*(peer.connect(session) for peer in peers))
+    print(f"Connected {len(peers)} peers to {args.url}", file=sys.stderr)
+    control_tasks = [
+        asyncio.ensure_future(peer.control_loop(
+            args.control_interval, position_updates=args.position_updates,
+            view_size=args.view_size if args.view_size_peers is None or peer.index < args.view_size_peers else None,
+        ))
+        for peer in peers
+    ]
+
+    # Measure after the warmup, once the streams are flowing
+    await asyncio.sleep(args.warmup)
+    producer_start = await producer_stats(peers[0])
+    start = time.monotonic()
+    await asyncio.sleep(args.duration)
+    end = time.monotonic()
+    producer_end = await producer_stats(peers[0])
+
+    for task in control_tasks:
+        task.cancel()
+    reports = [peer.report(start, end) for peer in peers]
+    await asyncio.gather(*(peer.close() for peer in peers), return_exceptions=True)
+
+    rtts = [rtt for peer in peers for rtt in peer.rtts]
+    fps = [report["fps"] for report in reports]
+    return {
+        "url": args.url,
+        "peers": args.peers,
+        "duration_s": end - start,
+        "summary": {
+            "fps_mean": float(np.mean(fps)) if fps else 0.0,
+            "fps_min": float(np.min(fps)) if fps else 0.0,
+            "stalls": sum(report["stalls"] for report in reports),
+            "producer_skipped": producer_end["skipped"] - producer_start["skipped"] if producer_start and producer_end else None,
+            "producer_late": producer_end["late"] - producer_start["late"] if producer_start and producer_end else None,
+            "control_errors": sum(report["control_errors"] for report in reports),
+            "rtt_p50_ms": percentile_ms(rtts, 50),
+            "rtt_p95_ms": percentile_ms(rtts, 95),
+        },
+        "per_peer": reports,
+    }
+
+
+def parse_size(value):
+    width, height = value.lower().split("x")
+    return int(width), int(height)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Headless WebRTC load test against `server.py --local`")
+    parser.add_argument("--url", type=str, default="http://127.0.0.1:9527", help="Local signalling endpoint")
+    parser.add_argument("--peers", type=int, default=4, help="Number of peer connections")
+    parser.add_argument("--duration", type=float, default=20, help="Measured seconds")
+    parser.add_argument("--warmup", type=float, default=3, help="Seconds to let the streams start before measuring")
+    parser.add_argument("--control-interval", type=float, default=0.5, help="Seconds between control calls per peer")
+    parser.add_argument("--position-updates", action="store_true", help="Subscribe to pushed position updates instead of polling get_position")
+    parser.add_argument("--view-size", type=parse_size, default=None, help="Ask for a stream of about WIDTHxHEIGHT pixels with set_view_size")
+    parser.add_argument("--view-size-peers", type=int, default=None, help="Only the first this many peers ask for --view-size (default all)")
+    parser.add_argument("--stall-ms", type=float, default=200, help="Frames arriving this much later than their timestamps say count as stalls")
+    parser.add_argument("--output", type=str, default=None, help="Write the JSON report here instead of stdout")
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    summary = report["summary"]
+    print(
+        f"{args.peers} peers: {summary['fps_mean']:.1f} fps mean, {summary['fps_min']:.1f} min, "
+        f"{summary['stalls']} stalls, control RTT p50 {summary['rtt_p50_ms'] or 0:.1f} ms, "
+        f"p95 {summary['rtt_p95_ms'] or 0:.1f} ms",
+        file=sys.stderr,
+    )
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+"""
+Loopback signalling for running the service without hypha.aicell.io.
+"""
+import asyncio
+import base64
+import functools
+import inspect
+import json
+
+import numpy as np
+from aiohttp import web
+from aiortc import RTCConfiguration, RTCPeerConnection, RTCSessionDescription
+
+CONTROL_CHANNEL = "control"
+
+# Context passed to the control functions in place of the Hypha user context
+LOCAL_CONTEXT = {"user": {"id": "local"}, "ws": "local"}
+
+
+def encode_binary(value):
+    """JSON fallback for binary results: bytes as base64, arrays as {"dtype", "shape", "data"}"""
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return base64.b64encode(value).decode("ascii")
+    if isinstance(value, np.ndarray):
+        return {"dtype": str(value.dtype), "shape": list(value.shape), "data": encode_binary(value.tobytes())}
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+class LocalSignalingServer:
+    """
+    Stands in for the Hypha RTC service on a plain HTTP endpoint.
+
+    POST /offer with {"sdp", "type"} answers the offer like the `offer`
+    function registered by hypha_rpc's register_rtc_service, calling
+    `on_init(peer_connection)` first. Peers open a data channel named
+    "control" and send JSON {"id", "method", "kwargs"} messages; every call
+    runs the function of the `service` dict like a Hypha service with
+    run_in_executor (plain functions in the default executor, coroutine
+    functions on the loop) and is answered with {"id", "result"} or
+    {"id", "error"}, with bytes and arrays in the result encoded as base64.
+    Async generator functions send each item as {"id", "item"} before the
+    final {"id", "result": null}.
+    The context of every call carries the caller's "peer_connection".
+    Keyword arguments listed in an optional "callbacks" field are passed as
+    functions that send {"id", "callback", "args"} messages back over the
+    channel. Only host candidates are gathered, so
+    peers have to be on the same machine or network.
+    With `offer_handler(params)` the offers are answered by that coroutine
+    function instead, e.g. one handing the peer to a worker process.
+    """
+
+    def __init__(self, service, on_init=None, host="127.0.0.1", port=9527, offer_handler=None):
+        self.functions = {name: value for name, value in service.items() if callable(value)}
+        self.on_init = on_init
+        self.offer_handler = offer_handler
+        self.host = host
+        self.port = port
+        self.peer_connections = set()
+        self.app = web.Application()
+        self.app.router.add_post("/offer", self.handle_offer)
+        self._runner = None
+
+    async def start(self):
+        self._runner = web.AppRunner(self.app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        print(f"Local signalling listening on http://{self.host}:{self.port}/offer")
+
+    async def stop(self):
+        await asyncio.gather(*(pc.close() for pc in list(self.peer_connections)), return_exceptions=True)
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def handle_offer(self, request):
+        params = await request.json()
+        answer = self.offer_handler or self.answer
+        return web.json_response(await answer(params))
+
+    async def answer(self, params):
+        """Answer the offer {"sdp", "type"} with a peer connection of this server"""
+        offer = RTCSessionDescription(sdp=params["sdp"], type=params["type"])
+        pc = RTCPeerConnection(configuration=RTCConfiguration(iceServers=[]))
+        self.peer_connections.add(pc)
+
+        @pc.on("connectionstatechange")
+        async def on_connectionstatechange():
+            if pc.connectionState in ("failed", "closed"):
+                self.peer_connections.discard(pc)
+
+        @pc.on("datachannel")
+        def on_datachannel(channel):
+            if channel.label != CONTROL_CHANNEL:
+                return
+
+            @channel.on("message")
+            def on_message(message):
+                asyncio.ensure_future(self.handle_call(channel, message, pc))
+
+        if self.on_init:
+            await self.on_init(pc)
+        await pc.setRemoteDescription(offer)
+        answer = await pc.createAnswer()
+        await pc.setLocalDescription(answer)
+        return {"sdp": pc.localDescription.sdp, "type": pc.localDescription.type}
+
+    async def handle_call(self, channel, message, pc=None):
+        call = json.loads(message)
+        reply = {"id": call.get("id")}
+        try:
+            func = self.functions[call["method"]]
+            kwargs = dict(call.get("kwargs", {}))
+            for name in call.get("callbacks", []):
+                kwargs[name] = self.remote_callback(channel, call.get("id"), name)
+            context = dict(LOCAL_CONTEXT, peer_connection=pc)
+            call_func = functools.partial(func, context=context, **kwargs)
+            if inspect.isasyncgenfunction(func):
+                # Stream the items, the final reply only marks the end
+                async for item in call_func():
+                    if channel.readyState != "open":
+                        return
+                    channel.send(json.dumps({"id": call.get("id"), "item": item}, default=encode_binary))
+                result = None
+            elif inspect.iscoroutinefunction(func):
+                result = await call_func()
+            else:
+                result = await asyncio.get_running_loop().run_in_executor(None, call_func)
+            reply["result"] = result
+        except Exception as e:
+            reply["error"] = f"{type(e).__name__}: {e}"
+        if channel.readyState == "open":
+            channel.send(json.dumps(reply, default=encode_binary))
+
+    def remote_callback(self, channel, call_id, name):
+        """A function forwarding its arguments to the peer as a callback message"""
+        def callback(*args):
+            if channel.readyState != "open":
+                raise ConnectionError("Control channel closed")
+            channel.send(json.dumps({"id": call_id, "callback": name, "args": list(args)}))
+        return callback
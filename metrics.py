@@ -0,0 +1,306 @@
+"""
+Lightweight Prometheus-style metrics for the streaming service.
+
+Counters, gauges and histograms are updated with a short lock per labelled
+series, so they are safe to use from the render pool and from the RPC
+executor threads and cheap enough for every frame. `render_metrics()`
+produces the Prometheus text exposition format served on /metrics.
+"""
+import bisect
+import functools
+import inspect
+import threading
+import time
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.25, 0.5, 0.75, 1.0, 2.5, 5.0, 7.5, 10.0)
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    pairs = []
+    for name, value in labels:
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+class CounterValue:
+    def __init__(self):
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def samples(self, name):
+        yield name + "_total", (), self.value
+
+
+class GaugeValue(CounterValue):
+    def set(self, value):
+        self.value = value
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    def samples(self, name):
+        yield name, (), self.value
+
+
+class HistogramValue:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def samples(self, name):
+        with self._lock:
+            counts, total = list(self.counts), self.sum
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += count
+            yield name + "_bucket", (("le", format_value(bound)),), cumulative
+        yield name + "_sum", (), total
+        yield name + "_count", (), cumulative
+
+
+class Metric:
+    """
+    A metric family with optional labels.
+
+    Without labels the family updates its single series directly
+    (`counter.inc()`), with labels pick the series first
+    (`counter.labels(method="move").inc()`). A gauge or counter can instead
+    be computed when scraped by `function`, which returns the value, or a
+    dict from label value tuples to values for labelled families.
+    """
+
+    kind = None
+    value_class = None
+    suffix = ""  # Appended to the name of computed samples
+
+    def __init__(self, name, documentation, labelnames=(), function=None, registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.function = function
+        self._series = {}
+        self._lock = threading.Lock()
+        (REGISTRY if registry is None else registry).append(self)
+
+    def _new_value(self):
+        return self.value_class()
+
+    def labels(self, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        series = self._series.get(key)
+        if series is None:
+            with self._lock:
+                series = self._series.setdefault(key, self._new_value())
+        return series
+
+    def set_function(self, function):
+        """Compute the value(s) with `function` whenever the metrics are scraped"""
+        self.function = function
+
+    def collect(self):
+        """Yield (sample name, labels, value) of every series"""
+        if self.function is not None:
+            values = self.function()
+            if not self.labelnames:
+                values = {(): values}
+            for key, value in values.items():
+                yield self.name + self.suffix, tuple(zip(self.labelnames, key)), value
+            return
+        for key, series in list(self._series.items()):
+            for name, extra_labels, value in series.samples(self.name):
+                yield name, tuple(zip(self.labelnames, key)) + extra_labels, value
+
+
+class Counter(Metric):
+    kind = "counter"
+    value_class = CounterValue
+    suffix = "_total"
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+
+class Gauge(Metric):
+    kind = "gauge"
+    value_class = GaugeValue
+
+    def set(self, value):
+        self.labels().set(value)
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def dec(self, amount=1):
+        self.labels().dec(amount)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS, registry=None):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames, registry=registry)
+
+    def _new_value(self):
+        return HistogramValue(self.buckets)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+
+# All metrics, in the order they are rendered
+REGISTRY = []
+
+
+def render_metrics(registry=None):
+    """Render the metrics in the Prometheus text exposition format"""
+    lines = []
+    for metric in REGISTRY if registry is None else registry:
+        lines.append(f"# HELP {metric.name} {metric.documentation}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for name, labels, value in metric.collect():
+            lines.append(f"{name}{format_labels(labels)} {format_value(value)}")
+    return "\n".join(lines) + "\n"
+
+
+# Frame production
+RENDER_SECONDS = Histogram(
+    "microscope_render_seconds", "Time to render one frame",
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.02, 0.033, 0.05, 0.1, 0.25, 0.5, 1.0),
+)
+FRAME_INTERVAL_SECONDS = Histogram(
+    "microscope_frame_interval_seconds", "Time between consecutive published frames",
+    buckets=(0.01, 0.02, 0.03, 0.035, 0.04, 0.05, 0.067, 0.1, 0.25, 0.5, 1.0),
+)
+VIDEO_FRAME_SECONDS = Histogram(
+    "microscope_video_frame_seconds", "Time to wrap a rendered image into a VideoFrame",
+    buckets=(0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01),
+)
+FRAMES_LATE = Counter("microscope_frames_late", "Frames published after their deadline")
+FRAMES_SKIPPED = Counter("microscope_frames_skipped", "Frame slots skipped because the producer fell behind")
+PRODUCER_IDLE = Gauge("microscope_producer_idle", "1 while frames are produced at the idle frame rate because the stage is at rest")
+
+# Peers
+ACTIVE_PEERS = Gauge("microscope_active_peers", "Open WebRTC peer connections")
+ACTIVE_TRACKS = Gauge("microscope_active_tracks", "Video tracks subscribed to the frame producer")
+PEER_CONNECTION_STATES = Gauge(
+    "microscope_peer_connection_states", "WebRTC peer connections by connection state", labelnames=("state",),
+)
+
+# RPCs
+RPC_CALLS = Counter("microscope_rpc_calls", "RPC calls by method and outcome", labelnames=("method", "status"))
+RPC_SECONDS = Histogram(
+    "microscope_rpc_seconds", "RPC latency by method", labelnames=("method",),
+    buckets=(0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5),
+)
+
+
+# Snapshots
+SNAPSHOTS = Counter(
+    "microscope_snapshots", "snap() requests by image format and encoded snapshot cache outcome",
+    labelnames=("format", "cache"),
+)
+SNAPSHOT_ENCODE_SECONDS = Histogram(
+    "microscope_snapshot_encode_seconds", "Time to encode a snapshot by image format", labelnames=("format",),
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5),
+)
+
+# Resolution pyramid
+PYRAMID_FRAMES = Counter(
+    "microscope_pyramid_frames", "Frames handed to consumers by pyramid level (0 is full resolution)",
+    labelnames=("level",),
+)
+DOWNSCALE_SECONDS = Histogram(
+    "microscope_downscale_seconds", "Time to downscale a frame to the next pyramid level",
+    buckets=(0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01),
+)
+
+# Encoding
+ENCODE_SECONDS = Histogram(
+    "microscope_encode_seconds", "Time to encode one frame for a peer by codec", labelnames=("codec",),
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25),
+)
+KEYFRAMES = Counter(
+    "microscope_keyframes", "Keyframes forced by reason (interval or requested by the receiver)",
+    labelnames=("reason",),
+)
+
+# Recording
+RECORDING_FRAMES = Counter(
+    "microscope_recording_frames", "Frames offered to the stream recorder by outcome (written or dropped)",
+    labelnames=("outcome",),
+)
+
+
+def instrument_rpc(func):
+    """
+    Count the calls of an RPC function by outcome and record their latency;
+    for generator functions until the generator is exhausted
+    """
+    method = func.__name__
+    latency = RPC_SECONDS.labels(method=method)
+
+    def record(start, status):
+        latency.observe(time.perf_counter() - start)
+        RPC_CALLS.labels(method=method, status=status).inc()
+
+    if inspect.isasyncgenfunction(func):
+        @functools.wraps(func)
+        async def generator_wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            status = "error"
+            try:
+                async for item in func(*args, **kwargs):
+                    yield item
+                status = "ok"
+            finally:
+                record(start, status)
+        return generator_wrapper
+
+    if inspect.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def async_wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            status = "error"
+            try:
+                result = await func(*args, **kwargs)
+                status = "ok"
+                return result
+            finally:
+                record(start, status)
+        return async_wrapper
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        status = "error"
+        try:
+            result = func(*args, **kwargs)
+            status = "ok"
+            return result
+        finally:
+            record(start, status)
+    return wrapper
@@ -0,0 +1,553 @@
+"""
+Shared frame production for all connected peers.
+"""
+import asyncio
+import collections
+import fractions
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from av import VideoFrame
+
+from metrics import DOWNSCALE_SECONDS, FRAME_INTERVAL_SECONDS, PYRAMID_FRAMES, RENDER_SECONDS, VIDEO_FRAME_SECONDS
+from scheduler import VIDEO_CLOCK_RATE, DeadlineStats, FrameScheduler
+
+VIDEO_TIME_BASE = fractions.Fraction(1, VIDEO_CLOCK_RATE)
+
+# Levels of the output pyramid, each half the width and height of the one above
+PYRAMID_LEVELS = 3
+
+# Encoded bits per pixel a stream needs to look acceptable, to fit pyramid
+# levels to a peer's estimated bandwidth. The default 480x360 at 30 fps
+# needs about 260 kbps, which fits aiortc's initial VP8 target of 500 kbps
+# with room to step back up.
+BITS_PER_PIXEL = 0.05
+
+# Seconds a peer stays below the level its size asks for before it tries the
+# next level up, how long it keeps it, and the longest wait after failed tries
+PROBE_INTERVAL = 10.0
+PROBE_HOLD = 3.0
+MAX_PROBE_INTERVAL = 60.0
+
+
+def create_render_executor(workers, mode="thread"):
+    """Create the worker pool used to render frames off the event loop"""
+    if workers <= 0:
+        return None
+    if mode == "process":
+        # Spawn fresh interpreters, forking a process with a running event
+        # loop and aiortc threads is not safe
+        return ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn"))
+    if mode == "thread":
+        return ThreadPoolExecutor(workers, thread_name_prefix="render")
+    raise ValueError(f"Unknown render mode: {mode}")
+
+
+def timed_render(render, *args):
+    """Call render(*args) and return its result with the render time in seconds"""
+    start = time.perf_counter()
+    result = render(*args)
+    return result, time.perf_counter() - start
+
+
+def even(value):
+    return max(2, int(value) // 2 * 2)
+
+
+def pyramid_sizes(width, height):
+    """The (width, height) of every pyramid level of a width x height frame"""
+    sizes = [(width, height)]
+    while len(sizes) < PYRAMID_LEVELS:
+        width, height = sizes[-1]
+        sizes.append((even(width / 2), even(height / 2)))
+    return sizes
+
+
+def select_level(width, height, fps, max_width=None, max_height=None, bitrate=None, current=0):
+    """
+    The pyramid level for a peer: the smallest one that still covers the
+    `max_width` x `max_height` it asked for, or a smaller one while the
+    level doesn't fit into its estimated `bitrate` (bits per second).
+    Going back up to a level above `current` needs 25% headroom, so the
+    level doesn't flap with every bandwidth estimate.
+    """
+    sizes = pyramid_sizes(width, height)
+    level = 0
+    if max_width or max_height:
+        while level + 1 < len(sizes) and sizes[level + 1][0] >= (max_width or 0) and sizes[level + 1][1] >= (max_height or 0):
+            level += 1
+    if bitrate:
+        while level + 1 < len(sizes):
+            level_width, level_height = sizes[level]
+            headroom = 1.25 if level < current else 1.0
+            if level_width * level_height * fps * BITS_PER_PIXEL * headroom <= bitrate:
+                break
+            level += 1
+    return level
+
+
+class LevelSelector:
+    """
+    Picks the pyramid level of one peer with select_level, probing upwards.
+
+    A receiver's bandwidth estimate only grows with the bitrate it receives,
+    so a peer moved to a smaller level would rarely show the headroom to
+    come back. After `probe_interval` seconds below the level its size asks
+    for, the selector sends the next level up for `probe_hold` seconds
+    whatever the estimate says. It stays there if the estimate followed, and
+    otherwise steps back down and waits twice as long (up to
+    `max_probe_interval`) before the next try.
+
+    While `frozen` (the producer idles at a low frame rate, so the estimate
+    only reflects that) the level stays put, and once thawed it is held for
+    `probe_hold` seconds like a probe, while the estimate catches up.
+    """
+
+    def __init__(self, probe_interval=PROBE_INTERVAL, probe_hold=PROBE_HOLD, max_probe_interval=MAX_PROBE_INTERVAL):
+        self.probe_interval = probe_interval
+        self.probe_hold = probe_hold
+        self.max_probe_interval = max_probe_interval
+        self.level = 0
+        self._interval = probe_interval
+        self._next_probe = 0.0
+        self._probe_level = None
+        self._probe_until = 0.0
+
+    def select(self, width, height, fps, max_width=None, max_height=None, bitrate=None, now=None, frozen=False):
+        """The level for the current estimate; `now` is a time.monotonic() value"""
+        now = time.monotonic() if now is None else now
+        if frozen:
+            self._probe_level = self.level
+            self._probe_until = now + self.probe_hold
+            return self.level
+        wanted = select_level(width, height, fps, max_width, max_height)
+        level = select_level(width, height, fps, max_width, max_height, bitrate, self.level)
+        if self._probe_level is not None:
+            if now < self._probe_until:
+                # Give the estimate time to follow the probed level
+                level = min(level, self._probe_level)
+            else:
+                if level <= self._probe_level:
+                    self._interval = self.probe_interval
+                else:
+                    self._interval = min(self._interval * 2, self.max_probe_interval)
+                self._probe_level = None
+        elif wanted < level <= self.level and now >= self._next_probe:
+            level -= 1
+            self._probe_level = level
+            self._probe_until = now + self.probe_hold
+        if level > self.level:
+            self._next_probe = now + self._interval
+        self.level = level
+        return level
+
+
+class AdaptiveQuality:
+    """
+    Steps the stream resolution and frame rate down under CPU pressure.
+
+    Quality levels go from the configured resolution and frame rate down to
+    half the resolution at half the frame rate. After every `window` frames
+    the controller looks at the share of frames that missed their deadline
+    and at the render time relative to the frame interval: it steps down
+    when either is too high, and back up once the next level up is expected
+    to fit comfortably for `recovery_windows` windows in a row.
+    """
+
+    # (resolution scale, frame rate scale) from best to cheapest
+    LADDER = [(1.0, 1.0), (0.75, 1.0), (0.5, 1.0), (0.5, 2 / 3), (0.5, 0.5)]
+
+    def __init__(self, width, height, fps, window=30, max_miss_ratio=0.1,
+                 max_load=0.85, recovery_load=0.6, recovery_windows=3):
+        self.window = window
+        self.max_miss_ratio = max_miss_ratio
+        self.max_load = max_load
+        self.recovery_load = recovery_load
+        self.recovery_windows = recovery_windows
+        self.configure(width, height, fps)
+
+    def configure(self, width, height, fps):
+        """Set the best quality level and start again from it"""
+        levels = []
+        for size_scale, fps_scale in self.LADDER:
+            level = (even(width * size_scale), even(height * size_scale), max(1, round(fps * fps_scale)))
+            if level not in levels:
+                levels.append(level)
+        # Readers index levels[level], so never leave them a partial ladder
+        self.level = 0
+        self.levels = levels
+        self._reset_window()
+        self._good_windows = 0
+
+    @property
+    def current(self):
+        """The (width, height, fps) to render at"""
+        return self.levels[self.level]
+
+    def _reset_window(self):
+        self._frames = 0
+        self._misses = 0
+        self._render_time = 0.0
+
+    def _cost(self, level):
+        width, height, fps = self.levels[level]
+        return width * height * fps
+
+    def record(self, render_time, missed=0):
+        """Account one produced frame; returns True when the quality level changed"""
+        self._frames += 1
+        self._misses += missed
+        self._render_time += render_time
+        if self._frames < self.window:
+            return False
+
+        fps = self.current[2]
+        miss_ratio = self._misses / (self._frames + self._misses)
+        load = self._render_time / self._frames * fps
+        self._reset_window()
+
+        if (miss_ratio > self.max_miss_ratio or load > self.max_load) and self.level < len(self.levels) - 1:
+            self.level += 1
+            self._good_windows = 0
+            print(f"AdaptiveQuality: stepping down to {self.current} (load {load:.2f}, missed {miss_ratio:.0%})")
+            return True
+
+        if self.level > 0 and miss_ratio == 0:
+            # Estimate the load at the next level up from its pixel rate
+            expected_load = load * self._cost(self.level - 1) / self._cost(self.level)
+            if expected_load < self.recovery_load:
+                self._good_windows += 1
+                if self._good_windows >= self.recovery_windows:
+                    self.level -= 1
+                    self._good_windows = 0
+                    print(f"AdaptiveQuality: stepping up to {self.current} (load {load:.2f})")
+                    return True
+                return False
+        self._good_windows = 0
+        return False
+
+
+class Subscription:
+    """
+    A consumer of the FrameProducer, with its own bounded frame queue.
+
+    Queue items are (frame, deadline_ns) pairs, with frames of the pyramid
+    `level` the consumer asked for (0 is full resolution). Every consumer
+    gets its own VideoFrame over the shared pixels, since encoders rebase
+    the pts and time_base and set the pict_type of the frames they are
+    handed. `dropped` counts
+    frames that were discarded because the consumer did not pull them in
+    time, `stats` and `waited_ns` are filled in by the consumer when it
+    receives frames.
+    """
+
+    def __init__(self, queue_size):
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.level = 0
+        self.dropped = 0
+        self.stats = DeadlineStats()
+        self.waited_ns = 0  # Time spent waiting for the producer
+
+    def as_dict(self):
+        stats = self.stats.as_dict()
+        stats["skipped"] = self.dropped
+        stats["waited_ms"] = self.waited_ns / 1e6
+        return stats
+
+
+class FrameProducer:
+    """
+    Renders each frame once per tick and fans it out to every subscriber.
+
+    `snapshot(count)` runs on the event loop and returns the stage state for
+    frame `count`. `render(state, count, width, height, fps, pixel_format, t)`
+    returns the frame as a uint8 image in `pixel_format` (bgr24, or packed
+    yuv420p planes). Without an executor the render runs inline on the event
+    loop. With an executor up to `pipeline_depth` frames are rendered ahead in
+    the pool, so the loop only picks up finished frames and stays responsive
+    while rendering saturates other cores. For process pools `render` has to
+    be picklable.
+
+    With `adaptive` set, an AdaptiveQuality controller lowers the resolution
+    and frame rate while frames miss their deadlines and raises them again
+    when rendering keeps up.
+
+    Frames are paced by a FrameScheduler on the monotonic clock, which also
+    numbers them, stamps their pts and counts late and skipped frames.
+
+    Every subscriber gets a small bounded queue. A consumer that falls behind
+    (e.g. a slow encoder) loses its oldest queued frame instead of holding
+    back the producer or the other peers.
+
+    Subscribers can ask for a lower level of a resolution pyramid (half,
+    quarter size). Only the full frame is rendered; each lower level is
+    downscaled from the one above, once per frame and only while a
+    subscriber wants it, so small streams cost a fraction of the encoding.
+    Subscribers share the pixels of a level but get their own VideoFrame
+    object, with its own pts, time_base and pict_type.
+
+    With a `stage` (a StageController or SharedStageReader) and `idle_fps`
+    set, frames are produced at `idle_fps` once the stage has been at rest
+    for `idle_after` seconds, when only the specimens' float and pulse
+    animate. The full frame rate returns as soon as the stage moves again.
+    """
+
+    def __init__(self, snapshot, render, width=480, height=360, fps=30, queue_size=2,
+                 executor=None, pipeline_depth=2, pixel_format="bgr24", adaptive=False,
+                 stage=None, idle_fps=0, idle_after=2.0):
+        self.snapshot = snapshot
+        self.render = render
+        self.pixel_format = pixel_format
+        self.queue_size = queue_size
+        self.executor = executor
+        self.pipeline_depth = pipeline_depth
+        self.quality = AdaptiveQuality(width, height, fps)
+        self.adaptive = adaptive
+        self.scheduler = FrameScheduler(fps)
+        self.subscribers = set()
+        self.stage = stage
+        self.idle_fps = idle_fps
+        self.idle_after = idle_after
+        self.idle = False
+        self.latest_frame = None
+        self.latest_count = None
+        self._still = None  # Render of a still frame while no peer streams
+        self._render_estimate = 0.0  # Moving average of the render time in seconds
+        self._task = None
+
+    @property
+    def count(self):
+        """Number of the next frame slot"""
+        return self.scheduler.count
+
+    @property
+    def width(self):
+        return self.quality.current[0]
+
+    @property
+    def height(self):
+        return self.quality.current[1]
+
+    @property
+    def fps(self):
+        return self.quality.current[2]
+
+    @property
+    def running(self):
+        return self._task is not None and not self._task.done()
+
+    def configure(self, width=None, height=None, fps=None, adaptive=None):
+        """Change the stream resolution, frame rate or adaptive mode; takes effect with the next frame"""
+        best_width, best_height, best_fps = self.quality.levels[0]
+        self.quality.configure(width or best_width, height or best_height, fps or best_fps)
+        if adaptive is not None:
+            self.adaptive = adaptive
+        print(f"FrameProducer: configured {self.width}x{self.height} at {self.fps} fps (adaptive: {self.adaptive})")
+
+    def warm_up(self, workers):
+        """
+        Render one frame on each of the `workers` workers of the render pool
+        and wait for them. Process pools spawn their workers (and import the
+        renderer there) on first use, which would make the first frames miss
+        their deadlines and the adaptive controller step down right away.
+        """
+        if self.executor is None:
+            return
+        start = time.perf_counter()
+        args = (self.snapshot(0), 0, self.width, self.height, self.fps, self.pixel_format, 0.0)
+        futures = [self.executor.submit(timed_render, self.render, *args) for _ in range(workers)]
+        for future in futures:
+            future.result()
+        print(f"FrameProducer: render pool warmed up in {time.perf_counter() - start:.2f}s")
+
+    def subscribe(self):
+        """Register a new consumer and return its Subscription"""
+        subscription = Subscription(self.queue_size)
+        self.subscribers.add(subscription)
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run())
+        print(f"FrameProducer: subscriber added ({len(self.subscribers)} active)")
+        return subscription
+
+    def unsubscribe(self, subscription):
+        """Remove a consumer; production stops once the last one leaves"""
+        if subscription in self.subscribers:
+            self.subscribers.discard(subscription)
+            print(f"FrameProducer: subscriber removed ({len(self.subscribers)} active)")
+
+    async def capture(self):
+        """
+        Return (count, VideoFrame) of the most recently published frame.
+
+        While no peer is streaming, the current stage state is rendered as a
+        still instead; concurrent callers share that render.
+        """
+        if self.running and self.latest_frame is not None:
+            return self.latest_count, self.latest_frame
+        if self._still is None:
+            self._still = asyncio.ensure_future(self._render_still())
+            self._still.add_done_callback(self._still_done)
+        return await asyncio.shield(self._still)
+
+    def _still_done(self, future):
+        self._still = None
+
+    async def _render_still(self):
+        count = self.count
+        img, render_time = await self._render(count, self.scheduler.media_time(count))
+        RENDER_SECONDS.observe(render_time)
+        return count, self._to_video_frame(img, self.scheduler.pts(count))
+
+    def stats(self):
+        """Pacing counters of the producer and of every subscriber"""
+        return {
+            "producer": self.scheduler.stats.as_dict(),
+            "idle": self.idle,
+            "subscribers": [subscription.as_dict() for subscription in list(self.subscribers)],
+        }
+
+    def _publish(self, item):
+        """Queue (img, pts, deadline_ns), or an Exception, for every subscriber"""
+        # Pyramid levels of the image, downscaled when a subscriber first asks for them
+        pyramid = None if isinstance(item, Exception) else [item[0]]
+        for subscription in self.subscribers:
+            queue = subscription.queue
+            if queue.full():
+                # Drop the oldest frame so slow consumers always get the newest one
+                queue.get_nowait()
+                subscription.dropped += 1
+            if pyramid is None:
+                queue.put_nowait(item)
+            else:
+                img = self._pyramid_level(pyramid, subscription.level)
+                queue.put_nowait((self._to_video_frame(img, item[1]), item[2]))
+
+    def _pyramid_level(self, pyramid, level):
+        level = max(0, min(level, PYRAMID_LEVELS - 1))
+        while len(pyramid) <= level:
+            above = VideoFrame.from_numpy_buffer(pyramid[-1], format=self.pixel_format)
+            start = time.perf_counter()
+            below = above.reformat(width=even(above.width / 2), height=even(above.height / 2), interpolation="AREA")
+            pyramid.append(below.to_ndarray())
+            DOWNSCALE_SECONDS.observe(time.perf_counter() - start)
+        PYRAMID_FRAMES.labels(level=str(level)).inc()
+        return pyramid[level]
+
+    def _to_video_frame(self, img, pts):
+        """A VideoFrame over the pixels of `img`, which must not change afterwards"""
+        start = time.perf_counter()
+        frame = VideoFrame.from_numpy_buffer(img, format=self.pixel_format)
+        frame.pts = pts
+        frame.time_base = VIDEO_TIME_BASE
+        VIDEO_FRAME_SECONDS.observe(time.perf_counter() - start)
+        return frame
+
+    async def _render(self, count, t):
+        state = self.snapshot(count)
+        args = (state, count, self.width, self.height, self.fps, self.pixel_format, t)
+        if self.executor is None:
+            return timed_render(self.render, *args)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, timed_render, self.render, *args)
+
+    def _stage_at_rest(self):
+        """Whether idling is on and the stage has been at rest for `idle_after` seconds"""
+        if self.stage is None or not self.idle_fps:
+            return False
+        snapshot = self.stage.snapshot
+        return not snapshot.moving and time.monotonic() - snapshot.time >= self.idle_after
+
+    def _set_idle(self, idle, pending):
+        self.idle = idle
+        if idle:
+            print(f"FrameProducer: stage at rest, idling at {min(self.idle_fps, self.fps)} fps")
+        else:
+            # The next frame is due now, not at the end of the idle interval
+            self.scheduler.resume()
+            print(f"FrameProducer: stage moving, back to {self.fps} fps")
+        # Frames rendered ahead at the old rate are stale now
+        for future in pending:
+            future.cancel()
+        pending.clear()
+
+    async def _wait_or_motion(self, lead_ns):
+        """scheduler.wait(lead_ns), or None as soon as the stage starts moving"""
+        wait = asyncio.ensure_future(self.scheduler.wait(lead_ns))
+        motion = asyncio.ensure_future(self.stage.wait_for_motion())
+        try:
+            done, _ = await asyncio.wait((wait, motion), return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            wait.cancel()
+            motion.cancel()
+        return wait.result() if wait in done else None
+
+    async def _run(self):
+        scheduler = self.scheduler
+        scheduler.restart()
+        # Frames being rendered ahead, oldest first
+        pending = collections.deque()
+        last_publish_ns = None
+        try:
+            while self.subscribers:
+                idle = self._stage_at_rest()
+                if idle != self.idle:
+                    self._set_idle(idle, pending)
+                scheduler.set_fps(min(self.idle_fps, self.fps) if self.idle else self.fps)
+
+                # Keep the render pipeline full
+                if self.executor is not None:
+                    while len(pending) < max(1, self.pipeline_depth):
+                        next_count = scheduler.count + len(pending)
+                        pending.append(asyncio.ensure_future(
+                            self._render(next_count, scheduler.media_time(next_count))
+                        ))
+
+                # Inline renders start early by the typical render time, so the
+                # frame is ready when it is due
+                lead_ns = 0 if pending else int(self._render_estimate * 1e9)
+                if self.idle:
+                    skipped = await self._wait_or_motion(lead_ns)
+                    if skipped is None:
+                        # The stage started moving, go back to the full rate right away
+                        continue
+                else:
+                    skipped = await scheduler.wait(lead_ns)
+                if not self.subscribers:
+                    break
+
+                if pending:
+                    img, render_time = await pending.popleft()
+                else:
+                    img, render_time = await self._render(scheduler.count, scheduler.media_time())
+                    self._render_estimate += (render_time - self._render_estimate) / 8
+                RENDER_SECONDS.observe(render_time)
+                await scheduler.wait_deadline()
+                self.latest_frame = self._to_video_frame(img, scheduler.pts())
+                self.latest_count = scheduler.count
+                self._publish((img, scheduler.pts(), scheduler.deadline_ns()))
+                now_ns = time.monotonic_ns()
+                if last_publish_ns is not None:
+                    FRAME_INTERVAL_SECONDS.observe((now_ns - last_publish_ns) / 1e9)
+                last_publish_ns = now_ns
+                scheduler.frame_done()
+
+                # Renders in a pool overlap, so only their share of the frame interval counts
+                parallel_renders = max(1, self.pipeline_depth) if self.executor is not None else 1
+                if self.adaptive and self.quality.record(render_time / parallel_renders, skipped):
+                    # Frames rendered ahead at the old quality are stale now
+                    for future in pending:
+                        future.cancel()
+                    pending.clear()
+
+                # Give the consumers a chance to run between frames
+                await asyncio.sleep(0)
+        except Exception as e:
+            print(f"FrameProducer: Error producing frame: {e}")
+            # Wake up the consumers so they can stop instead of waiting forever
+            self._publish(e)
+            raise
+        finally:
+            for future in pending:
+                future.cancel()
+            self.idle = False
@@ -0,0 +1,191 @@
+"""
+Recording of the produced stream to rotating video files on an encoder thread.
+"""
+import asyncio
+import fractions
+import os
+import queue
+import threading
+import time
+
+import av
+
+from metrics import RECORDING_FRAMES
+from scheduler import VIDEO_CLOCK_RATE
+
+RECORDING_CONTAINERS = {"mp4": "mp4", "mkv": "matroska"}
+RECORDING_TIME_BASE = fractions.Fraction(1, VIDEO_CLOCK_RATE)
+
+
+def stream_pts(frame):
+    """
+    The pts of `frame` on the 90 kHz video clock. Encoders rebase the frames
+    they are handed (aiortc's VP8 encoder to 1/1000000, H.264 to 1/30), so
+    this goes by the frame's time_base instead of assuming the producer's.
+    """
+    return round(frame.pts * frame.time_base * VIDEO_CLOCK_RATE)
+
+
+class StreamRecorder:
+    """
+    Tees the frames of a FrameProducer into MP4 or MKV segments on disk.
+
+    The recorder subscribes to the producer like a peer, and a small task
+    moves each frame into a bounded queue without waiting. A dedicated
+    thread encodes the queue with PyAV and starts a new file every
+    `segment_seconds` of stream time. When the encoder or the disk falls
+    behind, frames that don't fit into the queue are dropped and counted,
+    so recording never holds back the live stream. Frames whose timestamp
+    doesn't follow the previous one are dropped and counted as well.
+    """
+
+    def __init__(self, producer, directory="recordings", codec="libx264", queue_size=60):
+        self.producer = producer
+        self.directory = directory
+        self.codec = codec
+        self.queue_size = queue_size
+        self.recording = None
+        self._pump_task = None
+        self._thread = None
+
+    @property
+    def active(self):
+        return self.recording is not None and not self.recording["stopping"].is_set()
+
+    def start(self, container="mp4", segment_seconds=300):
+        """Start recording into new segment files; returns the recording info"""
+        if self.active:
+            raise RuntimeError("Already recording")
+        if container not in RECORDING_CONTAINERS:
+            raise ValueError(f"Unknown container {container!r}, use one of {', '.join(RECORDING_CONTAINERS)}")
+        if segment_seconds <= 0:
+            raise ValueError("segment_seconds must be positive")
+        os.makedirs(self.directory, exist_ok=True)
+        width, height = self.producer.quality.levels[0][:2]
+        now = time.time()
+        self.recording = {
+            "name": f"recording-{time.strftime('%Y%m%d-%H%M%S', time.localtime(now))}-{int(now * 1000) % 1000:03d}",
+            "container": container,
+            "segment_seconds": segment_seconds,
+            "width": width,
+            "height": height,
+            "queue": queue.Queue(maxsize=self.queue_size),
+            "stopping": threading.Event(),
+            "segments": [],
+            "written": 0,
+            "dropped": 0,
+            "error": None,
+        }
+        self._thread = threading.Thread(target=self._encode, args=(self.recording,), name="recorder", daemon=True)
+        self._thread.start()
+        self._pump_task = asyncio.ensure_future(self._pump(self.recording, self.producer.subscribe()))
+        print(f"StreamRecorder: recording {width}x{height} {container} segments of {segment_seconds}s to {self.directory}")
+        return self.info()
+
+    async def stop(self):
+        """Stop recording, wait for the queued frames to be written and return the recording info"""
+        recording = self.recording
+        if recording is None:
+            raise RuntimeError("Not recording")
+        recording["stopping"].set()
+        if self._pump_task is not None:
+            self._pump_task.cancel()
+            self._pump_task = None
+        await asyncio.get_running_loop().run_in_executor(None, self._thread.join)
+        info = self.info()
+        self.recording = None
+        print(f"StreamRecorder: stopped, {info['written']} frames written, {info['dropped']} dropped")
+        return info
+
+    def info(self):
+        recording = self.recording
+        if recording is None:
+            return {"recording": False}
+        return {
+            "recording": not recording["stopping"].is_set(),
+            "container": recording["container"],
+            "width": recording["width"],
+            "height": recording["height"],
+            "segments": list(recording["segments"]),
+            "written": recording["written"],
+            "dropped": recording["dropped"],
+            "queued": recording["queue"].qsize(),
+            "error": recording["error"],
+        }
+
+    async def _pump(self, recording, subscription):
+        """Move produced frames into the encoder queue, dropping what doesn't fit"""
+        try:
+            while not recording["stopping"].is_set():
+                item = await subscription.queue.get()
+                if isinstance(item, Exception):
+                    break
+                try:
+                    recording["queue"].put_nowait((item[0], stream_pts(item[0])))
+                except queue.Full:
+                    recording["dropped"] += 1
+                    RECORDING_FRAMES.labels(outcome="dropped").inc()
+        finally:
+            self.producer.unsubscribe(subscription)
+
+    def _encode(self, recording):
+        """Encoder thread: write queued frames into rotating segment files"""
+        frames = recording["queue"]
+        segment_pts = int(recording["segment_seconds"] * VIDEO_CLOCK_RATE)
+        output = stream = None
+        start_pts = last_pts = None
+        try:
+            while True:
+                try:
+                    frame, pts = frames.get(timeout=0.1)
+                except queue.Empty:
+                    if recording["stopping"].is_set():
+                        break
+                    continue
+                if last_pts is not None and pts <= last_pts:
+                    recording["dropped"] += 1
+                    RECORDING_FRAMES.labels(outcome="dropped").inc()
+                    continue
+                last_pts = pts
+                if output is None or pts - start_pts >= segment_pts:
+                    if output is not None:
+                        self._close_segment(output, stream)
+                    output, stream = self._open_segment(recording)
+                    start_pts = pts
+                # The recorder's subscription has its own VideoFrame, so it can
+                # be restamped; reformat returns it as is if it already fits
+                frame = frame.reformat(width=recording["width"], height=recording["height"], format="yuv420p")
+                frame.pts = pts - start_pts
+                frame.time_base = RECORDING_TIME_BASE
+                for packet in stream.encode(frame):
+                    output.mux(packet)
+                recording["written"] += 1
+                RECORDING_FRAMES.labels(outcome="written").inc()
+        except Exception as e:
+            recording["error"] = f"{type(e).__name__}: {e}"
+            print(f"StreamRecorder: encoder failed: {e}")
+        finally:
+            recording["stopping"].set()
+            if output is not None:
+                self._close_segment(output, stream)
+
+    def _open_segment(self, recording):
+        index = len(recording["segments"])
+        path = os.path.join(self.directory, f"{recording['name']}-{index:03d}.{recording['container']}")
+        output = av.open(path, "w", format=RECORDING_CONTAINERS[recording["container"]])
+        stream = output.add_stream(self.codec, rate=self.producer.quality.levels[0][2])
+        stream.width, stream.height, stream.pix_fmt = recording["width"], recording["height"], "yuv420p"
+        stream.time_base = RECORDING_TIME_BASE
+        stream.codec_context.time_base = RECORDING_TIME_BASE
+        if self.codec == "libx264":
+            stream.options = {"preset": "veryfast"}
+        recording["segments"].append(path)
+        print(f"StreamRecorder: writing {path}")
+        return output, stream
+
+    def _close_segment(self, output, stream):
+        try:
+            for packet in stream.encode(None):
+                output.mux(packet)
+        finally:
+            output.close()
@@ -0,0 +1,514 @@
+"""
+Rendering helpers for the simulated microscope view.
+"""
+import threading
+import time
+
+import numpy as np
+
+# Slight blue tint applied to the (B, G, R) channels of the background
+BACKGROUND_TINT = [0.85, 0.92, 1.0]
+GRID_SPACING = 50
+GRID_COLOR = [60, 60, 60]  # Darker grid lines
+CROSSHAIR_SIZE = 15
+CROSSHAIR_COLOR = [255, 255, 255]
+
+# Field of view in stage units; other resolutions show the same field of view
+# scaled by view_scale()
+REFERENCE_WIDTH, REFERENCE_HEIGHT = 480, 360
+
+# BT.601 limited range (the libav default for bgr24 -> yuv420p) as a linear
+# map from (B, G, R) to (Y, U, V) plus offsets added after compositing
+BGR_TO_YUV = np.array([
+    [24.966, 128.553, 65.481],
+    [112.0, -74.203, -37.797],
+    [-18.214, -93.786, 112.0],
+], dtype=np.float32) / 255
+YUV_OFFSET = [16, 128, 128]
+
+
+def bgr_to_yuv(color):
+    """Convert a (B, G, R) color to offset-free (Y, U, V) components"""
+    return BGR_TO_YUV @ np.asarray(color, dtype=np.float32)
+
+
+def view_scale(width, height):
+    """Output pixels per stage unit for a resolution"""
+    return min(width / REFERENCE_WIDTH, height / REFERENCE_HEIGHT)
+
+
+def downsample_2x2(plane):
+    """Average each 2x2 block of a plane (leading two axes)"""
+    return 0.25 * (plane[0::2, 0::2] + plane[1::2, 0::2] + plane[0::2, 1::2] + plane[1::2, 1::2])
+
+
+def lap(timings, stage, start):
+    """Add the time since `start` to timings[stage] (if timings is given) and return the current time"""
+    now = time.perf_counter()
+    if timings is not None:
+        timings[stage] = timings.get(stage, 0.0) + now - start
+    return now
+
+
+def hud_slice(start, stop, scale, offset=0):
+    """Pixel slice of a HUD element laid out for the reference resolution"""
+    return slice(offset + int(round(start * scale)), offset + int(round(stop * scale)))
+
+
+class BackgroundLayers:
+    """
+    Time-invariant layers of the microscope view for one resolution.
+
+    The vignette, coordinate grids, measurement grid, crosshair and HUD
+    background never change between frames, so they are computed once here
+    and only composited with the time-varying terms in each frame.
+    """
+
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        self.scale = view_scale(width, height)
+        self.center_x, self.center_y = width // 2, height // 2
+
+        # Distance from center for vignette effect
+        y_grad, x_grad = np.ogrid[:height, :width]
+        distance = np.sqrt((x_grad - self.center_x)**2 + (y_grad - self.center_y)**2)
+        max_distance = np.sqrt(self.center_x**2 + self.center_y**2)
+        vignette = 1 - (distance / max_distance) * 0.3
+
+        # Vignette pre-multiplied with the channel tint, shape (height, width, 3)
+        self.tinted_vignette = (
+            vignette[:, :, None] * np.array(BACKGROUND_TINT)
+        ).astype(np.float32)
+
+        # The pattern noise is separable, so 1D coordinate vectors are enough
+        self.x_phase = (np.arange(width) * 0.1 / self.scale).astype(np.float32)
+        self.y_phase = (np.arange(height) * 0.1 / self.scale).astype(np.float32)
+
+        # Static overlay drawn on top of the specimen objects
+        self.overlay = np.zeros((height, width, 3), dtype=np.float32)
+        self.overlay_mask = np.zeros((height, width, 1), dtype=bool)
+        self._build_overlay()
+
+    def _paint(self, rows, cols, color):
+        self.overlay[rows, cols] = color
+        self.overlay_mask[rows, cols] = True
+
+    def _build_overlay(self):
+        width, height = self.width, self.height
+        center_x, center_y = self.center_x, self.center_y
+        scale = self.scale
+        crosshair_size = int(round(CROSSHAIR_SIZE * scale))
+        line_width = max(1, int(round(scale)))
+
+        # Microscope crosshair at center
+        if 0 <= center_y < height:
+            self._paint(center_y, slice(max(0, center_x - crosshair_size), min(width, center_x + crosshair_size)), CROSSHAIR_COLOR)
+        if 0 <= center_x < width:
+            self._paint(slice(max(0, center_y - crosshair_size), min(height, center_y + crosshair_size)), center_x, CROSSHAIR_COLOR)
+
+        # Measurement grid, major lines only
+        grid_step = GRID_SPACING * 2 * scale
+        for i in range(int(np.ceil(width / grid_step))):
+            x = int(round(i * grid_step))
+            self._paint(slice(None), slice(x, min(x + line_width, width)), GRID_COLOR)
+        for i in range(int(np.ceil(height / grid_step))):
+            y = int(round(i * grid_step))
+            self._paint(slice(y, min(y + line_width, height)), slice(None), GRID_COLOR)
+
+        # Black background of the position indicator
+        self._paint(hud_slice(10, 35, scale), hud_slice(10, 200, scale), [0, 0, 0])
+
+    def render_background(self, t, out=None):
+        """Render the lit, textured background at time t into a float32 image"""
+        if out is None:
+            out = np.empty((self.height, self.width, 3), dtype=np.float32)
+        base_intensity = 45 + 15 * np.sin(t * 0.5)
+        # Deterministic pattern noise: 3 * sin(x * 0.1 + t * 0.5) * cos(y * 0.1 + t * 0.3)
+        pattern = np.multiply.outer(
+            np.cos(self.y_phase + np.float32(t * 0.3)),
+            3 * np.sin(self.x_phase + np.float32(t * 0.5)),
+        )
+        pattern += np.float32(base_intensity)
+        np.multiply(pattern[:, :, None], self.tinted_vignette, out=out)
+        return out
+
+    def apply_overlay(self, img):
+        """Draw the crosshair, grid and HUD background onto img in place"""
+        np.copyto(img, self.overlay, where=self.overlay_mask)
+        return img
+
+
+_layer_cache = {}
+
+
+def get_background_layers(width, height):
+    """Return the cached BackgroundLayers for a resolution, building it on first use"""
+    layers = _layer_cache.get((width, height))
+    if layers is None:
+        layers = _layer_cache[(width, height)] = BackgroundLayers(width, height)
+    return layers
+
+
+def chroma_coverage(start, stop):
+    """Fraction of each half resolution sample covered by the full resolution range [start, stop)"""
+    first = np.arange(start // 2, (stop + 1) // 2) * 2
+    return np.clip(np.minimum(first + 2, stop) - np.maximum(first, start), 0, 2) / 2
+
+
+class YUVLayers:
+    """
+    Time-invariant layers of the microscope view for compositing in yuv420p.
+
+    Compositing is linear, so the scene is built directly in offset-free
+    Y/U/V planes: luma at full resolution and both chroma planes at half
+    resolution, with the BT.601 offsets added when quantizing.
+    """
+
+    def __init__(self, layers):
+        self.width, self.height = layers.width, layers.height
+        self.chroma_width, self.chroma_height = layers.width // 2, layers.height // 2
+
+        tint = bgr_to_yuv(BACKGROUND_TINT)
+        # The tinted vignette is linear in the tint, so any channel carries the vignette
+        vignette = layers.tinted_vignette[:, :, 2]
+        self.luma_vignette = (vignette * tint[0]).astype(np.float32)
+        self.chroma_vignette = (downsample_2x2(vignette)[:, :, None] * tint[1:]).astype(np.float32)
+
+        # Pattern noise phases, chroma samples sit between two luma samples
+        self.x_phase, self.y_phase = layers.x_phase, layers.y_phase
+        self.chroma_x_phase = ((np.arange(self.chroma_width) * 2 + 0.5) * 0.1 / layers.scale).astype(np.float32)
+        self.chroma_y_phase = ((np.arange(self.chroma_height) * 2 + 0.5) * 0.1 / layers.scale).astype(np.float32)
+
+        # Luma overlay is copied where the mask is set
+        overlay = np.einsum("ij,hwj->hwi", BGR_TO_YUV, layers.overlay)
+        self.luma_overlay = np.ascontiguousarray(overlay[:, :, 0])
+        self.luma_mask = layers.overlay_mask[:, :, 0]
+
+        # Chroma overlay is blended by the fraction of each 2x2 block it covers
+        mask = layers.overlay_mask.astype(np.float32)
+        coverage = downsample_2x2(mask)[:, :, 0]
+        self.chroma_overlay_index = np.nonzero(coverage)
+        self.chroma_overlay_keep = (1 - coverage[self.chroma_overlay_index])[:, None]
+        self.chroma_overlay = downsample_2x2(overlay[:, :, 1:] * mask)[self.chroma_overlay_index]
+
+    def render_background(self, t, luma, chroma):
+        """Render the lit, textured background at time t into the float planes"""
+        base_intensity = np.float32(45 + 15 * np.sin(t * 0.5))
+        x_offset, y_offset = np.float32(t * 0.5), np.float32(t * 0.3)
+        pattern = np.multiply.outer(np.cos(self.y_phase + y_offset), 3 * np.sin(self.x_phase + x_offset))
+        pattern += base_intensity
+        np.multiply(pattern, self.luma_vignette, out=luma)
+        pattern = np.multiply.outer(np.cos(self.chroma_y_phase + y_offset), 3 * np.sin(self.chroma_x_phase + x_offset))
+        pattern += base_intensity
+        np.multiply(pattern[:, :, None], self.chroma_vignette, out=chroma)
+
+    def apply_overlay(self, luma, chroma):
+        """Draw the crosshair, grid and HUD background onto the planes in place"""
+        np.copyto(luma, self.luma_overlay, where=self.luma_mask)
+        index = self.chroma_overlay_index
+        chroma[index] = chroma[index] * self.chroma_overlay_keep + self.chroma_overlay
+
+
+_yuv_layer_cache = {}
+
+
+def get_yuv_layers(width, height):
+    """Return the cached YUVLayers for a resolution, building it on first use"""
+    layers = _yuv_layer_cache.get((width, height))
+    if layers is None:
+        layers = _yuv_layer_cache[(width, height)] = YUVLayers(get_background_layers(width, height))
+    return layers
+
+# Glow rings drawn around each specimen object, and samples per pixel in the
+# radial profile lookup tables
+GLOW_RINGS = 8
+GLOW_ALPHA = 0.4
+PROFILE_SAMPLES = 16
+
+
+class SpriteProfile:
+    """
+    Radial glow+disk profile of a specimen object of one integer size.
+
+    Drawing the glow rings and the main disk as successive alpha blends
+    reduces, for a pixel at distance d from the center, to
+    ``img * keep(d) + color * coverage(d)``. Both terms are tabulated here so
+    a sprite only touches the pixels inside its bounding box.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        # Outermost ring has a one pixel anti-aliased edge
+        self.radius = size + GLOW_RINGS + 1
+        distance = np.arange(0, (self.radius + 2) * PROFILE_SAMPLES) / PROFILE_SAMPLES
+        keep = np.ones_like(distance)
+        coverage = np.zeros_like(distance)
+        rings = [
+            (glow_size, GLOW_ALPHA * (1 - (glow_size - size) / GLOW_RINGS) ** 2)
+            for glow_size in range(size + GLOW_RINGS, size - 1, -1)
+        ]
+        rings.append((size, 1.0))  # Main object
+        for ring_radius, alpha in rings:
+            mask = np.clip(ring_radius + 1 - distance, 0, 1)
+            keep *= 1 - mask
+            coverage = coverage * (1 - mask) + alpha * mask
+        self.keep = keep.astype(np.float32)
+        self.keep_step = np.diff(keep, append=keep[-1]).astype(np.float32)
+        self.coverage = coverage.astype(np.float32)
+        self.coverage_step = np.diff(coverage, append=coverage[-1]).astype(np.float32)
+        self.max_index = len(distance) - 1
+
+    def _lookup(self, position):
+        """Interpolate keep and coverage at distances given in profile samples"""
+        np.minimum(position, self.max_index, out=position)
+        index = position.astype(np.intp)
+        fraction = position - index
+        keep = self.keep[index] + self.keep_step[index] * fraction
+        coverage = self.coverage[index] + self.coverage_step[index] * fraction
+        return keep, coverage
+
+    def draw(self, img, center_x, center_y, color, scale=1):
+        """
+        Blend the sprite into img at a subpixel position, in place.
+
+        `scale` is the size of an img pixel in sprite pixels, e.g. 2 for a
+        half resolution chroma plane. When an img pixel covers several sprite
+        pixels the profile is averaged over them.
+        """
+        height, width = img.shape[:2]
+        radius = self.radius / scale
+        x0 = max(0, int(np.floor(center_x - radius)))
+        x1 = min(width, int(np.ceil(center_x + radius)) + 1)
+        y0 = max(0, int(np.floor(center_y - radius)))
+        y1 = min(height, int(np.ceil(center_y + radius)) + 1)
+        if x0 >= x1 or y0 >= y1:
+            return
+
+        # Offsets of the sprite samples inside one img pixel, in sprite pixels
+        samples = max(1, int(round(scale)))
+        offsets = ((np.arange(samples, dtype=np.float32) + 0.5) / samples - 0.5) * scale
+        dx = (np.arange(x0, x1, dtype=np.float32) - np.float32(center_x)) * scale
+        dy = (np.arange(y0, y1, dtype=np.float32) - np.float32(center_y)) * scale
+        keep = coverage = 0
+        for offset_y in offsets:
+            for offset_x in offsets:
+                position = np.sqrt((dy[:, None] + offset_y)**2 + (dx[None, :] + offset_x)**2)
+                position *= PROFILE_SAMPLES
+                sample_keep, sample_coverage = self._lookup(position)
+                keep = keep + sample_keep
+                coverage = coverage + sample_coverage
+        if samples > 1:
+            keep /= samples * samples
+            coverage /= samples * samples
+
+        box = img[y0:y1, x0:x1]
+        box *= keep[:, :, None]
+        box += coverage[:, :, None] * np.asarray(color, dtype=np.float32)
+
+
+_profile_cache = {}
+
+
+def draw_specimen(img, center_x, center_y, size, color, scale=1):
+    """Draw a glowing specimen object of an integer size at a subpixel position"""
+    profile = _profile_cache.get(size)
+    if profile is None:
+        profile = _profile_cache[size] = SpriteProfile(size)
+    profile.draw(img, center_x, center_y, color, scale)
+
+
+class MicroscopeRenderer:
+    """
+    Renders the simulated microscope view from the stage state.
+
+    The view always shows the same field of view in stage units, resolutions
+    other than 480x360 only change the number of pixels per stage unit. One
+    renderer owns its float frame buffers, so it should only be used by a
+    single thread at a time.
+    """
+
+    def __init__(self, width=480, height=360, fps=30):
+        self.width = width
+        self.height = height
+        self.fps = fps
+        self.layers = get_background_layers(width, height)
+        self.scale = self.layers.scale
+        self.frame_buffer = np.empty((height, width, 3), dtype=np.float32)
+        self.yuv_layers = None
+
+    def _visible_objects(self, state, t):
+        """Yield (x, y, size, color) of the objects visible in the current view"""
+        width, height = self.width, self.height
+        scale = self.scale
+        # Calculate view offset based on microscope position
+        view_offset_x = int(state["x"] * scale - self.layers.center_x)
+        view_offset_y = int(state["y"] * scale - self.layers.center_y)
+
+        for obj in state["objects"]:
+            # Calculate object position relative to current view
+            obj_x = obj["x"] * scale - view_offset_x
+            obj_y = obj["y"] * scale - view_offset_y
+
+            # Add smoother floating motion with reduced temporal variation
+            float_x = obj_x + 3 * scale * np.sin(t * 1.5 + obj["x"] * 0.01)
+            float_y = obj_y + 2 * scale * np.cos(t * 1.2 + obj["y"] * 0.01)
+
+            # Only draw if object is visible in current view
+            margin = obj["size"] * scale
+            if -margin <= float_x <= width + margin and -margin <= float_y <= height + margin:
+                # Add smoother pulsing effect
+                pulse = 1 + 0.15 * np.sin(t * 2 + obj["x"] * 0.02)
+                yield float_x, float_y, int(obj["size"] * pulse), obj["color"]
+
+    def _hud_bars(self, state, count):
+        """Return the (y0, y1, x0, x1, color) rectangles of the position and frame indicators"""
+        width, height = self.width, self.height
+        scale = self.scale
+        bars = []
+        # Add coordinate display as colored bars with better precision
+        x_bar_length = int((state["x"] / state.get("stage_width", 480)) * 180)
+        y_bar_length = int((state["y"] / state.get("stage_height", 360)) * 180)
+        if x_bar_length > 0:
+            rows, cols = hud_slice(15, 20, scale), hud_slice(15, 15 + x_bar_length, scale)
+            bars.append((rows.start, rows.stop, cols.start, cols.stop, [255, 100, 100]))  # Red for X
+        if y_bar_length > 0:
+            rows, cols = hud_slice(25, 30, scale), hud_slice(15, 15 + y_bar_length, scale)
+            bars.append((rows.start, rows.stop, cols.start, cols.stop, [100, 255, 100]))  # Green for Y
+
+        # Add frame counter with solid colors
+        frame_indicator = count % 60
+        indicator_width = int((frame_indicator / 60) * 100)
+        rows = hud_slice(-15, -10, scale, offset=height)
+        cols = hud_slice(-110, -110 + indicator_width, scale, offset=width)
+        bars.append((rows.start, rows.stop, cols.start, cols.stop, [100, 100, 255]))
+        return bars
+
+    def render(self, state, count, t=None, timings=None, overlay=True):
+        """
+        Render frame number `count` for the given stage state as a uint8 BGR image.
+
+        `t` is the animation time in seconds, by default count / fps. If a
+        `timings` dict is given, the seconds spent in each rendering stage
+        are added to it. Without `overlay` the crosshair, grid and HUD are
+        left out, e.g. for scan tiles.
+        """
+        if t is None:
+            t = count / self.fps
+        start = time.perf_counter()
+
+        # Lit background with deterministic pattern noise for better compression
+        img = self.layers.render_background(t, out=self.frame_buffer)
+        start = lap(timings, "background", start)
+
+        # Draw object with smoother glow effect (quadratic falloff), only
+        # touching the pixels inside its bounding box
+        for float_x, float_y, size, color in self._visible_objects(state, t):
+            draw_specimen(img, float_x, float_y, size, color, scale=1 / self.scale)
+        start = lap(timings, "objects", start)
+
+        # Draw microscope crosshair, measurement grid and position indicator background
+        if overlay:
+            self.layers.apply_overlay(img)
+            for y0, y1, x0, x1, color in self._hud_bars(state, count):
+                img[y0:y1, x0:x1] = color
+        start = lap(timings, "grid_hud", start)
+
+        # Convert to uint8 with proper clipping for better quality
+        out = np.clip(img, 0, 255).astype(np.uint8)
+        lap(timings, "convert", start)
+        return out
+
+    def render_yuv(self, state, count, t=None, timings=None, overlay=True):
+        """
+        Render frame number `count` directly as a packed yuv420p image.
+
+        Returns a uint8 array of shape (height * 3 // 2, width) with the Y, U
+        and V planes back to back, the layout VideoFrame.from_ndarray expects
+        for yuv420p. This skips the float BGR image and the bgr24 -> yuv420p
+        conversion before encoding. Width and height must be even. `timings`
+        and `overlay` work as for `render`.
+        """
+        width, height = self.width, self.height
+        if self.yuv_layers is None:
+            self.yuv_layers = get_yuv_layers(width, height)
+            self.luma_buffer = np.empty((height, width), dtype=np.float32)
+            self.chroma_buffer = np.empty((height // 2, width // 2, 2), dtype=np.float32)
+        layers = self.yuv_layers
+        luma, chroma = self.luma_buffer, self.chroma_buffer
+        if t is None:
+            t = count / self.fps
+        start = time.perf_counter()
+
+        layers.render_background(t, luma, chroma)
+        start = lap(timings, "background", start)
+
+        # Chroma sample (i, j) sits at luma position (2 * i + 0.5, 2 * j + 0.5)
+        luma_view = luma[:, :, None]
+        for float_x, float_y, size, color in self._visible_objects(state, t):
+            yuv = bgr_to_yuv(color)
+            draw_specimen(luma_view, float_x, float_y, size, yuv[:1], scale=1 / self.scale)
+            draw_specimen(chroma, (float_x - 0.5) / 2, (float_y - 0.5) / 2, size, yuv[1:], scale=2 / self.scale)
+        start = lap(timings, "objects", start)
+
+        if overlay:
+            layers.apply_overlay(luma, chroma)
+            bars = self._hud_bars(state, count)
+        else:
+            bars = []
+        for y0, y1, x0, x1, color in bars:
+            yuv = bgr_to_yuv(color)
+            luma[y0:y1, x0:x1] = yuv[0]
+            # Blend partially covered chroma samples at odd rectangle edges
+            coverage = np.multiply.outer(chroma_coverage(y0, y1), chroma_coverage(x0, x1))
+            coverage = coverage[:, :, None].astype(np.float32)
+            box = chroma[y0 // 2:(y1 + 1) // 2, x0 // 2:(x1 + 1) // 2]
+            box *= 1 - coverage
+            box += coverage * yuv[1:]
+        start = lap(timings, "grid_hud", start)
+
+        # Quantize with the BT.601 offsets into one packed buffer
+        out = np.empty((height * 3 // 2, width), dtype=np.uint8)
+        chroma_size = (height // 2) * (width // 2)
+        luma += YUV_OFFSET[0]
+        np.clip(luma, 0, 255, out=luma)
+        out[:height] = luma
+        chroma += YUV_OFFSET[1]
+        np.clip(chroma, 0, 255, out=chroma)
+        planes = out[height:].reshape(2, chroma_size)
+        planes[0] = chroma[:, :, 0].ravel()
+        planes[1] = chroma[:, :, 1].ravel()
+        lap(timings, "convert", start)
+        return out
+
+
+_thread_local = threading.local()
+
+
+def get_renderer(width=480, height=360):
+    """Return the calling thread's renderer for a resolution"""
+    renderers = getattr(_thread_local, "renderers", None)
+    if renderers is None:
+        renderers = _thread_local.renderers = {}
+    renderer = renderers.get((width, height))
+    if renderer is None:
+        renderer = renderers[(width, height)] = MicroscopeRenderer(width, height)
+    return renderer
+
+
+def render_view(state, count, width=480, height=360, fps=30, pixel_format="bgr24", t=None, timings=None, overlay=True):
+    """
+    Render frame `count` as a uint8 image in `pixel_format` (bgr24 or yuv420p).
+
+    `t` is the animation time in seconds, by default count / fps. Each thread
+    (or worker process) renders into its own buffers, so this can be called
+    concurrently from a render pool. Per-stage render times are added to the
+    `timings` dict if one is given. Without `overlay` the crosshair, grid
+    and HUD are left out.
+    """
+    renderer = get_renderer(width, height)
+    if t is None:
+        t = count / fps
+    if pixel_format == "yuv420p":
+        return renderer.render_yuv(state, count, t, timings, overlay)
+    return renderer.render(state, count, t, timings, overlay)
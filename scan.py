@@ -0,0 +1,146 @@
+"""
+Tiled scan acquisition into a memory-mapped mosaic on disk.
+"""
+import asyncio
+import math
+import os
+import time
+
+import numpy as np
+
+from render import render_view, view_scale
+
+# Animation time of every tile, so the specimens' float and pulse put them in
+# the same place in overlapping tiles
+SCAN_TIME = 0.0
+
+
+def plan_tiles(region, tile_overlap, fov_width, fov_height, stage_width, stage_height):
+    """
+    Return rows, columns and the (row, col, center_x, center_y) stage
+    positions of the tiles covering `region`.
+
+    `region` is {"x", "y", "width", "height"} in stage units, with (x, y) its
+    top-left corner. Tiles are one field of view (`fov_width` x `fov_height`
+    stage units) in size, spread evenly so neighbours overlap by at least
+    the fraction `tile_overlap`. Rows are scanned in alternating directions
+    so the stage never travels back across the region.
+    """
+    if not 0 <= tile_overlap < 1:
+        raise ValueError("tile_overlap must be in [0, 1)")
+    x, y = float(region["x"]), float(region["y"])
+    width, height = float(region["width"]), float(region["height"])
+    if width <= 0 or height <= 0:
+        raise ValueError("The scan region must have a positive width and height")
+
+    cols = max(1, math.ceil((width - fov_width) / (fov_width * (1 - tile_overlap))) + 1)
+    rows = max(1, math.ceil((height - fov_height) / (fov_height * (1 - tile_overlap))) + 1)
+    # The first and last tiles are flush with the region edges
+    step_x = (width - fov_width) / (cols - 1) if cols > 1 else 0
+    step_y = (height - fov_height) / (rows - 1) if rows > 1 else 0
+
+    tiles = []
+    for row in range(rows):
+        center_y = y + fov_height / 2 + row * step_y
+        order = range(cols) if row % 2 == 0 else reversed(range(cols))
+        for col in order:
+            center_x = x + fov_width / 2 + col * step_x
+            if not (0 <= center_x <= stage_width and 0 <= center_y <= stage_height):
+                raise ValueError(
+                    f"Tile at ({center_x:.0f}, {center_y:.0f}) is outside the stage travel "
+                    f"(0-{stage_width}, 0-{stage_height})"
+                )
+            tiles.append((row, col, center_x, center_y))
+    return rows, cols, tiles
+
+
+def render_tile(state, width, height):
+    """
+    The view of `state` as an rgb24 image at SCAN_TIME, without the
+    crosshair, grid and HUD of the stream, which would repeat in every tile
+    """
+    bgr = render_view(state, 0, width, height, pixel_format="bgr24", t=SCAN_TIME, overlay=False)
+    return bgr[:, :, ::-1]
+
+
+def write_tile(mosaic, pixels, top, left):
+    """Copy the rgb24 `pixels` of a tile into the mosaic, clipped to its bounds"""
+    height, width = mosaic.shape[:2]
+    y0, x0 = max(0, top), max(0, left)
+    y1, x1 = min(height, top + pixels.shape[0]), min(width, left + pixels.shape[1])
+    if y1 > y0 and x1 > x0:
+        mosaic[y0:y1, x0:x1] = pixels[y0 - top:y1 - top, x0 - left:x1 - left]
+
+
+async def scan_region(controller, producer, region, path, tile_overlap=0.1, settle_time=0.0, flush_every=16):
+    """
+    Scan `region` tile by tile and yield progress dicts.
+
+    For every tile the stage is moved with the controller's physics, waits
+    for arrival plus `settle_time` seconds, and the view of the producer's
+    stage state is rendered (see render_tile) at the stream resolution on a
+    worker thread and written into a uint8 (height, width, 3) rgb24
+    mosaic memory-mapped from the .npy file at `path`. Only one tile is held
+    in memory at a time; the mosaic pages are flushed to disk every
+    `flush_every` tiles, so memory use does not grow with the scan size.
+
+    Yields {"type": "start", ...} with the mosaic geometry, then one
+    {"type": "tile", ...} per tile and finally {"type": "done", ...}.
+    """
+    state = controller.state
+    width, height = producer.quality.levels[0][:2]
+    scale = view_scale(width, height)
+    fov_width, fov_height = width / scale, height / scale
+    rows, cols, tiles = plan_tiles(
+        region, tile_overlap, fov_width, fov_height, state["stage_width"], state["stage_height"]
+    )
+    mosaic_width = math.ceil(float(region["width"]) * scale)
+    mosaic_height = math.ceil(float(region["height"]) * scale)
+
+    loop = asyncio.get_running_loop()
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    mosaic = await loop.run_in_executor(
+        None, lambda: np.lib.format.open_memmap(path, mode="w+", dtype=np.uint8, shape=(mosaic_height, mosaic_width, 3))
+    )
+    start = time.monotonic()
+    yield {
+        "type": "start",
+        "path": path,
+        "rows": rows,
+        "cols": cols,
+        "tiles": len(tiles),
+        "width": mosaic_width,
+        "height": mosaic_height,
+        "pixels_per_unit": scale,
+    }
+    try:
+        for index, (row, col, center_x, center_y) in enumerate(tiles):
+            controller.move_to(center_x, center_y)
+            position = await controller.wait_for_arrival()
+            if settle_time > 0:
+                await asyncio.sleep(settle_time)
+            count = producer.count
+            pixels = await loop.run_in_executor(None, render_tile, producer.snapshot(count), width, height)
+
+            # Pixel offset of the tile's top-left corner in the mosaic
+            left = round((position["x"] - fov_width / 2 - float(region["x"])) * scale)
+            top = round((position["y"] - fov_height / 2 - float(region["y"])) * scale)
+            await loop.run_in_executor(None, write_tile, mosaic, pixels, top, left)
+            if (index + 1) % flush_every == 0:
+                await loop.run_in_executor(None, mosaic.flush)
+            yield {
+                "type": "tile",
+                "index": index,
+                "row": row,
+                "col": col,
+                "x": position["x"],
+                "y": position["y"],
+                "pixel_x": left,
+                "pixel_y": top,
+                "frame": count,
+                "progress": (index + 1) / len(tiles),
+            }
+    finally:
+        await loop.run_in_executor(None, mosaic.flush)
+        del mosaic
+    yield {"type": "done", "path": path, "tiles": len(tiles), "elapsed": time.monotonic() - start}
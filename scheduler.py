@@ -0,0 +1,156 @@
+"""
+Frame pacing on the monotonic clock with deadline-miss accounting.
+"""
+import asyncio
+import time
+
+# Frames are stamped on the 90 kHz RTP video clock, so pts stays monotonic
+# when the frame rate changes
+VIDEO_CLOCK_RATE = 90000
+NS_PER_SECOND = 1_000_000_000
+
+
+class DeadlineStats:
+    """
+    Counts how punctually frames meet their deadlines.
+
+    A frame is late when it arrives more than `late_fraction` of a frame
+    interval after its deadline. Jitter is the RFC 3550 interarrival jitter
+    estimate of the lateness, in nanoseconds.
+    """
+
+    def __init__(self, late_fraction=0.25):
+        self.late_fraction = late_fraction
+        self.frames = 0
+        self.late = 0
+        self.skipped = 0
+        self.jitter_ns = 0.0
+        self.max_lateness_ns = 0
+        self._last_lateness_ns = None
+
+    def record(self, lateness_ns, interval_ns):
+        """Account one frame that arrived lateness_ns after its deadline"""
+        self.frames += 1
+        if lateness_ns > interval_ns * self.late_fraction:
+            self.late += 1
+        self.max_lateness_ns = max(self.max_lateness_ns, lateness_ns)
+        if self._last_lateness_ns is not None:
+            delta = abs(lateness_ns - self._last_lateness_ns)
+            self.jitter_ns += (delta - self.jitter_ns) / 16
+        self._last_lateness_ns = lateness_ns
+
+    def as_dict(self):
+        return {
+            "frames": self.frames,
+            "late": self.late,
+            "skipped": self.skipped,
+            "jitter_ms": self.jitter_ns / 1e6,
+            "max_lateness_ms": self.max_lateness_ns / 1e6,
+        }
+
+
+class FrameScheduler:
+    """
+    Paces frames on time.monotonic_ns and owns their numbering and pts.
+
+    Frame n is due at a deadline on a fixed grid, anchored at the first
+    frame and re-anchored when the frame rate changes, so sleeping never
+    accumulates drift and wall-clock adjustments don't matter. When the
+    producer falls a whole interval or more behind, the missed slots are
+    skipped and counted instead of being rendered in a burst.
+    """
+
+    def __init__(self, fps, clock_rate=VIDEO_CLOCK_RATE):
+        self.fps = fps
+        self.clock_rate = clock_rate
+        self.count = 0
+        self.stats = DeadlineStats()
+        self._anchor_ns = None
+        self._anchor_count = 0
+        self._anchor_pts = 0
+
+    @property
+    def interval_ns(self):
+        return NS_PER_SECOND // self.fps
+
+    def deadline_ns(self, count=None):
+        """Monotonic time at which frame `count` is due"""
+        if count is None:
+            count = self.count
+        if self._anchor_ns is None:
+            return time.monotonic_ns()
+        return self._anchor_ns + (count - self._anchor_count) * NS_PER_SECOND // self.fps
+
+    def pts(self, count=None):
+        """Presentation timestamp of frame `count` on the `clock_rate` clock"""
+        if count is None:
+            count = self.count
+        return self._anchor_pts + (count - self._anchor_count) * self.clock_rate // self.fps
+
+    def media_time(self, count=None):
+        """Presentation time of frame `count` in seconds"""
+        return self.pts(count) / self.clock_rate
+
+    def set_fps(self, fps):
+        """Change the frame rate from the current frame on"""
+        if fps == self.fps:
+            return
+        if self._anchor_ns is not None:
+            self._anchor_ns, self._anchor_pts = self.deadline_ns(), self.pts()
+            self._anchor_count = self.count
+        self.fps = fps
+
+    def restart(self):
+        """Anchor the schedule at the next frame again, e.g. after an idle period"""
+        if self._anchor_ns is not None:
+            self._anchor_pts = self.pts()
+            self._anchor_count = self.count
+            self._anchor_ns = None
+
+    def resume(self):
+        """
+        Make the current frame due now instead of at its deadline, e.g. to end
+        a slow idle interval early; its pts follows the time that really passed
+        """
+        if self._anchor_ns is None:
+            return
+        now = time.monotonic_ns()
+        pts = self._anchor_pts + (now - self._anchor_ns) * self.clock_rate // NS_PER_SECOND
+        pts = max(pts, self.pts(self.count - 1) + 1)
+        self._anchor_ns, self._anchor_pts, self._anchor_count = now, pts, self.count
+
+    async def wait(self, lead_ns=0):
+        """
+        Sleep until `lead_ns` before the current frame is due.
+
+        The lead leaves time to render the frame before its deadline. Returns
+        the number of frame slots skipped because the deadline had already
+        passed by a whole interval or more.
+        """
+        now = time.monotonic_ns()
+        if self._anchor_ns is None:
+            self._anchor_ns = now + lead_ns
+            self._anchor_count = self.count
+            return 0
+
+        deadline = self.deadline_ns()
+        if now < deadline - lead_ns:
+            await asyncio.sleep((deadline - lead_ns - now) / NS_PER_SECOND)
+            return 0
+
+        skipped = max(0, now - deadline) * self.fps // NS_PER_SECOND
+        if skipped:
+            self.count += skipped
+            self.stats.skipped += skipped
+        return skipped
+
+    async def wait_deadline(self):
+        """Sleep until the current frame is due, if it is not due yet"""
+        remaining = self.deadline_ns() - time.monotonic_ns()
+        if remaining > 0:
+            await asyncio.sleep(remaining / NS_PER_SECOND)
+
+    def frame_done(self):
+        """Account the current frame as delivered now and advance to the next one"""
+        self.stats.record(time.monotonic_ns() - self.deadline_ns(), self.interval_ns)
+        self.count += 1
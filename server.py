@@ -1,37 +1,67 @@
 import argparse
 import asyncio
+import inspect
 import logging
-import fractions
-import aiohttp
+import os
+import time
+import weakref
+from aiohttp import web
 
-import numpy as np
-from av import VideoFrame
 from hypha_rpc import login, connect_to_server, register_rtc_service
-from fastapi import FastAPI
-from fastapi.responses import HTMLResponse
+from fastapi import FastAPI, Request
+from fastapi.responses import HTMLResponse, Response
 
-from aiortc import MediaStreamTrack
+from aiortc import MediaStreamTrack, RTCConfiguration, RTCIceServer, RTCPeerConnection, RTCSessionDescription
+from aiortc.rtp import RTCP_PSFB_APP, RtcpPsfbPacket, unpack_remb_fci
+# Sets up the RPC on a peer's data channel, as register_rtc_service does
+from hypha_rpc.webrtc_client import _setup_rpc
+
+import metrics
+from capture import SnapshotCache
+from encoding import (
+    DEFAULT_ENCODER_SETTINGS, install_encoder, missing_internal, prefer_codecs, sender_encoder, update_encoder_settings,
+)
+from ice import IceServerCache
+from local_signaling import LocalSignalingServer
+from metrics import instrument_rpc
+from render import render_view, view_scale
+from producer import FrameProducer, LevelSelector, create_render_executor, pyramid_sizes
+from recorder import StreamRecorder
+from scan import scan_region
+from specimen import SpecimenWorld, generate_world, load_world
+from stage import SharedStage, SharedStageReader, StageController
+from telemetry import PositionBroadcaster
+from webapp import AccessLog, StaticFile
+from workers import PipeLink, WorkerPool
 
 logger = logging.getLogger("pc")
 
 # FastAPI app instance
 app = FastAPI()
 
+# index.html is kept in memory, compressed, and reloaded when the file changes
+index_page = StaticFile("index.html")
+
+# Requests through the Hypha ASGI proxy are logged in batches off the event loop
+access_log = AccessLog()
+
 @app.get("/", response_class=HTMLResponse)
-async def root():
-    with open("index.html", "r") as file:
-        HTML_CONTENT = file.read()
-    return HTML_CONTENT
+async def root(request: Request):
+    return index_page.response(request.headers)
 
 @app.get("/api/v1/test")
 async def test():
     return {"message": "Hello, WebRTC demo is working!"}
 
+@app.get("/metrics")
+async def get_metrics():
+    return Response(metrics.render_metrics(), media_type=metrics.CONTENT_TYPE)
+
 async def serve_fastapi(args, context=None):
     # context can be used for authorization, e.g., checking the user's permission
     # e.g., check user id against a list of allowed users
     scope = args["scope"]
-    print(f'{context["user"]["id"]} - {scope["client"]} - {scope["method"]} - {scope["path"]}')
+    access_log.log(f'{context["user"]["id"]} - {scope["client"]} - {scope["method"]} - {scope["path"]}')
     await app(args["scope"], args["receive"], args["send"])
 
 # Global state for microscope position
@@ -40,12 +70,15 @@ microscope_state = {
     "y": 180,  # Center Y
     "target_x": 240,
     "target_y": 180,
+    "stage_width": 480,   # Stage travel range in X, independent of the stream resolution
+    "stage_height": 360,  # Stage travel range in Y
     "velocity_x": 0.0,  # Current velocity in X direction
     "velocity_y": 0.0,  # Current velocity in Y direction
     "max_acceleration": 8.0,  # Maximum acceleration when starting movement
     "max_velocity": 15.0,     # Maximum velocity
     "damping": 0.85,          # Velocity damping for smooth deceleration
     "attraction_strength": 0.3,  # How strongly it's attracted to target
+    "speed_limit": None,      # Velocity limit of the current path, set by the stage controller
     "objects": [
         {"x": 100, "y": 100, "color": [255, 100, 100], "size": 30},
         {"x": 300, "y": 200, "color": [100, 255, 100], "size": 25},
@@ -55,420 +88,728 @@ microscope_state = {
     ]
 }
 
+# The slide under the microscope, indexed so frames only touch the objects
+# near the view; replaced by --world-objects or --world-file
+specimen_world = SpecimenWorld(microscope_state["objects"], microscope_state["stage_width"], microscope_state["stage_height"])
+
+def set_specimen_world(world):
+    """Put `world` under the microscope, centered; the stage travels over the whole slide"""
+    global specimen_world
+    specimen_world = world
+    microscope_state["stage_width"] = world.width
+    microscope_state["stage_height"] = world.height
+    stage_controller.reset(world.width / 2, world.height / 2)
+    print(f"Specimen world: {len(world)} objects on a {world.width:.0f}x{world.height:.0f} slide")
+
+# Advances the stage physics at a fixed rate, independent of frame delivery
+stage_controller = StageController(microscope_state, rate=240)
+
+# Pushes position changes to subscribed clients instead of them polling get_position
+position_broadcaster = PositionBroadcaster(stage_controller)
+
+def snapshot_frame(count):
+    """Capture the stage pose for frame `count` as the state to render"""
+    pose = stage_controller.pose()
+    if count % 90 == 0:  # Log every 90 frames
+        print(f"FrameProducer: Frame {count}, Microscope pos: ({pose['x']:.1f}, {pose['y']:.1f})")
+    # Only the objects near the view are rendered (and sent to render workers)
+    scale = view_scale(frame_producer.width, frame_producer.height)
+    half_width = frame_producer.width / scale / 2
+    half_height = frame_producer.height / scale / 2
+    return {
+        "x": pose["x"],
+        "y": pose["y"],
+        "stage_width": microscope_state["stage_width"],
+        "stage_height": microscope_state["stage_height"],
+        "objects": specimen_world.visible(pose["x"], pose["y"], half_width, half_height),
+    }
+
+# Renders once per tick and fans the frames out to all VideoTransformTracks,
+# at a lower rate while the stage is at rest
+frame_producer = FrameProducer(
+    snapshot_frame, render_view, width=480, height=360, fps=30, pixel_format="yuv420p", stage=stage_controller
+)
+
+# Encoded stills of the latest frame, shared by concurrent snap() calls
+snapshot_cache = SnapshotCache()
+
+# Where scan() writes its mosaics, set with --scan-dir; one scan runs at a time
+scan_settings = {"directory": "scans"}
+scan_lock = asyncio.Lock()
+
+# Records the stream to disk on its own encoder thread, directory set with --record-dir
+stream_recorder = StreamRecorder(frame_producer)
+
+# ICE servers for the RTC service, cached across restarts in --ice-cache
+ice_server_cache = IceServerCache()
+
+# Encoder settings every new peer starts with, set with --codecs, --min-bitrate,
+# --max-bitrate and --keyframe-interval; configure_encoder changes them per peer
+encoder_defaults = dict(DEFAULT_ENCODER_SETTINGS)
+
+# Worker processes streaming to the peers with --workers
+worker_pool = None
+
+# Control functions a worker process runs itself; it forwards all others to
+# the main process, which owns the stage
+WORKER_LOCAL_FUNCTIONS = (
+    "get_position", "subscribe_position", "unsubscribe_position", "get_stream_stats", "set_view_size",
+    "configure_encoder", "execute",
+)
+
+# Functions that can be batched with execute
+BATCH_FUNCTIONS = (
+    "move", "move_to", "move_path", "get_position", "snap", "configure_stream",
+    "set_view_size", "configure_encoder", "get_stream_stats",
+)
+
+# Open WebRTC peer connections, for the metrics
+peer_connections = set()
+
+# The VideoTransformTracks of every peer connection, and the peer connections
+# by the label of their data channel, to find the stream of an RPC caller
+peer_tracks = weakref.WeakKeyDictionary()
+channel_peers = weakref.WeakValueDictionary()
+
+def count_connection_states():
+    states = {}
+    for peer_connection in list(peer_connections):
+        key = (peer_connection.connectionState,)
+        states[key] = states.get(key, 0) + 1
+    return states
+
+metrics.ACTIVE_PEERS.set_function(lambda: len(peer_connections))
+metrics.PEER_CONNECTION_STATES.set_function(count_connection_states)
+metrics.ACTIVE_TRACKS.set_function(lambda: len(frame_producer.subscribers))
+metrics.FRAMES_LATE.set_function(lambda: frame_producer.scheduler.stats.late)
+metrics.FRAMES_SKIPPED.set_function(lambda: frame_producer.scheduler.stats.skipped)
+metrics.PRODUCER_IDLE.set_function(lambda: int(frame_producer.idle))
+
 class VideoTransformTrack(MediaStreamTrack):
     """
-    A video stream track that transforms frames from an another track.
+    A video stream track that delivers the frames of the shared FrameProducer.
     """
 
     kind = "video"
 
-    def __init__(self):
+    def __init__(self, producer=None):
         super().__init__()  # don't forget this!
+        self.producer = producer or frame_producer
         self.count = 0
         self.running = True
-        self.start_time = None
+        self.subscription = None
+        # Size the viewer asked for with set_view_size and the bandwidth its
+        # receiver estimates (RTCP REMB), to pick the pyramid level
+        self.max_width = None
+        self.max_height = None
+        self.bitrate = None
+        self.levels = LevelSelector()
+        # Codec preference, bitrate caps and keyframe interval of this peer,
+        # and the RTCRtpSender encoding the track
+        self.encoder_settings = dict(encoder_defaults, codecs=list(encoder_defaults["codecs"]))
+        self.sender = None
         print("VideoTransformTrack initialized")
 
-    def draw_circle(self, img, center_x, center_y, radius, color):
-        """Draw a filled circle on the image"""
-        height, width = img.shape[:2]
-        y, x = np.ogrid[:height, :width]
-        mask = (x - center_x)**2 + (y - center_y)**2 <= radius**2
-        img[mask] = color
-
-    def draw_crosshair(self, img, center_x, center_y, size=20, color=[255, 255, 255]):
-        """Draw a crosshair at the specified position"""
-        height, width = img.shape[:2]
-        
-        # Horizontal line
-        if 0 <= center_y < height:
-            start_x = max(0, center_x - size)
-            end_x = min(width, center_x + size)
-            img[center_y, start_x:end_x] = color
-        
-        # Vertical line
-        if 0 <= center_x < width:
-            start_y = max(0, center_y - size)
-            end_y = min(height, center_y + size)
-            img[start_y:end_y, center_x] = color
-
     async def recv(self):
         if not self.running:
             print("VideoTransformTrack: recv() called but track is not running")
             raise Exception("Track stopped")
             
         try:
-            import time
-            
-            # Initialize start time on first frame
-            if self.start_time is None:
-                self.start_time = time.time()
-            
-            # Calculate proper timing
-            current_time = time.time()
-            elapsed = current_time - self.start_time
-            expected_frame = int(elapsed * 30)  # 30 FPS
-            
-            # Skip frames if we're behind, or wait if we're ahead
-            if self.count < expected_frame:
-                self.count = expected_frame
-            elif self.count > expected_frame:
-                await asyncio.sleep((self.count - expected_frame) / 30.0)
-            
-            # Physics-based movement with acceleration and deceleration
-            # Calculate distance to target
-            dx = microscope_state["target_x"] - microscope_state["x"]
-            dy = microscope_state["target_y"] - microscope_state["y"]
-            distance = np.sqrt(dx*dx + dy*dy)
-            
-            if distance > 0.1:  # Only apply forces if not at target
-                # Normalize direction vectors
-                dir_x = dx / distance
-                dir_y = dy / distance
-                
-                # Calculate acceleration based on distance to target
-                # Stronger acceleration when far, weaker when close
-                acceleration_magnitude = min(
-                    microscope_state["max_acceleration"], 
-                    distance * microscope_state["attraction_strength"]
-                )
-                
-                # Apply acceleration in direction of target
-                accel_x = dir_x * acceleration_magnitude
-                accel_y = dir_y * acceleration_magnitude
-                
-                # Update velocity with acceleration
-                microscope_state["velocity_x"] += accel_x * (1/30.0)  # Frame time
-                microscope_state["velocity_y"] += accel_y * (1/30.0)
-                
-                # Apply damping to velocity for smooth deceleration
-                microscope_state["velocity_x"] *= microscope_state["damping"]
-                microscope_state["velocity_y"] *= microscope_state["damping"]
-                
-                # Limit maximum velocity
-                vel_magnitude = np.sqrt(
-                    microscope_state["velocity_x"]**2 + microscope_state["velocity_y"]**2
-                )
-                if vel_magnitude > microscope_state["max_velocity"]:
-                    scale = microscope_state["max_velocity"] / vel_magnitude
-                    microscope_state["velocity_x"] *= scale
-                    microscope_state["velocity_y"] *= scale
-                
-                # Update position based on velocity
-                microscope_state["x"] += microscope_state["velocity_x"]
-                microscope_state["y"] += microscope_state["velocity_y"]
-                
-                # Ensure position stays within bounds
-                microscope_state["x"] = max(0, min(480, microscope_state["x"]))
-                microscope_state["y"] = max(0, min(360, microscope_state["y"]))
-                
-                # Stop very small movements to avoid jitter
-                if distance < 2.0 and vel_magnitude < 0.5:
-                    microscope_state["x"] = microscope_state["target_x"]
-                    microscope_state["y"] = microscope_state["target_y"]
-                    microscope_state["velocity_x"] = 0.0
-                    microscope_state["velocity_y"] = 0.0
-            else:
-                # At target, zero out velocity
-                microscope_state["velocity_x"] = 0.0
-                microscope_state["velocity_y"] = 0.0
-            
-            # Generate a frame with microscope view simulation
-            t = self.count / 30.0  # time in seconds
-            
-            # Create a 480x360 frame
-            height, width = 360, 480
-            
-            # Create a gradient background that simulates microscope lighting
-            y_grad, x_grad = np.ogrid[:height, :width]
-            center_x, center_y = width // 2, height // 2
-            
-            # Distance from center for vignette effect
-            distance = np.sqrt((x_grad - center_x)**2 + (y_grad - center_y)**2)
-            max_distance = np.sqrt(center_x**2 + center_y**2)
-            vignette = 1 - (distance / max_distance) * 0.3
-            
-            # Reduce noise for better compression and quality
-            # Use deterministic pattern instead of random noise
-            pattern_noise = 3 * np.sin(x_grad * 0.1 + t * 0.5) * np.cos(y_grad * 0.1 + t * 0.3)
-            base_intensity = 45 + 15 * np.sin(t * 0.5)
-            background = (base_intensity + pattern_noise) * vignette
-            
-            # Create high-quality RGB image with better precision
-            img = np.zeros((height, width, 3), dtype=np.float32)
-            img[:, :, 0] = background * 0.85  # Slight blue tint
-            img[:, :, 1] = background * 0.92
-            img[:, :, 2] = background
-            
-            # Calculate view offset based on microscope position
-            view_offset_x = int(microscope_state["x"] - center_x)
-            view_offset_y = int(microscope_state["y"] - center_y)
+            # Subscribe lazily, so frames are only produced once the encoder pulls
+            if self.subscription is None:
+                self.subscription = self.producer.subscribe()
+            self.subscription.level = self.select_level()
             
-            # Draw objects that move relative to microscope position
-            for obj in microscope_state["objects"]:
-                # Calculate object position relative to current view
-                obj_x = obj["x"] - view_offset_x
-                obj_y = obj["y"] - view_offset_y
-                
-                # Add smoother floating motion with reduced temporal variation
-                float_x = obj_x + 3 * np.sin(t * 1.5 + obj["x"] * 0.01)
-                float_y = obj_y + 2 * np.cos(t * 1.2 + obj["y"] * 0.01)
-                
-                # Only draw if object is visible in current view
-                if -obj["size"] <= float_x <= width + obj["size"] and -obj["size"] <= float_y <= height + obj["size"]:
-                    # Add smoother pulsing effect
-                    pulse = 1 + 0.15 * np.sin(t * 2 + obj["x"] * 0.02)
-                    size = int(obj["size"] * pulse)
-                    
-                    # Draw object with smoother glow effect for better compression
-                    for glow_size in range(size + 8, size - 1, -1):
-                        alpha = 0.4 * (1 - (glow_size - size) / 8) ** 2  # Quadratic falloff
-                        glow_color = [obj["color"][i] * alpha for i in range(3)]
-                        self.draw_circle_float(img, float_x, float_y, glow_size, glow_color)
-                    
-                    # Draw main object with precise colors
-                    self.draw_circle_float(img, float_x, float_y, size, obj["color"])
+            wait_start = time.monotonic_ns()
+            item = await self.subscription.queue.get()
+            if isinstance(item, Exception):
+                raise item
+            frame, deadline_ns = item
             
-            # Draw microscope crosshair at center with anti-aliasing
-            self.draw_crosshair_float(img, center_x, center_y, 15, [255, 255, 255])
-            
-            # Add measurement grid with reduced intensity for better compression
-            grid_spacing = 50
-            grid_color = [60, 60, 60]  # Darker grid lines
-            for i in range(0, width, grid_spacing):
-                if i % (grid_spacing * 2) == 0:  # Major grid lines
-                    img[:, i:min(i+1, width)] = grid_color
-            for i in range(0, height, grid_spacing):
-                if i % (grid_spacing * 2) == 0:  # Major grid lines
-                    img[i:min(i+1, height), :] = grid_color
-            
-            # Add position indicator with solid colors
-            pos_text_area = img[10:35, 10:200]
-            pos_text_area[:] = [0, 0, 0]  # Black background
-            
-            # Add coordinate display as colored bars with better precision
-            x_bar_length = int((microscope_state["x"] / 480) * 180)
-            y_bar_length = int((microscope_state["y"] / 360) * 180)
-            
-            if x_bar_length > 0:
-                img[15:20, 15:15+x_bar_length] = [255, 100, 100]  # Red for X
-            if y_bar_length > 0:
-                img[25:30, 15:15+y_bar_length] = [100, 255, 100]  # Green for Y
-            
-            # Add frame counter with solid colors
-            frame_indicator = self.count % 60
-            indicator_width = int((frame_indicator / 60) * 100)
-            img[height-15:height-10, width-110:width-110+indicator_width] = [100, 100, 255]
-            
-            # Convert to uint8 with proper clipping for better quality
-            img_uint8 = np.clip(img, 0, 255).astype(np.uint8)
-            
-            new_frame = VideoFrame.from_ndarray(img_uint8, format="bgr24")
-            
-            # Use proper timing based on frame count
-            new_frame.pts = self.count
-            new_frame.time_base = fractions.Fraction(1, 30)  # 30 FPS
-            
-            if self.count % 90 == 0:  # Log every 3 seconds
-                print(f"VideoTransformTrack: Frame {self.count}, Microscope pos: ({microscope_state['x']:.1f}, {microscope_state['y']:.1f})")
+            # Account how late the encoder picks up the frame, and how long it
+            # had to wait for the producer
+            now = time.monotonic_ns()
+            self.subscription.waited_ns += now - wait_start
+            self.subscription.stats.record(now - deadline_ns, self.producer.scheduler.interval_ns)
             
             self.count += 1
-            
-            return new_frame
+            return frame
         except Exception as e:
             print(f"VideoTransformTrack: Error in recv(): {e}")
-            self.running = False
+            self.stop()
             raise
 
-    def draw_circle_float(self, img, center_x, center_y, radius, color):
-        """Draw a filled circle on the float image with anti-aliasing"""
-        height, width = img.shape[:2]
-        y, x = np.ogrid[:height, :width]
-        
-        # Calculate distance from center
-        distance = np.sqrt((x - center_x)**2 + (y - center_y)**2)
-        
-        # Create anti-aliased mask
-        mask = np.zeros((height, width), dtype=np.float32)
-        inside = distance <= radius
-        edge = (distance > radius) & (distance <= radius + 1)
-        
-        mask[inside] = 1.0
-        mask[edge] = radius + 1 - distance[edge]  # Smooth edge
-        
-        # Apply color with alpha blending
-        for i in range(3):
-            img[:, :, i] = img[:, :, i] * (1 - mask) + color[i] * mask
-
-    def draw_crosshair_float(self, img, center_x, center_y, size=20, color=[255, 255, 255]):
-        """Draw a crosshair with anti-aliasing"""
-        height, width = img.shape[:2]
-        center_x, center_y = int(center_x), int(center_y)
+    def select_level(self):
+        """The pyramid level that fits the requested size and the estimated bandwidth"""
+        bitrate = self.bitrate
+        max_bitrate = self.encoder_settings["max_bitrate"]
+        if max_bitrate:
+            bitrate = min(bitrate, max_bitrate) if bitrate else max_bitrate
+        return self.levels.select(
+            self.producer.width, self.producer.height, self.producer.fps,
+            self.max_width, self.max_height, bitrate, frozen=self.producer.idle,
+        )
+
+    def stats(self):
+        """Delivery counters of this track: late, skipped (dropped) frames and jitter"""
+        if self.subscription is None:
+            return None
+        return self.subscription.as_dict()
+
+    def stop(self):
+        super().stop()
+        self.running = False
+        if self.subscription is not None:
+            self.producer.unsubscribe(self.subscription)
+            self.subscription = None
+
+async def timed(phases, name, awaitable):
+    """Await `awaitable` and record how long it took in `phases[name]`"""
+    start = time.perf_counter()
+    try:
+        return await awaitable
+    finally:
+        phases[name] = time.perf_counter() - start
+
+def watch_bitrate(sender, video_track):
+    """Pass the receiver's REMB bandwidth estimates for `sender` on to `video_track.bitrate`"""
+    # aiortc only hands REMB to its own encoder, so look at the RTCP packets first
+    if missing_internal(sender, "_handle_rtcp_packet", "bandwidth based level selection"):
+        return
+    handle_rtcp_packet = sender._handle_rtcp_packet
+
+    async def handle(packet):
+        if isinstance(packet, RtcpPsfbPacket) and packet.fmt == RTCP_PSFB_APP:
+            try:
+                bitrate, ssrcs = unpack_remb_fci(packet.fci)
+            except ValueError:
+                pass
+            else:
+                if getattr(sender, "_ssrc", None) in ssrcs:
+                    video_track.bitrate = bitrate
+        await handle_rtcp_packet(packet)
+
+    sender._handle_rtcp_packet = handle
+
+def caller_tracks(context):
+    """The VideoTransformTracks of the peer connection an RPC came in on"""
+    context = context or {}
+    peer_connection = context.get("peer_connection")
+    if peer_connection is None:
+        # Hypha RPC over a data channel comes from the channel's client id
+        peer_connection = channel_peers.get(str(context.get("from", "")).split("/")[-1])
+    if peer_connection is None or peer_connection not in peer_tracks:
+        raise ValueError("This has to be called over the WebRTC connection of the stream")
+    return peer_tracks[peer_connection]
+
+async def on_init(peer_connection):
+    print("WebRTC peer connection initialized on server side")
+    video_tracks = []
+    peer_connections.add(peer_connection)
+    peer_tracks[peer_connection] = video_tracks
+
+    @peer_connection.on("datachannel")
+    def on_datachannel(channel):
+        channel_peers[channel.label] = peer_connection
+
+    @peer_connection.on("connectionstatechange")
+    async def on_connectionstatechange():
+        print(f"Connection state changed to: {peer_connection.connectionState}")
+        if peer_connection.connectionState in ("failed", "closed"):
+            peer_connections.discard(peer_connection)
+            # Release the shared producer subscription of this peer
+            for video_track in video_tracks:
+                video_track.stop()
+
+    @peer_connection.on("track")
+    def on_track(track):
+        print(f"Track {track.kind} received from client")
+        video_track = VideoTransformTrack()
+        video_tracks.append(video_track)
+
+        sender = peer_connection.addTrack(video_track)
+        video_track.sender = sender
+        # The offer was negotiated before this event, so the codecs are
+        # reordered before the answer is created from them
+        transceiver = next(t for t in peer_connection.getTransceivers() if t.sender is sender)
+        prefer_codecs(transceiver, video_track.encoder_settings["codecs"])
+        install_encoder(sender, video_track.encoder_settings)
+        watch_bitrate(sender, video_track)
+        print(f"Added VideoTransformTrack to peer connection")
+
+        @track.on("ended")
+        async def on_ended():
+            print(f"Client track {track.kind} ended")
+            video_track.stop()
+
+def create_control_service():
+    """Build the microscope-control service definition"""
+    @instrument_rpc
+    async def move(value, axis, is_absolute=True, is_blocking=True, context=None):
+        """Move the microscope position along one axis, waiting for arrival if `is_blocking`"""
+        print(f"Move command: {value} on {axis} axis (absolute: {is_absolute})")
         
-        # Horizontal line
-        if 0 <= center_y < height:
-            start_x = max(0, center_x - size)
-            end_x = min(width, center_x + size)
-            img[center_y, start_x:end_x] = color
+        snapshot = stage_controller.snapshot
+        x, y = snapshot.target_x, snapshot.target_y
+        if axis.upper() == 'X':
+            x = value if is_absolute else x + value
+        elif axis.upper() == 'Y':
+            y = value if is_absolute else y + value
+        stage_controller.move_to(x, y)
         
-        # Vertical line
-        if 0 <= center_x < width:
-            start_y = max(0, center_y - size)
-            end_y = min(height, center_y + size)
-            img[start_y:end_y, center_x] = color
-
-async def fetch_ice_servers():
-    """Fetch ICE servers from the coturn service"""
+        snapshot = stage_controller.snapshot
+        print(f"New target position: ({snapshot.target_x}, {snapshot.target_y})")
+        print(f"Current velocity: ({snapshot.velocity_x:.2f}, {snapshot.velocity_y:.2f})")
+        if is_blocking:
+            await stage_controller.wait_for_arrival()
+        return {"x": snapshot.target_x, "y": snapshot.target_y}
+    
+    @instrument_rpc
+    async def move_to(x, y, is_blocking=True, context=None):
+        """Move to an absolute (x, y) position, waiting for arrival if `is_blocking`"""
+        stage_controller.move_to(x, y)
+        if is_blocking:
+            return await stage_controller.wait_for_arrival()
+        snapshot = stage_controller.snapshot
+        return {"x": snapshot.target_x, "y": snapshot.target_y}
+    
+    @instrument_rpc
+    async def move_path(waypoints, speed=None, is_blocking=True, context=None):
+        """
+        Follow a list of [x, y] waypoints without stopping in between, at most
+        `speed` stage units per second, waiting for arrival if `is_blocking`
+        """
+        stage_controller.move_path([(x, y) for x, y in waypoints], speed)
+        if is_blocking:
+            return await stage_controller.wait_for_arrival()
+        snapshot = stage_controller.snapshot
+        return {"x": snapshot.target_x, "y": snapshot.target_y}
+    
+    @instrument_rpc
+    async def configure_stream(width=None, height=None, fps=None, adaptive=None, context=None):
+        """
+        Change the resolution, frame rate or adaptive quality of the stream
+        for every viewer (in every worker process); a single viewer asks for
+        a smaller stream with set_view_size instead
+        """
+        if (width is not None and width % 2) or (height is not None and height % 2):
+            raise ValueError("Width and height must be even")
+        frame_producer.configure(width, height, fps, adaptive)
+        if worker_pool is not None:
+            worker_pool.broadcast("configure_stream", width=width, height=height, fps=fps, adaptive=adaptive)
+        best_width, best_height, best_fps = frame_producer.quality.levels[0]
+        return {
+            "width": best_width,
+            "height": best_height,
+            "fps": best_fps,
+            "adaptive": frame_producer.adaptive,
+        }
+    
+    @instrument_rpc
+    async def set_view_size(width, height, context=None):
+        """
+        Ask for a stream of about `width` x `height` pixels on the calling
+        peer: it gets the smallest pyramid level that still covers that size
+        """
+        tracks = caller_tracks(context)
+        for track in tracks:
+            track.max_width, track.max_height = width, height
+        level = tracks[0].select_level() if tracks else 0
+        level_width, level_height = pyramid_sizes(frame_producer.width, frame_producer.height)[level]
+        return {"level": level, "width": level_width, "height": level_height}
+    
+    @instrument_rpc
+    async def configure_encoder(min_bitrate=None, max_bitrate=None, keyframe_interval=None, context=None):
+        """
+        Cap the bitrate (bits per second, 0 for aiortc's limits) or force a
+        keyframe every `keyframe_interval` frames (0 only on request) for the
+        calling peer; returns its settings and encoder state
+        """
+        tracks = caller_tracks(context)
+        info = dict(encoder_defaults)
+        for track in tracks:
+            update_encoder_settings(
+                track.encoder_settings, min_bitrate=min_bitrate, max_bitrate=max_bitrate, keyframe_interval=keyframe_interval
+            )
+            info = dict(track.encoder_settings)
+            encoder = sender_encoder(track.sender)
+            if encoder is not None:
+                encoder.apply_bitrate()
+                info.update(encoder.info())
+        return info
+    
+    @instrument_rpc
+    async def get_stream_stats(context=None):
+        """Frame pacing counters of the producer and of every connected track"""
+        return frame_producer.stats()
+    
+    @instrument_rpc
+    def get_position(context=None):
+        """Get current microscope position"""
+        snapshot = stage_controller.snapshot
+        return {"x": snapshot.x, "y": snapshot.y}
+    
+    @instrument_rpc
+    async def subscribe_position(callback, max_rate=30, context=None):
+        """Push position, velocity and target changes to `callback`, at most `max_rate` times per second"""
+        if not callable(callback):
+            # Interface object passed with _rintf by the web client
+            callback = callback["on_position"]
+        subscription_id, state = position_broadcaster.subscribe(callback, max_rate)
+        return {"id": subscription_id, "state": state}
+    
+    @instrument_rpc
+    async def unsubscribe_position(subscription_id, context=None):
+        """Stop the position updates of a subscription"""
+        position_broadcaster.unsubscribe(subscription_id)
+    
+    @instrument_rpc
+    async def snap(image_format="png", quality=90, context=None):
+        """
+        Capture the most recent frame as "png" or "jpeg" bytes, or as a raw
+        (height, width, 3) rgb24 uint8 array converted from it (a copy made
+        once per frame); `quality` (1-100) applies to JPEG
+        """
+        count, frame = await frame_producer.capture()
+        data = await snapshot_cache.get(frame, image_format, quality)
+        snapshot = stage_controller.snapshot
+        print(f"snap an image: frame {count} as {image_format}")
+        return {
+            "status": "image captured",
+            "position": {"x": snapshot.x, "y": snapshot.y},
+            "frame": count,
+            "width": frame.width,
+            "height": frame.height,
+            "format": image_format,
+            "data": data,
+        }
+    
+    @instrument_rpc
+    async def execute(commands, context=None):
+        """
+        Run a batch of {"method", "kwargs"} commands in order and return their
+        results, e.g. a series of blocking move_to and snap calls in one round trip
+        """
+        results = []
+        for index, command in enumerate(commands):
+            method = command["method"]
+            # Looked up in the service, so in a worker process the commands
+            # it forwards go to the main process and the per-peer ones stay here
+            func = service.get(method) if method in BATCH_FUNCTIONS else None
+            if func is None:
+                raise ValueError(f"Command {index}: unknown method {method!r}")
+            try:
+                result = func(**command.get("kwargs", {}), context=context)
+                if inspect.isawaitable(result):
+                    result = await result
+            except Exception as e:
+                raise RuntimeError(f"Command {index} ({method}) failed after {len(results)} results: {e}") from e
+            results.append(result)
+        return results
+    
+    @instrument_rpc
+    async def scan(region, tile_overlap=0.1, settle_time=0.0, context=None):
+        """
+        Scan `region` {"x", "y", "width", "height"} (stage units) tile by tile
+        into a memory-mapped .npy mosaic on the server, yielding the mosaic
+        geometry, then position and progress of every tile as it is written
+        """
+        if scan_lock.locked():
+            raise RuntimeError("A scan is already running")
+        async with scan_lock:
+            now = time.time()
+            name = f"scan-{time.strftime('%Y%m%d-%H%M%S', time.localtime(now))}-{int(now * 1000) % 1000:03d}.npy"
+            path = os.path.join(scan_settings["directory"], name)
+            print(f"Scanning {region} into {path}")
+            async for progress in scan_region(
+                stage_controller, frame_producer, region, path, tile_overlap, settle_time
+            ):
+                yield progress
+    
+    @instrument_rpc
+    async def start_recording(container="mp4", segment_seconds=300, context=None):
+        """
+        Record the stream on the server into "mp4" or "mkv" files, starting a
+        new file every `segment_seconds`; frames the encoder can't keep up
+        with are dropped from the recording, never from the live stream
+        """
+        return stream_recorder.start(container, segment_seconds)
+    
+    @instrument_rpc
+    async def stop_recording(context=None):
+        """Stop recording and return the written segment files and frame counts"""
+        return await stream_recorder.stop()
+    
+    @instrument_rpc
+    def get_recording_status(context=None):
+        return stream_recorder.info()
+    
+    service = {
+        "id": "microscope-control",
+        "config":{
+            "visibility": "public",
+            "run_in_executor": True,
+            "require_context": True,   
+        },
+        "type": "echo",
+        "move": move,
+        "move_to": move_to,
+        "move_path": move_path,
+        "execute": execute,
+        "scan": scan,
+        "start_recording": start_recording,
+        "stop_recording": stop_recording,
+        "get_recording_status": get_recording_status,
+        "get_position": get_position,
+        "subscribe_position": subscribe_position,
+        "unsubscribe_position": unsubscribe_position,
+        "snap": snap,
+        "configure_stream": configure_stream,
+        "set_view_size": set_view_size,
+        "configure_encoder": configure_encoder,
+        "get_stream_stats": get_stream_stats,
+    }
+    return service
+
+def forward_rpc(link, name, func):
+    """A control function calling `name` in the main process through `link`, with the signature of `func`"""
+    signature = inspect.signature(func)
+    def arguments(args, kwargs):
+        bound = signature.bind_partial(*args, **kwargs).arguments
+        bound.pop("context", None)
+        return bound
+    if inspect.isasyncgenfunction(func):
+        async def forward(*args, **kwargs):
+            async for item in link.stream(name, **arguments(args, kwargs)):
+                yield item
+    else:
+        async def forward(*args, **kwargs):
+            return await link.request(name, **arguments(args, kwargs))
+    forward.__name__ = name
+    forward.__doc__ = func.__doc__
+    return forward
+
+def create_worker_service(link):
+    """microscope-control for the peers of a worker process"""
+    service = create_control_service()
+    for name, func in list(service.items()):
+        if callable(func) and name not in WORKER_LOCAL_FUNCTIONS:
+            service[name] = forward_rpc(link, name, func)
+    return service
+
+async def answer_hypha_offer(params, ice_servers, workspace, service, on_init):
+    """Answer an offer like hypha_rpc's RTC service, serving `service` on the peer's data channels"""
+    peer_connection = RTCPeerConnection(
+        configuration=RTCConfiguration(iceServers=[RTCIceServer(**server) for server in ice_servers])
+    )
+
+    @peer_connection.on("datachannel")
+    async def on_datachannel(channel):
+        rpc = await _setup_rpc({"channel": channel, "client_id": channel.label, "workspace": workspace})
+        rpc.add_service(service)
+
+    await on_init(peer_connection)
+    await peer_connection.setRemoteDescription(RTCSessionDescription(sdp=params["sdp"], type=params["type"]))
+    answer = await peer_connection.createAnswer()
+    await peer_connection.setLocalDescription(answer)
+    return {
+        "sdp": peer_connection.localDescription.sdp,
+        "type": peer_connection.localDescription.type,
+        "workspace": workspace,
+    }
+
+def run_worker(index, connection, stage_name, world, producer_options, encoder_options):
+    """Entry point of a --workers process"""
+    asyncio.run(serve_worker(index, connection, stage_name, world, producer_options, encoder_options))
+
+async def serve_worker(index, connection, stage_name, world, producer_options, encoder_options):
+    """
+    Render, encode and stream to the peers the main process assigns to this
+    worker, with the stage pose read from shared memory
+    """
+    global stage_controller, specimen_world
+    shared = SharedStage(stage_name)
+    stage_controller = SharedStageReader(shared)
+    position_broadcaster.controller = stage_controller
+    frame_producer.stage = stage_controller
+    specimen_world = world
+    microscope_state["stage_width"], microscope_state["stage_height"] = world.width, world.height
+    configure_producer(**producer_options)
+    encoder_defaults.update(encoder_options)
+
+    link = PipeLink(connection, {})
+    service = create_worker_service(link)
+    open_peers = set()
+
+    async def on_worker_init(peer_connection):
+        await on_init(peer_connection)
+        open_peers.add(peer_connection)
+
+        @peer_connection.on("connectionstatechange")
+        async def report_closed():
+            if peer_connection.connectionState in ("failed", "closed") and peer_connection in open_peers:
+                open_peers.discard(peer_connection)
+                link.notify("peer_closed")
+
+    # Answers local offers without serving HTTP, the main process does that
+    local_peers = LocalSignalingServer(service, on_init=on_worker_init)
+
+    async def offer(params, ice_servers=None, workspace=None):
+        if workspace is None:
+            return await local_peers.answer(params)
+        return await answer_hypha_offer(params, ice_servers, workspace, service, on_worker_init)
+
+    link.handlers.update(offer=offer, configure_stream=frame_producer.configure)
+    link.start()
+    print(f"Worker {index}: ready (pid {os.getpid()})")
+    try:
+        # Run until the main process goes away
+        await link.closed
+    finally:
+        await local_peers.stop()
+        shared.close()
+
+def start_workers(count, producer_options):
+    """Start the worker pool, sharing the stage pose with it in shared memory"""
+    global worker_pool
+    stage_controller.shared = SharedStage()
+    stage_controller.shared.write(stage_controller.snapshot, stage_controller.rate if stage_controller.running else 0)
+    # Requests forwarded by the workers run here, with the real stage
+    handlers = {name: func for name, func in create_control_service().items() if callable(func)}
+    worker_pool = WorkerPool(
+        count, run_worker, (stage_controller.shared.name, specimen_world, producer_options, encoder_defaults), handlers
+    )
+    worker_pool.start()
+
+def configure_producer(pixel_format="yuv420p", width=480, height=360, fps=30, adaptive=True,
+                       render_workers=0, render_mode="thread", pipeline_depth=2, idle_fps=0, idle_after=2.0):
+    frame_producer.pixel_format = pixel_format
+    frame_producer.idle_fps = idle_fps
+    frame_producer.idle_after = idle_after
+    frame_producer.configure(width, height, fps, adaptive)
+    frame_producer.executor = create_render_executor(render_workers, render_mode)
+    frame_producer.pipeline_depth = pipeline_depth
+    frame_producer.warm_up(render_workers)
+    if idle_fps:
+        print(f"Streaming at {idle_fps} fps after the stage has been at rest for {idle_after}s")
+    if frame_producer.executor is not None:
+        print(f"Rendering frames in a {render_mode} pool with {render_workers} workers, pipeline depth {pipeline_depth}")
+
+async def local_metrics(request):
+    return web.Response(body=metrics.render_metrics().encode(), headers={"Content-Type": metrics.CONTENT_TYPE})
+
+async def serve_local(host="127.0.0.1", port=9527):
+    """Serve the stream and microscope-control on a loopback signalling endpoint instead of Hypha"""
+    offer_handler = None
+    if worker_pool is not None:
+        async def offer_handler(params):
+            return await worker_pool.offer(params=params)
+    signaling = LocalSignalingServer(
+        create_control_service(), on_init=on_init, host=host, port=port, offer_handler=offer_handler
+    )
+    signaling.app.router.add_get("/metrics", local_metrics)
+    await signaling.start()
+    print(f"Run `python loadtest.py --url http://{host}:{port}` to connect headless peers")
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get('https://ai.imjoy.io/public/services/coturn/get_rtc_ice_servers') as response:
-                if response.status == 200:
-                    ice_servers = await response.json()
-                    print("Successfully fetched ICE servers:", ice_servers)
-                    return ice_servers
-                else:
-                    print(f"Failed to fetch ICE servers, status: {response.status}")
-                    return None
-    except Exception as e:
-        print(f"Error fetching ICE servers: {e}")
-        return None
-
-async def start_service(service_id, workspace=None, token=None):
+        # Keep the server running
+        await asyncio.Event().wait()
+    finally:
+        await signaling.stop()
+        if worker_pool is not None:
+            worker_pool.stop()
+
+async def start_service(service_id, workspace=None, token=None, stage_rate=240,
+                        render_workers=0, render_mode="thread", pipeline_depth=2,
+                        pixel_format="yuv420p", width=480, height=360, fps=30, adaptive=True,
+                        local=False, local_host="127.0.0.1", local_port=9527, scan_dir="scans",
+                        record_dir="recordings", ice_cache="ice_servers.json", ice_ttl=3600, workers=0,
+                        codecs=None, min_bitrate=0, max_bitrate=0, keyframe_interval=0,
+                        idle_fps=0, idle_after=2.0, world_file=None, world_objects=0, world_size=(20000, 15000), world_seed=0):
     client_id = service_id + "-client"
-    token = await login({"server_url": "https://hypha.aicell.io",})
+    scan_settings["directory"] = scan_dir
+    stream_recorder.directory = record_dir
+    ice_server_cache.path = ice_cache
+    ice_server_cache.ttl = ice_ttl
+    update_encoder_settings(
+        encoder_defaults, codecs=codecs, min_bitrate=min_bitrate, max_bitrate=max_bitrate, keyframe_interval=keyframe_interval
+    )
+    if world_file:
+        set_specimen_world(load_world(world_file))
+    elif world_objects:
+        set_specimen_world(generate_world(world_objects, *world_size, seed=world_seed))
+    producer_options = {
+        "pixel_format": pixel_format, "width": width, "height": height, "fps": fps, "adaptive": adaptive,
+        "render_workers": render_workers, "render_mode": render_mode, "pipeline_depth": pipeline_depth,
+        "idle_fps": idle_fps, "idle_after": idle_after,
+    }
+    stage_controller.rate = stage_rate
+    stage_controller.start()
+    if workers:
+        # The main process only renders stills, scans and recordings
+        configure_producer(pixel_format, width, height, fps, adaptive, idle_fps=idle_fps, idle_after=idle_after)
+        start_workers(workers, producer_options)
+    else:
+        configure_producer(**producer_options)
+    index_page.refresh()
+    if local:
+        await serve_local(local_host, local_port)
+        return
+    startup = time.perf_counter()
+    phases = {}
+    # The ICE servers don't depend on the Hypha connection, get them while logging in
+    ice_servers = asyncio.ensure_future(timed(phases, "ice_servers", ice_server_cache.get()))
+    token = await timed(phases, "login", login({"server_url": "https://hypha.aicell.io",}))
     print(f"Starting service...")
-    server = await connect_to_server(
+    server = await timed(phases, "connect", connect_to_server(
         {
             "client_id": client_id,
             "server_url": "https://hypha.aicell.io",
             "workspace": workspace,
             "token": token,
         }
-    )
-    
-    # Register the FastAPI web app service
-    web_app_info = await server.register_service({
-        "id": "webrtc-demo-app",
-        "name": "WebRTC Demo App",
-        "type": "asgi",
-        "serve": serve_fastapi,
-        "config": {"visibility": "public", "require_context": True}
-    })
-    
-    print(f"Web app available at: https://hypha.aicell.io/{server.config.workspace}/apps/{web_app_info['id'].split(':')[1]}")
-    
-    async def on_init(peer_connection):
-        print("WebRTC peer connection initialized on server side")
-        
-        @peer_connection.on("connectionstatechange")
-        async def on_connectionstatechange():
-            print(f"Connection state changed to: {peer_connection.connectionState}")
-        
-        @peer_connection.on("track")
-        def on_track(track):
-            print(f"Track {track.kind} received from client")
-            video_track = VideoTransformTrack()
-            
-            # Add track - aiortc will handle the encoding parameters automatically
-            peer_connection.addTrack(video_track)
-            print(f"Added VideoTransformTrack to peer connection")
-            
-            @track.on("ended")
-            async def on_ended():
-                print(f"Client track {track.kind} ended")
-                video_track.running = False
-
-    # Fetch ICE servers
-    ice_servers = await fetch_ice_servers()
-    if not ice_servers:
-        print("Using fallback ICE servers")
-        ice_servers = [{"urls": ["stun:stun.l.google.com:19302"]}]
-
-    await register_rtc_service(
-        server,
-        service_id=service_id,
-        config={
-            "visibility": "public",
-            "ice_servers": ice_servers,
-            "on_init": on_init,
-        },
-    )
+    ))
     
-    def move(value, axis, is_absolute=True, is_blocking=True, context=None):
-        """Move the microscope position"""
-        print(f"Move command: {value} on {axis} axis (absolute: {is_absolute})")
-        
-        # Store previous target to detect new commands
-        prev_target_x = microscope_state["target_x"]
-        prev_target_y = microscope_state["target_y"]
-        
-        if axis.upper() == 'X':
-            if is_absolute:
-                microscope_state["target_x"] = max(0, min(480, value))
-            else:
-                microscope_state["target_x"] = max(0, min(480, microscope_state["target_x"] + value))
-        elif axis.upper() == 'Y':
-            if is_absolute:
-                microscope_state["target_y"] = max(0, min(360, value))
-            else:
-                microscope_state["target_y"] = max(0, min(360, microscope_state["target_y"] + value))
-        
-        # Check if target changed significantly to apply initial velocity boost
-        target_changed_x = abs(microscope_state["target_x"] - prev_target_x) > 1
-        target_changed_y = abs(microscope_state["target_y"] - prev_target_y) > 1
-        
-        if target_changed_x or target_changed_y:
-            # Calculate direction to new target
-            dx = microscope_state["target_x"] - microscope_state["x"]
-            dy = microscope_state["target_y"] - microscope_state["y"]
-            distance = np.sqrt(dx*dx + dy*dy)
-            
-            if distance > 0:
-                # Apply initial velocity boost in direction of movement
-                boost_strength = min(8.0, distance * 0.4)  # Scale boost with distance
-                dir_x = dx / distance
-                dir_y = dy / distance
-                
-                # Add velocity boost (this makes movement start quickly)
-                microscope_state["velocity_x"] += dir_x * boost_strength
-                microscope_state["velocity_y"] += dir_y * boost_strength
-                
-                # Limit the velocity to prevent overshooting
-                vel_magnitude = np.sqrt(
-                    microscope_state["velocity_x"]**2 + microscope_state["velocity_y"]**2
-                )
-                if vel_magnitude > microscope_state["max_velocity"]:
-                    scale = microscope_state["max_velocity"] / vel_magnitude
-                    microscope_state["velocity_x"] *= scale
-                    microscope_state["velocity_y"] *= scale
-        
-        print(f"New target position: ({microscope_state['target_x']}, {microscope_state['target_y']})")
-        print(f"Current velocity: ({microscope_state['velocity_x']:.2f}, {microscope_state['velocity_y']:.2f})")
-        return {"x": microscope_state["target_x"], "y": microscope_state["target_y"]}
+    # The RTC service reads its config on every offer, so refreshed TURN
+    # credentials apply to the following connections
+    rtc_config = {
+        "visibility": "public",
+        "on_init": on_init,
+    }
+    async def register_rtc():
+        rtc_config["ice_servers"] = await ice_servers
+        if worker_pool is None:
+            await register_rtc_service(server, service_id=service_id, config=rtc_config)
+            return
+        # Hand every peer to a worker process instead of answering here
+        del rtc_config["on_init"]
+        async def offer(params):
+            return await worker_pool.offer(
+                params=params, ice_servers=rtc_config["ice_servers"], workspace=server.config.workspace
+            )
+        await server.register_service({"id": service_id, "config": rtc_config, "offer": offer})
     
-    def get_position(context=None):
-        """Get current microscope position"""
-        return {"x": microscope_state["x"], "y": microscope_state["y"]}
+    def update_ice_servers(refreshed):
+        rtc_config["ice_servers"] = refreshed
+        print("Updated the ICE servers of the RTC service")
     
-    def snap(context=None):
-        print("snap an image")
-        return {"status": "image captured", "position": {"x": microscope_state["x"], "y": microscope_state["y"]}}
-        
-    await server.register_service(
-        {
-            "id": "microscope-control",
-            "config":{
-                "visibility": "public",
-                "run_in_executor": True,
-                "require_context": True,   
-            },
-            "type": "echo",
-            "move": move,
-            "get_position": get_position,
-            "snap": snap
-        }
+    # The services are independent of each other, register them concurrently
+    web_app_info, _, _ = await asyncio.gather(
+        timed(phases, "register_web_app", server.register_service({
+            "id": "webrtc-demo-app",
+            "name": "WebRTC Demo App",
+            "type": "asgi",
+            "serve": serve_fastapi,
+            "config": {"visibility": "public", "require_context": True}
+        })),
+        timed(phases, "register_rtc", register_rtc()),
+        timed(phases, "register_control", server.register_service(create_control_service())),
     )
+    ice_server_cache.start_refresh(update_ice_servers)
+    report = ", ".join(f"{name} {seconds:.2f}s" for name, seconds in phases.items())
+    print(f"Startup took {time.perf_counter() - startup:.2f}s ({report})")
     
+    print(f"Web app available at: https://hypha.aicell.io/{server.config.workspace}/apps/{web_app_info['id'].split(':')[1]}")
     print(
         f"Service (client_id={client_id}, service_id={service_id}) started successfully, available at https://hypha.aicell.io/{server.config.workspace}/services"
     )
@@ -478,11 +819,42 @@ async def start_service(service_id, workspace=None, token=None):
     # Keep the server running
     await server.serve()
 
+def parse_size(value):
+    width, height = value.lower().split("x")
+    return float(width), float(height)
+
 async def main():
     parser = argparse.ArgumentParser(
         description="WebRTC demo for video streaming"
     )
     parser.add_argument("--service-id", type=str, default="aiortc-demo", help="The service id")
+    parser.add_argument("--stage-rate", type=float, default=240, help="Stage physics update rate in Hz")
+    parser.add_argument("--render-workers", type=int, default=0, help="Render frames in a worker pool of this size (0 renders on the event loop)")
+    parser.add_argument("--render-mode", choices=["thread", "process"], default="thread", help="Kind of render worker pool")
+    parser.add_argument("--pipeline-depth", type=int, default=2, help="Number of frames rendered ahead by the worker pool")
+    parser.add_argument("--pixel-format", choices=["yuv420p", "bgr24"], default="yuv420p", help="Composite frames directly in yuv420p, or in bgr24 converted by the encoder")
+    parser.add_argument("--width", type=int, default=480, help="Stream width in pixels (even)")
+    parser.add_argument("--height", type=int, default=360, help="Stream height in pixels (even)")
+    parser.add_argument("--fps", type=int, default=30, help="Stream frame rate")
+    parser.add_argument("--adaptive", action=argparse.BooleanOptionalAction, default=True, help="Lower resolution and frame rate automatically when rendering falls behind")
+    parser.add_argument("--idle-fps", type=int, default=0, help="Frame rate while the stage is at rest (0 always streams at --fps)")
+    parser.add_argument("--idle-after", type=float, default=2.0, help="Seconds the stage has to be at rest before the stream drops to --idle-fps")
+    parser.add_argument("--local", action="store_true", help="Serve on a built-in loopback signalling endpoint instead of hypha.aicell.io")
+    parser.add_argument("--local-host", type=str, default="127.0.0.1", help="Host of the local signalling endpoint")
+    parser.add_argument("--local-port", type=int, default=9527, help="Port of the local signalling endpoint")
+    parser.add_argument("--world-file", type=str, default=None, help="Load the specimen slide from a .json or .npz file")
+    parser.add_argument("--world-objects", type=int, default=0, help="Generate a procedural slide with this many objects")
+    parser.add_argument("--world-size", type=parse_size, default=(20000, 15000), help="Size of the generated slide in stage units, WIDTHxHEIGHT")
+    parser.add_argument("--world-seed", type=int, default=0, help="Random seed of the generated slide")
+    parser.add_argument("--scan-dir", type=str, default="scans", help="Directory scan() writes its mosaics to")
+    parser.add_argument("--workers", type=int, default=0, help="Stream from this many worker processes, each with its own share of the peers (0 streams from the main process)")
+    parser.add_argument("--ice-cache", type=str, default="ice_servers.json", help="File the fetched ICE servers are cached in across restarts")
+    parser.add_argument("--ice-ttl", type=float, default=3600, help="Seconds before cached ICE servers (and their TURN credentials) are refreshed")
+    parser.add_argument("--record-dir", type=str, default="recordings", help="Directory start_recording() writes its video segments to")
+    parser.add_argument("--codecs", type=str, default=None, help="Video codecs in order of preference, e.g. h264,vp8 (default: the order of the offer)")
+    parser.add_argument("--min-bitrate", type=int, default=0, help="Lowest video bitrate in bits per second (0 keeps aiortc's limit for the codec)")
+    parser.add_argument("--max-bitrate", type=int, default=0, help="Highest video bitrate in bits per second (0 keeps aiortc's limit for the codec)")
+    parser.add_argument("--keyframe-interval", type=int, default=0, help="Force a keyframe every this many frames (0 only when the receiver asks)")
     parser.add_argument("--verbose", "-v", action="count")
     args = parser.parse_args()
 
@@ -495,6 +867,33 @@ async def main():
         args.service_id,
         workspace=None,
         token=None,
+        stage_rate=args.stage_rate,
+        render_workers=args.render_workers,
+        render_mode=args.render_mode,
+        pipeline_depth=args.pipeline_depth,
+        pixel_format=args.pixel_format,
+        width=args.width,
+        height=args.height,
+        fps=args.fps,
+        adaptive=args.adaptive,
+        idle_fps=args.idle_fps,
+        idle_after=args.idle_after,
+        local=args.local,
+        local_host=args.local_host,
+        local_port=args.local_port,
+        scan_dir=args.scan_dir,
+        record_dir=args.record_dir,
+        ice_cache=args.ice_cache,
+        ice_ttl=args.ice_ttl,
+        workers=args.workers,
+        codecs=args.codecs,
+        min_bitrate=args.min_bitrate,
+        max_bitrate=args.max_bitrate,
+        keyframe_interval=args.keyframe_interval,
+        world_file=args.world_file,
+        world_objects=args.world_objects,
+        world_size=args.world_size,
+        world_seed=args.world_seed,
     )
 
 if __name__ == "__main__":
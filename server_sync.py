@@ -1,7 +1,9 @@
 import argparse
+import asyncio
 import fractions
 import logging
 import numpy as np
+import threading
 import time
 import requests
 from av import VideoFrame
@@ -47,26 +49,81 @@ microscope_state = {
     ]
 }
 
-class VideoTransformTrack(MediaStreamTrack):
+# Serialises the move RPCs, which run in executor threads, against the frame
+# loop; position and target are only read or written in pairs under it
+state_lock = threading.Lock()
+
+# Frame rate of the stream
+STREAM_FPS = 30
+
+# Monotonic time of frame 0, shared so all tracks show the same frame numbers
+stream_clock = {"start": None}
+
+class FrameRenderer:
     """
-    A video stream track that transforms frames from an another track.
+    Renders the 480x360 microscope view without per-frame allocations.
+
+    The vignette and a small pool of noise textures are computed once, and
+    frames are composited into preallocated buffers. Each frame number is
+    rendered only once, tracks asking for the same frame share it.
     """
 
-    kind = "video"
+    def __init__(self, width=480, height=360, noise_textures=8, noise_margin=32):
+        self.width = width
+        self.height = height
+        self.noise_margin = noise_margin
 
-    def __init__(self):
-        super().__init__()  # don't forget this!
-        self.count = 0
-        self.running = True
-        self.start_time = None
-        print("VideoTransformTrack initialized")
+        # Distance from center for vignette effect
+        y_grad, x_grad = np.ogrid[:height, :width]
+        center_x, center_y = width // 2, height // 2
+        distance = np.sqrt((x_grad - center_x)**2 + (y_grad - center_y)**2)
+        max_distance = np.sqrt(center_x**2 + center_y**2)
+        self.vignette = (1 - (distance / max_distance) * 0.3).astype(np.float32)
+
+        # Ring buffer of slightly oversized noise textures; frames cycle through
+        # them at a varying offset, so the texture doesn't visibly repeat
+        rng = np.random.default_rng()
+        self.noise_pool = rng.normal(
+            0, 10, (noise_textures, height + noise_margin, width + noise_margin)
+        ).astype(np.float32)
+
+        self.background = np.empty((height, width), dtype=np.float32)
+        self.channel = np.empty((height, width), dtype=np.float32)
+        self.img = np.empty((height, width, 3), dtype=np.uint8)
+        self.disc_masks = {}
+        self.frames_rendered = 0
+        self.last_count = None
+        self.last_frame = None
+
+    def noise(self, count):
+        """Noise texture of frame `count`: a view into the noise pool"""
+        texture = self.noise_pool[count % len(self.noise_pool)]
+        # Offset by a different amount every cycle through the pool
+        cycle = count // len(self.noise_pool)
+        offset_y = (cycle * 7) % self.noise_margin
+        offset_x = (cycle * 13) % self.noise_margin
+        return texture[offset_y:offset_y + self.height, offset_x:offset_x + self.width]
+
+    def disc_mask(self, radius):
+        """Boolean mask of a filled circle of `radius` on its (2r+1)x(2r+1) bounding box"""
+        mask = self.disc_masks.get(radius)
+        if mask is None:
+            offsets = np.arange(-radius, radius + 1)
+            mask = self.disc_masks[radius] = offsets[:, None]**2 + offsets[None, :]**2 <= radius**2
+        return mask
 
     def draw_circle(self, img, center_x, center_y, radius, color):
-        """Draw a filled circle on the image"""
+        """Draw a filled circle on the image, only touching its bounding box"""
+        if radius < 0:
+            return
         height, width = img.shape[:2]
-        y, x = np.ogrid[:height, :width]
-        mask = (x - center_x)**2 + (y - center_y)**2 <= radius**2
-        img[mask] = color
+        x0, x1 = max(0, center_x - radius), min(width, center_x + radius + 1)
+        y0, y1 = max(0, center_y - radius), min(height, center_y + radius + 1)
+        if x0 >= x1 or y0 >= y1:
+            return
+        mask = self.disc_mask(radius)
+        mask = mask[y0 - center_y + radius:y1 - center_y + radius, x0 - center_x + radius:x1 - center_x + radius]
+        img[y0:y1, x0:x1][mask] = color
 
     def draw_crosshair(self, img, center_x, center_y, size=20, color=[255, 255, 255]):
         """Draw a crosshair at the specified position"""
@@ -84,125 +141,147 @@ class VideoTransformTrack(MediaStreamTrack):
             end_y = min(height, center_y + size)
             img[start_y:end_y, center_x] = color
 
+    def render(self, count):
+        """Return the VideoFrame of frame number `count`"""
+        if count == self.last_count:
+            return self.last_frame
+
+        # Smooth movement towards target position, once per frame
+        with state_lock:
+            microscope_state["x"] += (microscope_state["target_x"] - microscope_state["x"]) * 0.1
+            microscope_state["y"] += (microscope_state["target_y"] - microscope_state["y"]) * 0.1
+            stage_x, stage_y = microscope_state["x"], microscope_state["y"]
+        
+        # Generate a frame with microscope view simulation
+        t = count / STREAM_FPS  # time in seconds
+        height, width = self.height, self.width
+        center_x, center_y = width // 2, height // 2
+        
+        # Base background with slight texture
+        base_intensity = 40 + 20 * np.sin(t * 0.5)
+        background = self.background
+        np.add(self.noise(count), base_intensity, out=background)
+        background *= self.vignette
+        
+        img = self.img
+        for index, tint in enumerate((0.8, 0.9, 1.0)):  # Slight blue tint
+            np.multiply(background, tint, out=self.channel)
+            np.clip(self.channel, 0, 255, out=self.channel)
+            img[:, :, index] = self.channel
+        
+        # Calculate view offset based on microscope position
+        view_offset_x = int(stage_x - center_x)
+        view_offset_y = int(stage_y - center_y)
+        
+        # Draw objects that move relative to microscope position
+        for obj in microscope_state["objects"]:
+            # Calculate object position relative to current view
+            obj_x = obj["x"] - view_offset_x
+            obj_y = obj["y"] - view_offset_y
+            
+            # Add some floating motion to simulate living cells
+            float_x = obj_x + 5 * np.sin(t * 2 + obj["x"] * 0.01)
+            float_y = obj_y + 3 * np.cos(t * 1.5 + obj["y"] * 0.01)
+            
+            # Only draw if object is visible in current view
+            if -obj["size"] <= float_x <= width + obj["size"] and -obj["size"] <= float_y <= height + obj["size"]:
+                # Add pulsing effect
+                pulse = 1 + 0.2 * np.sin(t * 3 + obj["x"] * 0.02)
+                size = int(obj["size"] * pulse)
+                
+                # Draw object with glow effect
+                for glow_size in range(size + 10, size - 1, -2):
+                    alpha = 0.3 * (1 - (glow_size - size) / 10)
+                    glow_color = [int(c * alpha) for c in obj["color"]]
+                    self.draw_circle(img, int(float_x), int(float_y), glow_size, glow_color)
+                
+                # Draw main object
+                self.draw_circle(img, int(float_x), int(float_y), size, obj["color"])
+        
+        # Draw microscope crosshair at center
+        self.draw_crosshair(img, center_x, center_y, 15, [255, 255, 255])
+        
+        # Add measurement grid
+        grid_spacing = 50
+        grid_color = [80, 80, 80]
+        for i in range(0, width, grid_spacing):
+            if i % (grid_spacing * 2) == 0:  # Major grid lines
+                img[:, i:i+1] = grid_color
+        for i in range(0, height, grid_spacing):
+            if i % (grid_spacing * 2) == 0:  # Major grid lines
+                img[i:i+1, :] = grid_color
+        
+        # Add position indicator
+        pos_text_area = img[10:35, 10:200]
+        pos_text_area[:] = [0, 0, 0]  # Black background
+        
+        # Add coordinate display as colored bars
+        x_bar_length = int((stage_x / 480) * 180)
+        y_bar_length = int((stage_y / 360) * 180)
+        
+        if x_bar_length > 0:
+            img[15:20, 15:15+x_bar_length] = [255, 100, 100]  # Red for X
+        if y_bar_length > 0:
+            img[25:30, 15:15+y_bar_length] = [100, 255, 100]  # Green for Y
+        
+        # Add frame counter
+        frame_indicator = count % 60
+        indicator_width = int((frame_indicator / 60) * 100)
+        img[height-15:height-10, width-110:width-110+indicator_width] = [100, 100, 255]
+        
+        # from_ndarray copies the pixels, so the buffer can be reused right away
+        new_frame = VideoFrame.from_ndarray(img, format="bgr24")
+        
+        # Use proper timing based on frame count
+        new_frame.pts = count
+        new_frame.time_base = fractions.Fraction(1, STREAM_FPS)
+        
+        if count % 90 == 0:  # Log every 3 seconds
+            print(f"FrameRenderer: Frame {count}, Microscope pos: ({stage_x:.1f}, {stage_y:.1f})")
+        
+        self.frames_rendered += 1
+        self.last_count, self.last_frame = count, new_frame
+        return new_frame
+
+frame_renderer = FrameRenderer()
+
+class VideoTransformTrack(MediaStreamTrack):
+    """
+    A video stream track that transforms frames from an another track.
+    """
+
+    kind = "video"
+
+    def __init__(self, paced=True):
+        super().__init__()  # don't forget this!
+        self.count = 0
+        self.running = True
+        self.paced = paced  # Unpaced tracks return frames as fast as they are pulled
+        print("VideoTransformTrack initialized")
+
     async def recv(self):
         if not self.running:
             print("VideoTransformTrack: recv() called but track is not running")
             raise Exception("Track stopped")
             
         try:
-            # Initialize start time on first frame
-            if self.start_time is None:
-                self.start_time = time.time()
-            
-            # Calculate proper timing
-            current_time = time.time()
-            elapsed = current_time - self.start_time
-            expected_frame = int(elapsed * 30)  # 30 FPS
-            
-            # Skip frames if we're behind, or wait if we're ahead
-            if self.count < expected_frame:
-                self.count = expected_frame
-            elif self.count > expected_frame:
-                time.sleep((self.count - expected_frame) / 30.0)
-            
-            # Smooth movement towards target position
-            microscope_state["x"] += (microscope_state["target_x"] - microscope_state["x"]) * 0.1
-            microscope_state["y"] += (microscope_state["target_y"] - microscope_state["y"]) * 0.1
-            
-            # Generate a frame with microscope view simulation
-            t = self.count / 30.0  # time in seconds
-            
-            # Create a 480x360 frame
-            height, width = 360, 480
-            
-            # Create a gradient background that simulates microscope lighting
-            y_grad, x_grad = np.ogrid[:height, :width]
-            center_x, center_y = width // 2, height // 2
-            
-            # Distance from center for vignette effect
-            distance = np.sqrt((x_grad - center_x)**2 + (y_grad - center_y)**2)
-            max_distance = np.sqrt(center_x**2 + center_y**2)
-            vignette = 1 - (distance / max_distance) * 0.3
-            
-            # Base background with slight texture
-            noise = np.random.normal(0, 10, (height, width))
-            base_intensity = 40 + 20 * np.sin(t * 0.5)
-            background = (base_intensity + noise) * vignette
-            
-            img = np.zeros((height, width, 3), dtype=np.uint8)
-            img[:, :, 0] = np.clip(background * 0.8, 0, 255)  # Slight blue tint
-            img[:, :, 1] = np.clip(background * 0.9, 0, 255)
-            img[:, :, 2] = np.clip(background, 0, 255)
-            
-            # Calculate view offset based on microscope position
-            view_offset_x = int(microscope_state["x"] - center_x)
-            view_offset_y = int(microscope_state["y"] - center_y)
-            
-            # Draw objects that move relative to microscope position
-            for obj in microscope_state["objects"]:
-                # Calculate object position relative to current view
-                obj_x = obj["x"] - view_offset_x
-                obj_y = obj["y"] - view_offset_y
+            if self.paced:
+                # Initialize the stream clock on the first frame of any track
+                if stream_clock["start"] is None:
+                    stream_clock["start"] = time.monotonic()
                 
-                # Add some floating motion to simulate living cells
-                float_x = obj_x + 5 * np.sin(t * 2 + obj["x"] * 0.01)
-                float_y = obj_y + 3 * np.cos(t * 1.5 + obj["y"] * 0.01)
+                # Calculate proper timing
+                elapsed = time.monotonic() - stream_clock["start"]
+                expected_frame = int(elapsed * STREAM_FPS)
                 
-                # Only draw if object is visible in current view
-                if -obj["size"] <= float_x <= width + obj["size"] and -obj["size"] <= float_y <= height + obj["size"]:
-                    # Add pulsing effect
-                    pulse = 1 + 0.2 * np.sin(t * 3 + obj["x"] * 0.02)
-                    size = int(obj["size"] * pulse)
-                    
-                    # Draw object with glow effect
-                    for glow_size in range(size + 10, size - 1, -2):
-                        alpha = 0.3 * (1 - (glow_size - size) / 10)
-                        glow_color = [int(c * alpha) for c in obj["color"]]
-                        self.draw_circle(img, int(float_x), int(float_y), glow_size, glow_color)
-                    
-                    # Draw main object
-                    self.draw_circle(img, int(float_x), int(float_y), size, obj["color"])
-            
-            # Draw microscope crosshair at center
-            self.draw_crosshair(img, center_x, center_y, 15, [255, 255, 255])
-            
-            # Add measurement grid
-            grid_spacing = 50
-            grid_color = [80, 80, 80]
-            for i in range(0, width, grid_spacing):
-                if i % (grid_spacing * 2) == 0:  # Major grid lines
-                    img[:, i:i+1] = grid_color
-            for i in range(0, height, grid_spacing):
-                if i % (grid_spacing * 2) == 0:  # Major grid lines
-                    img[i:i+1, :] = grid_color
-            
-            # Add position indicator
-            pos_text_area = img[10:35, 10:200]
-            pos_text_area[:] = [0, 0, 0]  # Black background
-            
-            # Add coordinate display as colored bars
-            x_bar_length = int((microscope_state["x"] / 480) * 180)
-            y_bar_length = int((microscope_state["y"] / 360) * 180)
-            
-            if x_bar_length > 0:
-                img[15:20, 15:15+x_bar_length] = [255, 100, 100]  # Red for X
-            if y_bar_length > 0:
-                img[25:30, 15:15+y_bar_length] = [100, 255, 100]  # Green for Y
-            
-            # Add frame counter
-            frame_indicator = self.count % 60
-            indicator_width = int((frame_indicator / 60) * 100)
-            img[height-15:height-10, width-110:width-110+indicator_width] = [100, 100, 255]
-            
-            new_frame = VideoFrame.from_ndarray(img, format="bgr24")
-            
-            # Use proper timing based on frame count
-            new_frame.pts = self.count
-            new_frame.time_base = fractions.Fraction(1, 30)  # 30 FPS
-            
-            if self.count % 90 == 0:  # Log every 3 seconds
-                print(f"VideoTransformTrack: Frame {self.count}, Microscope pos: ({microscope_state['x']:.1f}, {microscope_state['y']:.1f})")
+                # Skip frames if we're behind, or wait if we're ahead. This
+                # runs on the event loop serving every peer, so never block it
+                if self.count < expected_frame:
+                    self.count = expected_frame
+                elif self.count > expected_frame:
+                    await asyncio.sleep(stream_clock["start"] + self.count / STREAM_FPS - time.monotonic())
             
+            new_frame = frame_renderer.render(self.count)
             self.count += 1
             
             return new_frame
@@ -273,27 +352,30 @@ def start_service(service_id, workspace=None):
         """Move the microscope position"""
         print(f"Move command: {value} on {axis} axis (absolute: {is_absolute})")
         
-        if axis.upper() == 'X':
-            if is_absolute:
-                microscope_state["target_x"] = max(0, min(480, value))
-            else:
-                microscope_state["target_x"] = max(0, min(480, microscope_state["target_x"] + value))
-        elif axis.upper() == 'Y':
-            if is_absolute:
-                microscope_state["target_y"] = max(0, min(360, value))
-            else:
-                microscope_state["target_y"] = max(0, min(360, microscope_state["target_y"] + value))
+        with state_lock:
+            if axis.upper() == 'X':
+                if is_absolute:
+                    microscope_state["target_x"] = max(0, min(480, value))
+                else:
+                    microscope_state["target_x"] = max(0, min(480, microscope_state["target_x"] + value))
+            elif axis.upper() == 'Y':
+                if is_absolute:
+                    microscope_state["target_y"] = max(0, min(360, value))
+                else:
+                    microscope_state["target_y"] = max(0, min(360, microscope_state["target_y"] + value))
+            target = {"x": microscope_state["target_x"], "y": microscope_state["target_y"]}
         
-        print(f"New target position: ({microscope_state['target_x']}, {microscope_state['target_y']})")
-        return {"x": microscope_state["target_x"], "y": microscope_state["target_y"]}
+        print(f"New target position: ({target['x']}, {target['y']})")
+        return target
     
     def get_position(context=None):
         """Get current microscope position"""
-        return {"x": microscope_state["x"], "y": microscope_state["y"]}
+        with state_lock:
+            return {"x": microscope_state["x"], "y": microscope_state["y"]}
     
     def snap(context=None):
         print("snap an image")
-        return {"status": "image captured", "position": {"x": microscope_state["x"], "y": microscope_state["y"]}}
+        return {"status": "image captured", "position": get_position()}
         
     server.register_service(
         {
@@ -0,0 +1,153 @@
+"""
+Virtual specimen slide with a uniform grid index for viewport culling.
+"""
+import json
+import math
+import os
+
+import numpy as np
+
+# Scale of a specimen's pulse (see render.py) and its floating motion in stage units
+PULSE_SCALE = 1.15
+FLOAT_AMPLITUDE = 3.0
+
+
+class SpecimenWorld:
+    """
+    Specimen objects on a virtual slide, indexed by a uniform grid.
+
+    Object positions, sizes and colors are kept in flat arrays sorted by grid
+    cell, so the objects of a row of cells are one contiguous slice and a
+    viewport query only touches the cells it overlaps: the cost of culling
+    depends on what is near the view, not on the size of the slide.
+    Objects are dicts {"x", "y", "color", "size"} like the stage state's
+    "objects" list; `visible()` returns them in that form.
+    """
+
+    def __init__(self, objects=(), width=480, height=360, cell_size=128):
+        objects = list(objects)
+        self.width = width
+        self.height = height
+        self.cell_size = cell_size
+        self._set_arrays(
+            np.array([obj["x"] for obj in objects], dtype=np.float32),
+            np.array([obj["y"] for obj in objects], dtype=np.float32),
+            np.array([obj["size"] for obj in objects], dtype=np.float32),
+            np.array([obj["color"] for obj in objects], dtype=np.uint8).reshape(-1, 3),
+        )
+
+    @classmethod
+    def from_arrays(cls, x, y, size, color, width, height, cell_size=128):
+        world = cls(width=width, height=height, cell_size=cell_size)
+        world._set_arrays(
+            np.asarray(x, dtype=np.float32),
+            np.asarray(y, dtype=np.float32),
+            np.asarray(size, dtype=np.float32),
+            np.asarray(color, dtype=np.uint8).reshape(-1, 3),
+        )
+        return world
+
+    def __len__(self):
+        return len(self.x)
+
+    def _set_arrays(self, x, y, size, color):
+        self.cols = max(1, math.ceil(self.width / self.cell_size))
+        self.rows = max(1, math.ceil(self.height / self.cell_size))
+        cell_x = np.clip((x // self.cell_size).astype(np.int64), 0, self.cols - 1)
+        cell_y = np.clip((y // self.cell_size).astype(np.int64), 0, self.rows - 1)
+        cells = cell_y * self.cols + cell_x
+        order = np.argsort(cells, kind="stable")
+        self.x, self.y, self.size, self.color = x[order], y[order], size[order], color[order]
+        # Objects of cell i are [cell_starts[i], cell_starts[i + 1])
+        self.cell_starts = np.searchsorted(cells[order], np.arange(self.rows * self.cols + 1))
+        self.max_size = float(self.size.max()) if len(self.size) else 0.0
+
+    def add(self, objects):
+        """Add objects and rebuild the index"""
+        objects = list(objects)
+        self._set_arrays(
+            np.concatenate([self.x, np.array([obj["x"] for obj in objects], dtype=np.float32)]),
+            np.concatenate([self.y, np.array([obj["y"] for obj in objects], dtype=np.float32)]),
+            np.concatenate([self.size, np.array([obj["size"] for obj in objects], dtype=np.float32)]),
+            np.concatenate([self.color, np.array([obj["color"] for obj in objects], dtype=np.uint8).reshape(-1, 3)]),
+        )
+
+    def query(self, x0, y0, x1, y1):
+        """Indices of the objects with their center inside the rectangle [x0, x1] x [y0, y1]"""
+        size = self.cell_size
+        cell_x0, cell_x1 = max(0, int(x0 // size)), min(self.cols - 1, int(x1 // size))
+        cell_y0, cell_y1 = max(0, int(y0 // size)), min(self.rows - 1, int(y1 // size))
+        if cell_x0 > cell_x1 or cell_y0 > cell_y1:
+            return np.empty(0, dtype=np.int64)
+        row_cells = np.arange(cell_y0, cell_y1 + 1) * self.cols
+        starts = self.cell_starts[row_cells + cell_x0]
+        ends = self.cell_starts[row_cells + cell_x1 + 1]
+        candidates = np.concatenate([np.arange(start, end) for start, end in zip(starts, ends)])
+        x, y = self.x[candidates], self.y[candidates]
+        return candidates[(x >= x0) & (x <= x1) & (y >= y0) & (y <= y1)]
+
+    def visible(self, center_x, center_y, half_width, half_height):
+        """
+        The objects that can show up in a view of `half_width` x `half_height`
+        stage units around (center_x, center_y), including ones just outside
+        that reach into it with their size, pulse and floating motion
+        """
+        margin = self.max_size * PULSE_SCALE + FLOAT_AMPLITUDE
+        indices = self.query(
+            center_x - half_width - margin, center_y - half_height - margin,
+            center_x + half_width + margin, center_y + half_height + margin,
+        )
+        x, y, size, color = self.x[indices].tolist(), self.y[indices].tolist(), self.size[indices].tolist(), self.color[indices].tolist()
+        return [
+            {"x": x[i], "y": y[i], "color": color[i], "size": size[i]}
+            for i in range(len(indices))
+        ]
+
+
+def generate_world(count, width, height, seed=0, cell_size=128):
+    """
+    A procedural slide with `count` objects: most of them clumped in colonies,
+    the rest scattered evenly
+    """
+    rng = np.random.default_rng(seed)
+    clustered = int(count * 0.8)
+    colonies = max(1, clustered // 200)
+    centers = rng.uniform((0, 0), (width, height), size=(colonies, 2))
+    spread = rng.uniform(40, 250, size=colonies)
+    members = rng.integers(0, colonies, size=clustered)
+    positions = np.concatenate([
+        centers[members] + rng.normal(size=(clustered, 2)) * spread[members, None],
+        rng.uniform((0, 0), (width, height), size=(count - clustered, 2)),
+    ])
+    positions = np.clip(positions, 0, (width, height))
+    return SpecimenWorld.from_arrays(
+        positions[:, 0], positions[:, 1],
+        rng.integers(8, 36, size=count),
+        rng.integers(80, 256, size=(count, 3)),
+        width, height, cell_size,
+    )
+
+
+def load_world(path, cell_size=128):
+    """
+    Load a slide from a .json file, {"width", "height", "objects": [...]} or
+    a plain list of objects, or from a .npz file with x, y, size and color
+    arrays and optional width and height
+    """
+    extension = os.path.splitext(path)[1].lower()
+    if extension == ".npz":
+        with np.load(path) as data:
+            x, y = data["x"], data["y"]
+            width = float(data["width"]) if "width" in data else float(x.max(initial=0))
+            height = float(data["height"]) if "height" in data else float(y.max(initial=0))
+            return SpecimenWorld.from_arrays(x, y, data["size"], data["color"], width, height, cell_size)
+    if extension == ".json":
+        with open(path, "r") as file:
+            data = json.load(file)
+        if isinstance(data, list):
+            data = {"objects": data}
+        objects = data["objects"]
+        width = data.get("width", max((obj["x"] for obj in objects), default=0))
+        height = data.get("height", max((obj["y"] for obj in objects), default=0))
+        return SpecimenWorld(objects, width, height, cell_size)
+    raise ValueError(f"Unsupported specimen file {path!r}, use .json or .npz")
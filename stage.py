@@ -0,0 +1,443 @@
+"""
+Simulated microscope stage: physics and the fixed-timestep controller task.
+"""
+import asyncio
+import collections
+import math
+import time
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+# The physics constants in the stage state (damping, velocity in pixels per
+# step, ...) were tuned for one step per 30 fps frame
+PHYSICS_REFERENCE_RATE = 30.0
+
+# Distance at which a path moves on to its next waypoint without stopping
+WAYPOINT_TOLERANCE = 5.0
+
+# Immutable stage state published by the StageController after every change.
+# `time` is when the step producing (x, y) ran, (previous_x, previous_y) is the
+# position one step earlier, to interpolate between.
+StageSnapshot = collections.namedtuple("StageSnapshot", [
+    "version", "time", "previous_x", "previous_y", "x", "y",
+    "velocity_x", "velocity_y", "target_x", "target_y", "moving",
+])
+
+
+def step_physics(state, dt):
+    """Advance the stage physics in `state` by dt seconds"""
+    # Fraction of a reference frame covered by this step
+    steps = dt * PHYSICS_REFERENCE_RATE
+
+    # Physics-based movement with acceleration and deceleration
+    # Calculate distance to target
+    dx = state["target_x"] - state["x"]
+    dy = state["target_y"] - state["y"]
+    distance = math.hypot(dx, dy)
+
+    if distance > 0.1:  # Only apply forces if not at target
+        # Normalize direction vectors
+        dir_x = dx / distance
+        dir_y = dy / distance
+
+        # Calculate acceleration based on distance to target
+        # Stronger acceleration when far, weaker when close
+        acceleration_magnitude = min(
+            state["max_acceleration"],
+            distance * state["attraction_strength"]
+        )
+
+        # Update velocity with acceleration
+        state["velocity_x"] += dir_x * acceleration_magnitude * dt
+        state["velocity_y"] += dir_y * acceleration_magnitude * dt
+
+        # Apply damping to velocity for smooth deceleration
+        damping = state["damping"] ** steps
+        state["velocity_x"] *= damping
+        state["velocity_y"] *= damping
+
+        # Limit maximum velocity, or the speed of the current path if it is lower
+        max_velocity = state["max_velocity"]
+        if state.get("speed_limit"):
+            max_velocity = min(max_velocity, state["speed_limit"])
+        vel_magnitude = math.hypot(state["velocity_x"], state["velocity_y"])
+        if vel_magnitude > max_velocity:
+            scale = max_velocity / vel_magnitude
+            state["velocity_x"] *= scale
+            state["velocity_y"] *= scale
+
+        # Update position based on velocity
+        state["x"] += state["velocity_x"] * steps
+        state["y"] += state["velocity_y"] * steps
+
+        # Ensure position stays within bounds
+        state["x"] = max(0, min(state["stage_width"], state["x"]))
+        state["y"] = max(0, min(state["stage_height"], state["y"]))
+
+        # Stop very small movements to avoid jitter
+        if distance < 2.0 and vel_magnitude < 0.5:
+            state["x"] = state["target_x"]
+            state["y"] = state["target_y"]
+            state["velocity_x"] = 0.0
+            state["velocity_y"] = 0.0
+    else:
+        # At target, settle on it and zero out velocity
+        state["x"] = state["target_x"]
+        state["y"] = state["target_y"]
+        state["velocity_x"] = 0.0
+        state["velocity_y"] = 0.0
+
+
+def boost_towards_target(state, strength=0.4, max_boost=8.0):
+    """Kick the velocity towards the target so a new move starts quickly"""
+    dx = state["target_x"] - state["x"]
+    dy = state["target_y"] - state["y"]
+    distance = math.hypot(dx, dy)
+    if distance > 0:
+        # Apply initial velocity boost in direction of movement
+        boost_strength = min(max_boost, distance * strength)  # Scale boost with distance
+        state["velocity_x"] += dx / distance * boost_strength
+        state["velocity_y"] += dy / distance * boost_strength
+
+        # Limit the velocity to prevent overshooting, and to the speed of the path
+        max_velocity = state["max_velocity"]
+        if state.get("speed_limit"):
+            max_velocity = min(max_velocity, state["speed_limit"])
+        vel_magnitude = math.hypot(state["velocity_x"], state["velocity_y"])
+        if vel_magnitude > max_velocity:
+            scale = max_velocity / vel_magnitude
+            state["velocity_x"] *= scale
+            state["velocity_y"] *= scale
+
+
+def is_at_rest(state):
+    """Whether the stage sits on its target without moving"""
+    return (
+        state["x"] == state["target_x"]
+        and state["y"] == state["target_y"]
+        and state["velocity_x"] == 0.0
+        and state["velocity_y"] == 0.0
+    )
+
+
+def interpolate_pose(snapshot, rate, now=None):
+    """
+    The pose of `snapshot` interpolated between its last two physics steps
+    run at `rate` Hz (0 for the latest position), with the velocity, target,
+    moving flag and version of the snapshot
+    """
+    if now is None:
+        now = time.monotonic()
+    alpha = 1.0
+    if rate:
+        alpha = min(1.0, max(0.0, (now - snapshot.time) * rate))
+    return {
+        "x": snapshot.previous_x + (snapshot.x - snapshot.previous_x) * alpha,
+        "y": snapshot.previous_y + (snapshot.y - snapshot.previous_y) * alpha,
+        "velocity_x": snapshot.velocity_x,
+        "velocity_y": snapshot.velocity_y,
+        "target_x": snapshot.target_x,
+        "target_y": snapshot.target_y,
+        "moving": snapshot.moving,
+        "version": snapshot.version,
+    }
+
+
+class SharedStage:
+    """
+    StageSnapshots of the controller process in shared memory, for --workers.
+
+    The block holds a sequence number, the physics rate and the snapshot
+    fields as float64. The writer makes the sequence number odd while it
+    updates the fields, and readers copy them and start over if the number
+    was odd or changed meanwhile, so they never see a half-written
+    snapshot. `time` is time.monotonic(), which is the same clock in every
+    process. Pass the `name` of an existing block to attach to it.
+    """
+
+    def __init__(self, name=None):
+        self.owner = name is None
+        size = (2 + len(StageSnapshot._fields)) * 8
+        self.memory = shared_memory.SharedMemory(name=name, create=self.owner, size=size)
+        if not self.owner:
+            # The creating process unlinks the block, not every process attaching to it
+            resource_tracker.unregister(self.memory._name, "shared_memory")
+        self.values = np.ndarray(2 + len(StageSnapshot._fields), dtype=np.float64, buffer=self.memory.buf)
+
+    @property
+    def name(self):
+        return self.memory.name
+
+    def write(self, snapshot, rate):
+        values = self.values
+        values[0] += 1
+        values[1] = rate
+        values[2:] = snapshot
+        values[0] += 1
+
+    def read(self):
+        """Return (snapshot, rate)"""
+        values = self.values
+        while True:
+            sequence = values[0]
+            if sequence % 2 == 0:
+                copy = values.tolist()
+                if values[0] == sequence:
+                    break
+            time.sleep(0)
+        fields = copy[2:]
+        fields[0] = int(fields[0])
+        fields[-1] = bool(fields[-1])
+        return StageSnapshot(*fields), copy[1]
+
+    def close(self):
+        self.values = None
+        self.memory.close()
+        if self.owner:
+            self.memory.unlink()
+
+
+class SharedStageReader:
+    """
+    Read-only stand-in for the StageController in a worker process: poses,
+    snapshots and motion waits come from a SharedStage
+    """
+
+    def __init__(self, shared, poll_interval=1.0 / 60):
+        self.shared = shared
+        self.poll_interval = poll_interval
+
+    @property
+    def snapshot(self):
+        return self.shared.read()[0]
+
+    def pose(self, now=None):
+        snapshot, rate = self.shared.read()
+        return interpolate_pose(snapshot, rate, now)
+
+    async def wait_for_motion(self):
+        """Wait until the stage moves, polling the shared snapshot"""
+        while not self.snapshot.moving:
+            await asyncio.sleep(self.poll_interval)
+
+
+class StageController:
+    """
+    Advances the stage physics at a fixed rate on monotonic time.
+
+    The physics runs in its own asyncio task, independent of how often frames
+    are pulled by the encoders. While the stage is at rest the task sleeps
+    until `wake()` is called, e.g. by a new move command; other tasks can wait
+    for that with `wait_for_motion()`.
+
+    The task is the only writer of the stage state. After every step and
+    target change it publishes a new `StageSnapshot` in `snapshot`, with an
+    increasing version; replacing the attribute is atomic, so renderers and
+    RPCs on any thread read a consistent pose from it, or an interpolated
+    one from `pose()`, without locks.
+
+    Moves go through `move_to()` and `move_path()`, which replace the queue of
+    waypoints the stage follows. They can be called from any thread and are
+    applied in order on the controller's event loop. Intermediate waypoints
+    are passed without stopping, `wait_for_arrival()` resolves once the stage
+    has settled on the last one.
+    """
+
+    def __init__(self, state, rate=240.0, max_catchup=0.25):
+        self.state = state
+        self.rate = rate
+        self.max_catchup = max_catchup  # Seconds of backlog simulated at most
+        self.steps = 0
+        self.waypoints = collections.deque()
+        self._arrival_futures = []
+        self.snapshot = None
+        # SharedStage every snapshot is also written to, set with --workers
+        self.shared = None
+        self._task = None
+        self._previous = (state["x"], state["y"])
+        self._last_step_time = time.monotonic()
+        self._publish()
+        self._loop = None
+        self._wake_event = None
+        self._motion_event = None
+
+    @property
+    def running(self):
+        return self._task is not None and not self._task.done()
+
+    def start(self):
+        """Start the controller task on the running event loop"""
+        if self.running:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._wake_event = asyncio.Event()
+        self._motion_event = asyncio.Event()
+        self._motion_event.set()  # Cleared by the task once the stage is at rest
+        self._task = asyncio.ensure_future(self._run())
+        print(f"StageController: running physics at {self.rate:.0f} Hz")
+
+    async def stop(self):
+        if self.running:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self._task = None
+
+    def _on_loop(self):
+        """Whether the caller runs on the controller's event loop"""
+        try:
+            return asyncio.get_running_loop() is self._loop
+        except RuntimeError:
+            return False
+
+    def _submit(self, func, *args):
+        """Run a state change on the controller's loop, the only writer of the state"""
+        if self._loop is None or self._on_loop():
+            func(*args)
+        elif not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(func, *args)
+
+    def wake(self):
+        """Resume stepping after a target change; safe to call from any thread"""
+        if self._loop is None or self._loop.is_closed():
+            return
+        self._submit(self._set_moving)
+
+    def _set_moving(self):
+        self._wake_event.set()
+        self._motion_event.set()
+
+    async def wait_for_motion(self):
+        """Wait until the stage is woken up to move, return at once if it is moving"""
+        if self._motion_event is None:
+            raise RuntimeError("StageController is not started")
+        await self._motion_event.wait()
+
+    def move_to(self, x, y, speed=None):
+        """Move to (x, y), replacing any queued path"""
+        self.move_path([(x, y)], speed)
+
+    def move_path(self, waypoints, speed=None):
+        """
+        Follow `waypoints` [(x, y), ...] in order, replacing any queued path.
+
+        `speed` limits the stage velocity along the path, in stage units per
+        second. Waypoints are clamped to the stage extents.
+        """
+        if not waypoints:
+            raise ValueError("A path needs at least one waypoint")
+        waypoints = [
+            (max(0, min(self.state["stage_width"], x)), max(0, min(self.state["stage_height"], y)))
+            for x, y in waypoints
+        ]
+        self._submit(self._start_path, waypoints, speed)
+
+    def _start_path(self, waypoints, speed):
+        self.state["speed_limit"] = speed / PHYSICS_REFERENCE_RATE if speed else None
+        self.waypoints = collections.deque(waypoints[1:])
+        self._set_target(*waypoints[0], boost=True)
+        self._publish()
+        self.wake()
+
+    def reset(self, x, y):
+        """Place the stage at rest at (x, y) without moving there, e.g. for a new slide"""
+        self._submit(self._reset, x, y)
+
+    def _reset(self, x, y):
+        state = self.state
+        state["x"] = state["target_x"] = x
+        state["y"] = state["target_y"] = y
+        state["velocity_x"] = state["velocity_y"] = 0.0
+        self.waypoints.clear()
+        self._previous = (x, y)
+        self._publish()
+        self.wake()
+
+    async def wait_for_arrival(self):
+        """Wait until the stage has settled at the end of its path, return the position"""
+        if is_at_rest(self.state) and not self.waypoints:
+            return {"x": self.state["x"], "y": self.state["y"]}
+        future = asyncio.get_running_loop().create_future()
+        self._arrival_futures.append(future)
+        return await future
+
+    def _set_target(self, x, y, boost=False):
+        state = self.state
+        # Only boost for a target that changed significantly
+        changed = abs(x - state["target_x"]) > 1 or abs(y - state["target_y"]) > 1
+        state["target_x"], state["target_y"] = x, y
+        if boost and changed:
+            boost_towards_target(state)
+
+    def _next_waypoint(self):
+        self._set_target(*self.waypoints.popleft())
+
+    def _arrived(self):
+        """Resolve the arrival waiters once the path is done"""
+        self.state["speed_limit"] = None
+        position = {"x": self.state["x"], "y": self.state["y"]}
+        futures, self._arrival_futures = self._arrival_futures, []
+        for future in futures:
+            if not future.done():
+                future.set_result(position)
+
+    def pose(self, now=None):
+        """
+        Return the stage pose interpolated between the last two physics steps,
+        with the velocity, target, moving flag and version of the snapshot it
+        was computed from
+        """
+        return interpolate_pose(self.snapshot, self.rate if self.running else 0, now)
+
+    def _publish(self):
+        """Replace the snapshot with the current state"""
+        state = self.state
+        version = self.snapshot.version + 1 if self.snapshot is not None else 0
+        self.snapshot = StageSnapshot(
+            version, self._last_step_time, self._previous[0], self._previous[1], state["x"], state["y"],
+            state["velocity_x"], state["velocity_y"], state["target_x"], state["target_y"],
+            bool(self.waypoints) or not is_at_rest(state),
+        )
+        if self.shared is not None:
+            self.shared.write(self.snapshot, self.rate if self.running else 0)
+
+    def _step(self, dt, step_time):
+        state = self.state
+        self._previous = (state["x"], state["y"])
+        step_physics(state, dt)
+        self._last_step_time = step_time
+        self.steps += 1
+        # Head for the next waypoint once the current one is close
+        if self.waypoints and math.hypot(state["target_x"] - state["x"], state["target_y"] - state["y"]) < WAYPOINT_TOLERANCE:
+            self._next_waypoint()
+        self._publish()
+
+    async def _run(self):
+        dt = 1.0 / self.rate
+        last = time.monotonic()
+        accumulator = 0.0
+        while True:
+            if is_at_rest(self.state) and self.waypoints:
+                self._next_waypoint()
+            elif is_at_rest(self.state):
+                self._arrived()
+                # Nothing to simulate until the target changes
+                self._previous = (self.state["x"], self.state["y"])
+                self._publish()
+                self._wake_event.clear()
+                if is_at_rest(self.state):
+                    self._motion_event.clear()
+                    await self._wake_event.wait()
+                last = time.monotonic()
+                accumulator = 0.0
+
+            now = time.monotonic()
+            accumulator = min(accumulator + now - last, self.max_catchup)
+            last = now
+            while accumulator >= dt:
+                self._step(dt, now - (accumulator - dt))
+                accumulator -= dt
+            await asyncio.sleep(dt - accumulator)
@@ -0,0 +1,107 @@
+"""
+Server-pushed stage position updates for subscribed clients.
+"""
+import asyncio
+import inspect
+import itertools
+import time
+
+# Fields of a position update and the number of decimals they are reported with
+POSITION_FIELDS = {
+    "x": 2,
+    "y": 2,
+    "velocity_x": 3,
+    "velocity_y": 3,
+    "target_x": 2,
+    "target_y": 2,
+}
+
+
+class PositionBroadcaster:
+    """
+    Pushes coalesced stage pose changes to subscribed callbacks.
+
+    A single task samples the StageController pose at the highest rate any
+    subscriber asked for, and sends each subscriber only the fields that
+    changed since its last update, at most `max_rate` times per second.
+    Updates that come in faster are coalesced into the next one, and a
+    subscriber whose previous update is still in flight is skipped until it
+    has been delivered. While the stage is at rest the task sleeps until the
+    controller is woken up again, so idle subscriptions cost nothing.
+    """
+
+    def __init__(self, controller, max_rate=60):
+        self.controller = controller
+        self.max_rate = max_rate
+        self.subscribers = {}
+        self._ids = itertools.count(1)
+        self._task = None
+
+    def current(self, pose=None):
+        """The current pose, velocity and target as a full update"""
+        if pose is None:
+            pose = self.controller.pose()
+        return {name: round(pose[name], digits) for name, digits in POSITION_FIELDS.items()}
+
+    def subscribe(self, callback, max_rate=30):
+        """
+        Register `callback(update)` and return (subscription_id, current state).
+
+        Updates are dicts with the changed fields plus "moving"; the returned
+        state is the baseline the first update is relative to.
+        """
+        state = self.current()
+        subscription_id = next(self._ids)
+        self.subscribers[subscription_id] = {
+            "callback": callback,
+            "interval": 1.0 / max(1.0, min(float(max_rate), self.max_rate)),
+            "last_sent": 0.0,
+            "state": state,
+            "sending": False,
+        }
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run())
+        print(f"PositionBroadcaster: subscriber {subscription_id} added ({len(self.subscribers)} active)")
+        return subscription_id, state
+
+    def unsubscribe(self, subscription_id):
+        if self.subscribers.pop(subscription_id, None) is not None:
+            print(f"PositionBroadcaster: subscriber {subscription_id} removed ({len(self.subscribers)} active)")
+
+    async def _send(self, subscription_id, subscriber, update):
+        try:
+            result = subscriber["callback"](update)
+            if inspect.isawaitable(result):
+                await result
+        except Exception as e:
+            # The client is gone, e.g. its peer connection closed
+            print(f"PositionBroadcaster: dropping subscriber {subscription_id}: {e}")
+            self.unsubscribe(subscription_id)
+        finally:
+            subscriber["sending"] = False
+
+    async def _run(self):
+        while self.subscribers:
+            pose = self.controller.pose()
+            state = self.current(pose)
+            moving = pose["moving"]
+            now = time.monotonic()
+            pending = False
+            for subscription_id, subscriber in list(self.subscribers.items()):
+                delta = {name: value for name, value in state.items() if subscriber["state"][name] != value}
+                if not delta:
+                    continue
+                if subscriber["sending"] or now - subscriber["last_sent"] < subscriber["interval"]:
+                    pending = True
+                    continue
+                delta["moving"] = moving
+                subscriber["state"] = state
+                subscriber["last_sent"] = now
+                subscriber["sending"] = True
+                asyncio.ensure_future(self._send(subscription_id, subscriber, delta))
+
+            if not moving and not pending:
+                # Everybody has the resting position, sleep until the stage moves again
+                await self.controller.wait_for_motion()
+            intervals = [subscriber["interval"] for subscriber in self.subscribers.values()]
+            await asyncio.sleep(min(intervals, default=0))
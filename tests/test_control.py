@@ -0,0 +1,54 @@
+import asyncio
+
+import pytest
+
+server = pytest.importorskip("server")
+
+
+def run_service(scenario):
+    """Run `scenario(service, controller)` against the control service with a started stage"""
+    async def run():
+        controller = server.stage_controller
+        controller.start()
+        controller.reset(240, 180)
+        try:
+            return await asyncio.wait_for(scenario(server.create_control_service(), controller), 10)
+        finally:
+            await controller.stop()
+
+    return asyncio.run(run())
+
+
+def test_blocking_move_returns_once_the_stage_arrived():
+    async def scenario(service, controller):
+        result = await service["move"](30, "x", is_absolute=False, is_blocking=True)
+        return result, controller.snapshot
+
+    result, snapshot = run_service(scenario)
+    assert result == {"x": 270, "y": 180}
+    assert (snapshot.x, snapshot.y, snapshot.moving) == (270, 180, False)
+
+
+def test_non_blocking_move_returns_while_moving():
+    async def scenario(service, controller):
+        result = await service["move"](200, "y", is_absolute=True, is_blocking=False)
+        moving = controller.snapshot.moving
+        await controller.wait_for_arrival()
+        return result, moving
+
+    result, moving = run_service(scenario)
+    assert result == {"x": 240, "y": 200}
+    assert moving
+
+
+def test_execute_runs_commands_in_order():
+    async def scenario(service, controller):
+        return await service["execute"]([
+            {"method": "move_to", "kwargs": {"x": 260, "y": 190}},
+            {"method": "get_position"},
+            {"method": "move_path", "kwargs": {"waypoints": [[250, 190], [250, 170]]}},
+            {"method": "get_position"},
+        ])
+
+    results = run_service(scenario)
+    assert results == [{"x": 260, "y": 190}, {"x": 260, "y": 190}, {"x": 250, "y": 170}, {"x": 250, "y": 170}]
@@ -0,0 +1,74 @@
+import types
+
+import numpy as np
+import pytest
+from aiortc.codecs import get_encoder
+from aiortc.rtcrtpparameters import RTCRtpCodecParameters
+from av import VideoFrame
+
+from encoding import DEFAULT_ENCODER_SETTINGS, PeerEncoder, install_encoder, prefer_codecs, update_encoder_settings
+from producer import VIDEO_TIME_BASE
+
+VP8 = RTCRtpCodecParameters(mimeType="video/VP8", clockRate=90000, payloadType=96)
+
+
+def video_frame():
+    frame = VideoFrame.from_ndarray(np.zeros((90 * 3 // 2, 120), dtype=np.uint8), format="yuv420p")
+    frame.pts = 3000
+    frame.time_base = VIDEO_TIME_BASE
+    return frame
+
+
+def test_update_encoder_settings_validates():
+    settings = dict(DEFAULT_ENCODER_SETTINGS)
+    update_encoder_settings(settings, codecs="H264, vp8", max_bitrate=800_000)
+    assert settings["codecs"] == ["h264", "vp8"]
+    with pytest.raises(ValueError):
+        update_encoder_settings(settings, codecs=["av1"])
+    with pytest.raises(ValueError):
+        update_encoder_settings(settings, min_bitrate=900_000)
+    assert settings["min_bitrate"] == 0
+
+
+def test_prefer_codecs_keeps_rtx_with_its_codec():
+    codecs = [
+        VP8,
+        RTCRtpCodecParameters(mimeType="video/rtx", clockRate=90000, payloadType=97, parameters={"apt": 96}),
+        RTCRtpCodecParameters(mimeType="video/H264", clockRate=90000, payloadType=98),
+        RTCRtpCodecParameters(mimeType="video/rtx", clockRate=90000, payloadType=99, parameters={"apt": 98}),
+    ]
+    transceiver = types.SimpleNamespace(_codecs=codecs)
+    prefer_codecs(transceiver, ["h264"])
+    assert [codec.payloadType for codec in transceiver._codecs] == [98, 99, 96, 97]
+
+
+def test_caps_go_past_aiortcs_limits():
+    settings = dict(DEFAULT_ENCODER_SETTINGS, min_bitrate=100_000, max_bitrate=2_000_000)
+    encoder = PeerEncoder(get_encoder(VP8), "vp8", settings)
+    encoder.target_bitrate = 50_000
+    assert encoder.target_bitrate == 100_000
+    encoder.target_bitrate = 5_000_000
+    assert encoder.target_bitrate == 2_000_000
+
+
+def test_forced_keyframes_are_counted():
+    frame = video_frame()
+    encoder = PeerEncoder(get_encoder(VP8), "vp8", dict(DEFAULT_ENCODER_SETTINGS))
+    encoder.encode(frame)
+    for _ in range(3):
+        packets, _ = encoder.encode(frame, force_keyframe=True)
+        assert packets
+    assert encoder.keyframes == 4
+
+
+def test_keyframe_interval():
+    frame = video_frame()
+    encoder = PeerEncoder(get_encoder(VP8), "vp8", dict(DEFAULT_ENCODER_SETTINGS, keyframe_interval=2))
+    for _ in range(5):
+        encoder.encode(frame)
+    assert encoder.keyframes == 3
+
+
+def test_install_encoder_without_the_sender_internals(capsys):
+    assert not install_encoder(types.SimpleNamespace(), dict(DEFAULT_ENCODER_SETTINGS))
+    assert "is missing from this aiortc version" in capsys.readouterr().out
@@ -0,0 +1,62 @@
+import asyncio
+import json
+import time
+
+from ice import IceServerCache
+
+EXPIRED = [{"urls": ["turn:turn.example.org"], "username": "old", "credential": "old"}]
+FRESH = [{"urls": ["turn:turn.example.org"], "username": "new", "credential": "new"}]
+
+
+def expired_cache(tmp_path, ttl):
+    path = tmp_path / "ice_servers.json"
+    path.write_text(json.dumps({"fetched_at": time.time() - 2 * ttl, "ice_servers": EXPIRED}))
+    cache = IceServerCache(str(path), ttl=ttl)
+
+    async def fetch():
+        cache.ice_servers = FRESH
+        cache.fetched_at = time.time()
+        return True
+
+    cache._fetch = fetch
+    return cache
+
+
+def test_expired_cache_is_served_while_fetching(tmp_path):
+    async def run():
+        cache = expired_cache(tmp_path, ttl=3600)
+        served = await cache.get()
+        await asyncio.sleep(0.01)
+        return served, cache.ice_servers
+
+    assert asyncio.run(run()) == (EXPIRED, FRESH)
+
+
+def test_list_fetched_before_the_refresh_starts_is_pushed_right_away(tmp_path):
+    async def run():
+        cache = expired_cache(tmp_path, ttl=3600)
+        pushed = []
+        await cache.get()
+        # The background fetch finishes during the service registration
+        await asyncio.sleep(0.01)
+        cache.start_refresh(pushed.append)
+        await asyncio.sleep(0.05)
+        await cache.close()
+        return pushed
+
+    assert asyncio.run(run()) == [FRESH]
+
+
+def test_served_list_is_not_pushed_again(tmp_path):
+    async def run():
+        cache = expired_cache(tmp_path, ttl=3600)
+        pushed = []
+        await cache.get()
+        await asyncio.sleep(0.01)
+        await cache.get()
+        cache.start_refresh(pushed.append)
+        await asyncio.sleep(0.05)
+        await cache.close()
+        return pushed
+
+    assert asyncio.run(run()) == []
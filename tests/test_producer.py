@@ -0,0 +1,96 @@
+from fractions import Fraction
+
+import numpy as np
+
+from producer import (
+    BITS_PER_PIXEL, VIDEO_TIME_BASE, FrameProducer, LevelSelector, Subscription, pyramid_sizes, select_level,
+)
+
+
+def test_pyramid_sizes_halve_to_even_sizes():
+    assert pyramid_sizes(480, 360) == [(480, 360), (240, 180), (120, 90)]
+    assert pyramid_sizes(100, 70) == [(100, 70), (50, 34), (24, 16)]
+
+
+def test_smallest_level_that_covers_the_view():
+    assert select_level(480, 360, 30) == 0
+    assert select_level(480, 360, 30, 240, 180) == 1
+    assert select_level(480, 360, 30, 241, 180) == 0
+    assert select_level(480, 360, 30, 10, 10) == 2
+
+
+def test_default_stream_fits_the_initial_vp8_target():
+    assert select_level(480, 360, 30, bitrate=500_000) == 0
+
+
+def needed(width, height, fps):
+    return width * height * fps * BITS_PER_PIXEL
+
+
+def test_steps_down_while_the_bitrate_cant_carry_the_level():
+    bitrate = needed(480, 360, 30) - 1
+    assert select_level(480, 360, 30, bitrate=bitrate) == 1
+    assert select_level(480, 360, 30, bitrate=1) == 2
+
+
+def test_going_up_needs_headroom():
+    bitrate = needed(480, 360, 30) * 1.1
+    assert select_level(480, 360, 30, bitrate=bitrate, current=0) == 0
+    assert select_level(480, 360, 30, bitrate=bitrate, current=1) == 1
+    assert select_level(480, 360, 30, bitrate=bitrate * 1.2, current=1) == 0
+
+
+def test_selector_probes_the_level_above():
+    low = needed(480, 360, 30) * 0.5
+    levels = LevelSelector(probe_interval=10, probe_hold=3)
+    assert levels.select(480, 360, 30, bitrate=low, now=0) == 1
+    assert levels.select(480, 360, 30, bitrate=low, now=5) == 1
+    # Tries level 0 for probe_hold seconds whatever the estimate
+    assert levels.select(480, 360, 30, bitrate=low, now=10) == 0
+    assert levels.select(480, 360, 30, bitrate=low, now=12) == 0
+    # The estimate didn't follow, so it steps down and waits twice as long
+    assert levels.select(480, 360, 30, bitrate=low, now=13) == 1
+    assert levels.select(480, 360, 30, bitrate=low, now=30) == 1
+    assert levels.select(480, 360, 30, bitrate=low, now=33) == 0
+
+
+def test_selector_keeps_a_probed_level_the_estimate_follows():
+    levels = LevelSelector(probe_interval=10, probe_hold=3)
+    assert levels.select(480, 360, 30, bitrate=needed(480, 360, 30) * 0.5, now=0) == 1
+    assert levels.select(480, 360, 30, bitrate=needed(480, 360, 30) * 0.5, now=10) == 0
+    assert levels.select(480, 360, 30, bitrate=needed(480, 360, 30), now=13) == 0
+    assert levels.select(480, 360, 30, bitrate=needed(480, 360, 30), now=60) == 0
+
+
+def test_selector_doesnt_probe_above_the_view_size():
+    levels = LevelSelector(probe_interval=10, probe_hold=3)
+    for now in range(0, 60, 5):
+        assert levels.select(480, 360, 30, 240, 180, bitrate=10**9, now=now) == 1
+
+
+def test_selector_keeps_its_level_while_frozen():
+    full = needed(480, 360, 30)
+    levels = LevelSelector(probe_interval=10, probe_hold=3)
+    assert levels.select(480, 360, 30, bitrate=full, now=0) == 0
+    # An idle stream's estimate drops with its frame rate
+    assert levels.select(480, 360, 30, bitrate=full / 6, now=5, frozen=True) == 0
+    assert levels.select(480, 360, 30, bitrate=full / 6, now=30, frozen=True) == 0
+    # Held for probe_hold seconds after waking up, while the estimate recovers
+    assert levels.select(480, 360, 30, bitrate=full / 6, now=32) == 0
+    assert levels.select(480, 360, 30, bitrate=full, now=34) == 0
+
+
+def test_every_subscriber_gets_its_own_frame():
+    producer = FrameProducer(snapshot=None, render=None, pixel_format="yuv420p")
+    subscriptions = [Subscription(2) for _ in range(3)]
+    subscriptions[2].level = 1
+    producer.subscribers.update(subscriptions)
+    img = np.arange(360 * 3 // 2 * 480, dtype=np.uint32).astype(np.uint8).reshape(-1, 480)
+    producer._publish((img, 9000, 123))
+    frames = [subscription.queue.get_nowait()[0] for subscription in subscriptions]
+    assert len({id(frame) for frame in frames}) == 3
+    assert np.array_equal(frames[0].to_ndarray(), img)
+    assert (frames[2].width, frames[2].height) == (240, 180)
+    # An encoder rebasing its frame leaves the others alone
+    frames[0].pts, frames[0].time_base = 3, Fraction(1, 30)
+    assert (frames[1].pts, frames[1].time_base) == (9000, VIDEO_TIME_BASE)
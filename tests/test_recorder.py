@@ -0,0 +1,60 @@
+import asyncio
+import fractions
+import types
+
+import av
+import numpy as np
+
+from producer import Subscription
+from recorder import StreamRecorder, stream_pts
+
+
+class FakeProducer:
+    def __init__(self, width, height, fps):
+        self.quality = types.SimpleNamespace(levels=[(width, height, fps)])
+        self.subscription = Subscription(1000)
+
+    def subscribe(self):
+        return self.subscription
+
+    def unsubscribe(self, subscription):
+        pass
+
+
+def rebased_frame(index, time_base):
+    """Frame `index` of a 30 fps stream, as a peer's encoder left it"""
+    frame = av.VideoFrame.from_ndarray(np.full((90 * 3 // 2, 120), index, dtype=np.uint8), format="yuv420p")
+    frame.time_base = time_base
+    frame.pts = int(index / 30 / time_base)
+    return frame
+
+
+def test_stream_pts_follows_the_time_base():
+    assert stream_pts(rebased_frame(30, fractions.Fraction(1, 1000000))) == 90000
+    assert stream_pts(rebased_frame(15, fractions.Fraction(1, 30))) == 45000
+
+
+def test_records_frames_rebased_by_the_encoders(tmp_path):
+    async def record():
+        producer = FakeProducer(120, 90, 30)
+        recorder = StreamRecorder(producer, directory=str(tmp_path), queue_size=1000)
+        recorder.start("mkv", segment_seconds=1)
+        for index in range(90):
+            # VP8 peers rebase to microseconds, H.264 peers to the frame rate
+            time_base = fractions.Fraction(1, 1000000) if index % 2 else fractions.Fraction(1, 30)
+            producer.subscription.queue.put_nowait((rebased_frame(index, time_base), 0))
+        # A frame that doesn't follow the previous one
+        producer.subscription.queue.put_nowait((rebased_frame(10, fractions.Fraction(1, 30)), 0))
+        while not producer.subscription.queue.empty():
+            await asyncio.sleep(0.01)
+        return await recorder.stop()
+
+    info = asyncio.run(record())
+    assert info["error"] is None
+    assert (info["written"], info["dropped"]) == (90, 1)
+    assert len(info["segments"]) == 3
+    frames = 0
+    for path in info["segments"]:
+        with av.open(path) as container:
+            frames += sum(1 for _ in container.decode(video=0))
+    assert frames == 90
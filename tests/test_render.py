@@ -0,0 +1,59 @@
+import numpy as np
+from av import VideoFrame
+
+from render import GLOW_ALPHA, GLOW_RINGS, draw_specimen, render_view
+from specimen import generate_world
+
+
+def draw_circle_float(img, center_x, center_y, radius, color):
+    """The full-frame anti-aliased circle blend the sprites replaced"""
+    height, width = img.shape[:2]
+    y, x = np.ogrid[:height, :width]
+    distance = np.sqrt((x - center_x)**2 + (y - center_y)**2)
+    mask = np.clip(radius + 1 - distance, 0, 1)
+    img *= 1 - mask[:, :, None]
+    img += mask[:, :, None] * np.asarray(color, dtype=np.float32)
+
+
+def draw_reference(img, center_x, center_y, size, color):
+    """Glow rings from the outside in, then the object itself"""
+    for glow_size in range(size + GLOW_RINGS, size - 1, -1):
+        alpha = GLOW_ALPHA * (1 - (glow_size - size) / GLOW_RINGS) ** 2
+        draw_circle_float(img, center_x, center_y, glow_size, [c * alpha for c in color])
+    draw_circle_float(img, center_x, center_y, size, color)
+
+
+def test_sprites_match_the_full_frame_blend():
+    rng = np.random.default_rng(2)
+    background = rng.uniform(20, 80, (120, 160, 3)).astype(np.float32)
+    sprites, reference = background.copy(), background.copy()
+    objects = [(30.3, 40.7, 8, [255, 80, 40]), (80.5, 60.25, 15, [40, 200, 250]), (150.9, 5.1, 10, [120, 255, 90]),
+               (85.0, 66.0, 4, [200, 200, 200])]
+    for center_x, center_y, size, color in objects:
+        draw_specimen(sprites, center_x, center_y, size, color)
+        draw_reference(reference, center_x, center_y, size, color)
+    # Within one intensity level
+    assert np.abs(sprites - reference).max() <= 1.0
+
+
+def scene():
+    world = generate_world(3000, 2000, 1500, seed=3)
+    return {
+        "x": 1000, "y": 750, "stage_width": 2000, "stage_height": 1500,
+        "objects": world.visible(1000, 750, 300, 250),
+    }
+
+
+def test_yuv_rendering_matches_converted_bgr():
+    state = scene()
+    for count in (0, 45):
+        yuv = render_view(state, count, 480, 360, pixel_format="yuv420p").astype(int)
+        bgr = render_view(state, count, 480, 360, pixel_format="bgr24")
+        reference = VideoFrame.from_ndarray(bgr, format="bgr24").reformat(format="yuv420p").to_ndarray()
+        luma_error = np.abs(yuv[:360] - reference[:360])
+        chroma_error = np.abs(yuv[360:] - reference[360:])
+        assert luma_error.max() <= 1
+        assert chroma_error.mean() < 0.25
+        # libswscale filters chroma differently, which only shows at sprite edges
+        assert np.percentile(chroma_error, 99) <= 1
+        assert chroma_error.max() <= 12
@@ -0,0 +1,47 @@
+import numpy as np
+import pytest
+
+from render import render_view
+from scan import plan_tiles, render_tile
+
+OBJECT = {"x": 1000, "y": 800, "color": [40, 200, 250], "size": 12}
+
+
+def state(x, y, objects=()):
+    return {"x": x, "y": y, "stage_width": 20000, "stage_height": 15000, "objects": list(objects)}
+
+
+def test_tiles_cover_the_region_in_serpentine_order():
+    rows, cols, tiles = plan_tiles({"x": 0, "y": 0, "width": 1000, "height": 600}, 0.1, 480, 360, 20000, 15000)
+    assert (rows, cols) == (2, 3)
+    assert [(row, col) for row, col, _, _ in tiles] == [(0, 0), (0, 1), (0, 2), (1, 2), (1, 1), (1, 0)]
+    assert tiles[0][2:] == (240, 180)
+    assert tiles[2][2] + 240 == 1000
+
+
+def test_tiles_outside_the_stage_are_rejected():
+    with pytest.raises(ValueError):
+        plan_tiles({"x": 19900, "y": 0, "width": 1000, "height": 360}, 0.1, 480, 360, 20000, 15000)
+
+
+def test_tiles_have_no_overlay():
+    tile = render_tile(state(1000, 800), 480, 360)
+    stream = render_view(state(1000, 800), 0, 480, 360, t=0.0)[:, :, ::-1]
+    # The crosshair at the center and the black HUD box are only in the stream
+    assert (stream[180, 240] == 255).all()
+    assert not (tile[180, 240] == 255).all()
+    assert (stream[20, 100] == 0).all()
+    assert tile[20, 100].any()
+
+
+def specimen_center(x, y):
+    """Center of OBJECT in the tile around (x, y), from what it adds to the empty view"""
+    added = render_tile(state(x, y, [OBJECT]), 480, 360).astype(int) - render_tile(state(x, y), 480, 360)
+    rows, cols = np.nonzero(np.abs(added).sum(axis=2) > 30)
+    return rows.mean() + y - 180, cols.mean() + x - 240
+
+
+def test_a_specimen_lines_up_in_overlapping_tiles():
+    # The same object seen from two tile positions maps to the same stage position
+    first, second = specimen_center(1100, 850), specimen_center(900, 700)
+    assert first == pytest.approx(second, abs=0.1)
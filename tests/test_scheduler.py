@@ -0,0 +1,74 @@
+import asyncio
+
+import pytest
+
+import scheduler
+from scheduler import NS_PER_SECOND, VIDEO_CLOCK_RATE, FrameScheduler
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """A monotonic_ns the test moves forward by hand"""
+    now = [10 * NS_PER_SECOND]
+    monkeypatch.setattr(scheduler.time, "monotonic_ns", lambda: now[0])
+    return now
+
+
+def start(frames):
+    """Anchor the schedule at the first frame"""
+    assert asyncio.run(frames.wait()) == 0
+    frames.frame_done()
+
+
+def test_deadlines_and_pts_follow_the_grid(clock):
+    frames = FrameScheduler(30)
+    start(frames)
+    assert frames.deadline_ns(3) - frames.deadline_ns(0) == NS_PER_SECOND // 10
+    assert frames.pts(30) == VIDEO_CLOCK_RATE
+
+
+def test_set_fps_keeps_the_current_deadline_and_pts(clock):
+    frames = FrameScheduler(30)
+    start(frames)
+    deadline, pts = frames.deadline_ns(), frames.pts()
+    frames.set_fps(10)
+    assert (frames.deadline_ns(), frames.pts()) == (deadline, pts)
+    assert frames.pts(frames.count + 1) - pts == VIDEO_CLOCK_RATE // 10
+
+
+def test_missed_intervals_are_skipped_and_counted(clock):
+    frames = FrameScheduler(10)
+    start(frames)
+    # Frame 1 was due at 100 ms; at 350 ms frames 1 and 2 are a whole interval late
+    clock[0] += 350 * NS_PER_SECOND // 1000
+    assert asyncio.run(frames.wait()) == 2
+    assert frames.count == 3
+    assert frames.stats.skipped == 2
+
+
+def test_a_late_frame_within_an_interval_is_not_skipped(clock):
+    frames = FrameScheduler(10)
+    start(frames)
+    clock[0] += 150 * NS_PER_SECOND // 1000
+    assert asyncio.run(frames.wait()) == 0
+    frames.frame_done()
+    assert frames.stats.late == 1
+    assert frames.stats.skipped == 0
+
+
+def test_resume_makes_the_current_frame_due_now(clock):
+    frames = FrameScheduler(1)
+    start(frames)
+    clock[0] += NS_PER_SECOND // 4
+    frames.resume()
+    assert frames.deadline_ns() == clock[0]
+    # The pts follows the time that passed, not the 1 fps grid
+    assert frames.pts() == VIDEO_CLOCK_RATE // 4
+
+
+def test_resume_keeps_pts_increasing(clock):
+    frames = FrameScheduler(30)
+    start(frames)
+    previous = frames.pts(frames.count - 1)
+    frames.resume()
+    assert frames.pts() > previous
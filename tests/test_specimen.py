@@ -0,0 +1,33 @@
+import numpy as np
+
+from specimen import FLOAT_AMPLITUDE, PULSE_SCALE, SpecimenWorld, generate_world
+
+
+def test_query_matches_a_full_scan():
+    world = generate_world(2000, 4000, 3000, seed=1)
+    for x0, y0, x1, y1 in [(0, 0, 4000, 3000), (100, 200, 700, 650), (3900, 2900, 5000, 4000), (-50, -50, 10, 10)]:
+        expected = np.flatnonzero((world.x >= x0) & (world.x <= x1) & (world.y >= y0) & (world.y <= y1))
+        assert sorted(world.query(x0, y0, x1, y1).tolist()) == expected.tolist()
+
+
+def test_query_outside_the_slide_is_empty():
+    world = generate_world(100, 1000, 1000, seed=2)
+    assert len(world.query(2000, 2000, 3000, 3000)) == 0
+
+
+def test_visible_includes_objects_reaching_into_the_view():
+    size = 20
+    world = SpecimenWorld([
+        {"x": 100, "y": 100, "color": [255, 0, 0], "size": size},
+        {"x": 100 + 50 + size * PULSE_SCALE + FLOAT_AMPLITUDE - 1, "y": 100, "color": [0, 255, 0], "size": size},
+        {"x": 400, "y": 100, "color": [0, 0, 255], "size": size},
+    ], width=480, height=360)
+    colors = [obj["color"] for obj in world.visible(100, 100, 50, 50)]
+    assert sorted(colors) == [[0, 255, 0], [255, 0, 0]]
+
+
+def test_add_reindexes():
+    world = SpecimenWorld(width=480, height=360)
+    world.add([{"x": 300, "y": 300, "color": [1, 2, 3], "size": 5}])
+    assert len(world) == 1
+    assert world.query(290, 290, 310, 310).tolist() == [0]
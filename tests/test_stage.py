@@ -0,0 +1,188 @@
+import asyncio
+import math
+import threading
+
+import pytest
+
+from stage import SharedStage, StageController, StageSnapshot, interpolate_pose, is_at_rest, step_physics
+
+
+def snapshot(version, x=1.5, y=-2.0, moving=True):
+    return StageSnapshot(version, 12.25, 1.0, -1.5, x, y, 0.5, -0.5, 10.0, 20.0, moving)
+
+
+def test_shared_snapshot_round_trips_to_another_process_handle():
+    shared = SharedStage()
+    try:
+        shared.write(snapshot(7), 240.0)
+        reader = SharedStage(shared.name)
+        try:
+            assert reader.read() == (snapshot(7), 240.0)
+            assert isinstance(reader.read()[0].version, int)
+        finally:
+            reader.close()
+    finally:
+        shared.close()
+
+
+def test_read_waits_out_a_write_in_progress():
+    shared = SharedStage()
+    try:
+        shared.write(snapshot(1), 240.0)
+        # An odd sequence number is a write in progress
+        shared.values[0] += 1
+        shared.values[6] = 99.0
+        result = []
+        reader = threading.Thread(target=lambda: result.append(shared.read()))
+        reader.start()
+        reader.join(0.1)
+        assert reader.is_alive()
+        shared.values[2:] = snapshot(2, x=99.0)
+        shared.values[0] += 1
+        reader.join(1)
+        assert result == [(snapshot(2, x=99.0), 240.0)]
+    finally:
+        shared.close()
+
+
+def stage_state(x=240.0, y=180.0):
+    return {
+        "x": x, "y": y, "target_x": x, "target_y": y, "stage_width": 480, "stage_height": 360,
+        "velocity_x": 0.0, "velocity_y": 0.0, "max_acceleration": 8.0, "max_velocity": 15.0,
+        "damping": 0.85, "attraction_strength": 0.3, "speed_limit": None,
+    }
+
+
+def settle_time(rate):
+    """Seconds the physics stepped at `rate` Hz takes to settle 150 units away"""
+    state = stage_state()
+    state["target_x"] = 390.0
+    steps = 0
+    while not is_at_rest(state):
+        step_physics(state, 1.0 / rate)
+        steps += 1
+        assert steps < rate * 10
+    return steps / rate
+
+
+def test_physics_speed_does_not_depend_on_the_step_rate():
+    reference = settle_time(30)
+    for rate in (60, 240, 1000):
+        assert abs(settle_time(rate) - reference) < 0.25 * reference
+
+
+def test_pose_interpolates_between_the_last_two_steps():
+    snapshot = StageSnapshot(3, 10.0, 0.0, 0.0, 8.0, 4.0, 1.0, 0.5, 20.0, 10.0, True)
+    pose = interpolate_pose(snapshot, 100, now=10.005)
+    assert (pose["x"], pose["y"]) == pytest.approx((4.0, 2.0))
+    pose = interpolate_pose(snapshot, 100, now=11.0)
+    assert (pose["x"], pose["y"], pose["version"]) == (8.0, 4.0, 3)
+    assert interpolate_pose(snapshot, 0, now=10.0)["x"] == 8.0
+
+
+def test_controller_steps_without_frames_and_sleeps_at_rest():
+    async def run():
+        controller = StageController(stage_state(), rate=240)
+        controller.start()
+        try:
+            controller.move_to(300, 200)
+            await asyncio.sleep(0.1)
+            moving = controller.snapshot
+            await asyncio.wait_for(controller.wait_for_arrival(), 5)
+            steps = controller.steps
+            await asyncio.sleep(0.1)
+            return moving, controller.snapshot, steps, controller.steps
+        finally:
+            await controller.stop()
+
+    moving, settled, steps, steps_later = asyncio.run(run())
+    assert moving.moving and 240 < moving.x < 300
+    assert not settled.moving and (settled.x, settled.y) == (300, 200)
+    assert settled.version > moving.version
+    # No steps while the stage is at rest
+    assert steps_later == steps
+
+
+def run_controller(scenario, state=None):
+    """Run `scenario(controller)` with a started controller"""
+    async def run():
+        controller = StageController(state or stage_state(), rate=240)
+        controller.start()
+        try:
+            return await asyncio.wait_for(scenario(controller), 10)
+        finally:
+            await controller.stop()
+
+    return asyncio.run(run())
+
+
+def test_path_visits_waypoints_in_order_without_stopping():
+    waypoints = [(270, 180), (270, 210), (240, 210)]
+
+    async def scenario(controller):
+        targets, speeds = [], []
+        set_target = controller._set_target
+
+        def record(x, y, boost=False):
+            targets.append((x, y))
+            speeds.append(math.hypot(controller.state["velocity_x"], controller.state["velocity_y"]))
+            set_target(x, y, boost)
+
+        controller._set_target = record
+        controller.move_path(waypoints)
+        position = await controller.wait_for_arrival()
+        return targets, speeds, position
+
+    targets, speeds, position = run_controller(scenario)
+    assert targets == waypoints
+    # Intermediate waypoints are passed while still moving
+    assert all(speed > 0 for speed in speeds[1:])
+    assert position == {"x": 240, "y": 210}
+
+
+def test_arrival_waits_for_the_stage_to_settle():
+    async def scenario(controller):
+        controller.move_to(280, 150)
+        position = await controller.wait_for_arrival()
+        return position, controller.snapshot
+
+    position, snapshot = run_controller(scenario)
+    assert position == {"x": 280, "y": 150}
+    assert not snapshot.moving
+
+
+def test_arrival_at_rest_returns_at_once():
+    async def scenario(controller):
+        return await controller.wait_for_arrival()
+
+    assert run_controller(scenario) == {"x": 240.0, "y": 180.0}
+
+
+def test_superseded_move_resolves_at_the_new_target():
+    async def scenario(controller):
+        controller.move_to(300, 180)
+        first = asyncio.ensure_future(controller.wait_for_arrival())
+        await asyncio.sleep(0.05)
+        controller.move_to(240, 150)
+        second = await controller.wait_for_arrival()
+        return await first, second
+
+    first, second = run_controller(scenario)
+    assert first == second == {"x": 240, "y": 150}
+
+
+def test_path_speed_caps_the_velocity():
+    async def scenario(controller):
+        controller.move_path([(330, 180)], speed=60)
+        fastest = 0.0
+        arrival = asyncio.ensure_future(controller.wait_for_arrival())
+        while not arrival.done():
+            snapshot = controller.snapshot
+            fastest = max(fastest, math.hypot(snapshot.velocity_x, snapshot.velocity_y))
+            await asyncio.sleep(0.005)
+        return fastest, controller.state["speed_limit"]
+
+    fastest, speed_limit = run_controller(scenario)
+    # Velocities are in stage units per 30 fps reference frame
+    assert 0 < fastest <= 60 / 30 + 1e-9
+    assert speed_limit is None
@@ -0,0 +1,38 @@
+import gzip
+
+import pytest
+
+from webapp import StaticFile, accepted_encodings
+
+
+@pytest.fixture
+def page(tmp_path):
+    path = tmp_path / "index.html"
+    path.write_text("<html>" + "microscope " * 500 + "</html>")
+    return StaticFile(str(path))
+
+
+def test_accepted_encodings_skips_refused_codings():
+    assert accepted_encodings("gzip, br;q=0, deflate;q=0.5") == {"gzip", "deflate"}
+
+
+def test_serves_the_accepted_encoding(page):
+    response = page.response({"accept-encoding": "gzip"})
+    assert response.status_code == 200
+    assert response.headers["content-encoding"] == "gzip"
+    assert gzip.decompress(response.body) == page.variants["identity"][0]
+
+
+def test_matching_etag_is_not_modified(page):
+    etag = page.response({"accept-encoding": "gzip"}).headers["etag"]
+    response = page.response({"accept-encoding": "gzip", "if-none-match": etag})
+    assert response.status_code == 304
+    assert not response.body
+
+
+def test_etag_of_another_encoding_gets_the_body(page):
+    gzip_etag = page.response({"accept-encoding": "gzip"}).headers["etag"]
+    response = page.response({"accept-encoding": "identity", "if-none-match": gzip_etag})
+    assert response.status_code == 200
+    assert "content-encoding" not in response.headers
+    assert response.body == page.variants["identity"][0]
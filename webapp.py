@@ -0,0 +1,148 @@
+"""
+Cached static pages and buffered access logging for the ASGI web app.
+"""
+import asyncio
+import collections
+import gzip
+import hashlib
+import os
+import sys
+import time
+
+from fastapi.responses import Response
+
+try:
+    import brotli
+except ImportError:
+    # Optional: without it pages are served with gzip only
+    brotli = None
+
+# Encodings in order of preference when the client accepts several
+ENCODINGS = ("br", "gzip")
+
+
+def accepted_encodings(header):
+    """The content codings of an Accept-Encoding header that aren't refused with q=0"""
+    accepted = set()
+    for part in header.split(","):
+        coding, _, params = part.strip().partition(";")
+        quality = params.strip()
+        if quality.startswith("q="):
+            try:
+                if float(quality[2:]) == 0:
+                    continue
+            except ValueError:
+                continue
+        if coding:
+            accepted.add(coding.strip().lower())
+    return accepted
+
+
+class StaticFile:
+    """
+    A file served from memory with precompressed variants.
+
+    The file is read and compressed once, and read again only when its
+    modification time or size changes, which is checked at most every
+    `check_interval` seconds. Every variant has its own ETag, so clients
+    revalidate with If-None-Match and get an empty 304 while the file is
+    unchanged.
+    """
+
+    def __init__(self, path, media_type="text/html; charset=utf-8", check_interval=1.0):
+        self.path = path
+        self.media_type = media_type
+        self.check_interval = check_interval
+        self.variants = {}
+        self._signature = None
+        self._checked = 0.0
+
+    def refresh(self):
+        """Reload the file if it changed since it was last read"""
+        now = time.monotonic()
+        if self.variants and now - self._checked < self.check_interval:
+            return
+        self._checked = now
+        try:
+            stat = os.stat(self.path)
+        except OSError as e:
+            if not self.variants:
+                raise
+            print(f"StaticFile: keeping the cached {self.path}: {e}")
+            return
+        signature = (stat.st_mtime_ns, stat.st_size)
+        if signature != self._signature:
+            with open(self.path, "rb") as file:
+                self._load(file.read())
+            self._signature = signature
+
+    def _load(self, body):
+        digest = hashlib.sha1(body).hexdigest()[:16]
+        variants = {"identity": (body, f'"{digest}"')}
+        compressed = {"gzip": gzip.compress(body, compresslevel=9, mtime=0)}
+        if brotli is not None:
+            compressed["br"] = brotli.compress(body, quality=11)
+        for encoding, data in compressed.items():
+            if len(data) < len(body):
+                variants[encoding] = (data, f'"{digest}-{encoding}"')
+        self.variants = variants
+        sizes = ", ".join(f"{encoding} {len(data)}" for encoding, (data, _) in variants.items())
+        print(f"StaticFile: loaded {self.path} ({sizes} bytes)")
+
+    def response(self, headers):
+        """The Response for a GET with the request `headers`"""
+        self.refresh()
+        accepted = accepted_encodings(headers.get("accept-encoding", ""))
+        encoding = next((name for name in ENCODINGS if name in accepted and name in self.variants), "identity")
+        body, etag = self.variants[encoding]
+        response_headers = {"ETag": etag, "Cache-Control": "no-cache", "Vary": "Accept-Encoding"}
+        if encoding != "identity":
+            response_headers["Content-Encoding"] = encoding
+
+        if_none_match = headers.get("if-none-match")
+        if if_none_match is not None:
+            # Only the ETag of the variant this request gets matches, so a
+            # client never keeps a body in another encoding
+            tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+            if "*" in tags or etag in tags:
+                response_headers.pop("Content-Encoding", None)
+                return Response(status_code=304, headers=response_headers)
+        return Response(body, headers=response_headers, media_type=self.media_type)
+
+
+class AccessLog:
+    """
+    Access log lines buffered in memory and written to stdout off the event loop.
+
+    Lines are collected without blocking and a background task writes them
+    in one batch every `flush_interval` seconds in the default executor.
+    If more than `max_lines` pile up, the oldest are dropped and counted.
+    """
+
+    def __init__(self, flush_interval=1.0, max_lines=10000):
+        self.flush_interval = flush_interval
+        self.lines = collections.deque(maxlen=max_lines)
+        self.dropped = 0
+        self._task = None
+
+    def log(self, line):
+        if len(self.lines) == self.lines.maxlen:
+            self.dropped += 1
+        self.lines.append(line)
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run())
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while self.lines:
+            await asyncio.sleep(self.flush_interval)
+            lines = list(self.lines)
+            self.lines.clear()
+            if self.dropped:
+                lines.append(f"AccessLog: dropped {self.dropped} lines")
+                self.dropped = 0
+            await loop.run_in_executor(None, self._write, lines)
+
+    def _write(self, lines):
+        sys.stdout.write("".join(line + "\n" for line in lines))
+        sys.stdout.flush()
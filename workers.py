@@ -0,0 +1,186 @@
+"""
+Worker processes for --workers: peers sharded across processes by load.
+"""
+import asyncio
+import functools
+import inspect
+import itertools
+import multiprocessing
+import threading
+
+
+class PipeLink:
+    """
+    Asyncio requests between two processes over a multiprocessing Connection.
+
+    A reader thread receives the messages (tuples) and hands them to the
+    event loop, so the loop never blocks on the pipe. `request(name, **kwargs)`
+    calls `handlers[name](**kwargs)` in the other process and returns its
+    result, awaiting coroutines; `stream` does the same for async generator
+    handlers and yields their items; `notify` calls a handler without
+    waiting for a reply. Errors are raised on the calling side as
+    RuntimeError with the remote exception type and message.
+    """
+
+    def __init__(self, connection, handlers):
+        self.connection = connection
+        self.handlers = handlers
+        self.closed = None
+        self._ids = itertools.count()
+        self._pending = {}
+        self._loop = None
+
+    def start(self):
+        self._loop = asyncio.get_running_loop()
+        self.closed = self._loop.create_future()
+        threading.Thread(target=self._receive, name="pipe-link", daemon=True).start()
+
+    def _receive(self):
+        while True:
+            try:
+                message = self.connection.recv()
+            except (EOFError, OSError):
+                break
+            self._loop.call_soon_threadsafe(self._dispatch, message)
+        self._loop.call_soon_threadsafe(self._close)
+
+    def _close(self):
+        for queue in self._pending.values():
+            queue.put_nowait(("error", "ConnectionError: worker link closed"))
+        self._pending.clear()
+        if not self.closed.done():
+            self.closed.set_result(None)
+
+    def _send(self, message):
+        if self.closed.done():
+            raise ConnectionError("Worker link closed")
+        self.connection.send(message)
+
+    def _dispatch(self, message):
+        kind = message[0]
+        if kind in ("request", "notify"):
+            asyncio.ensure_future(self._handle(*message))
+            return
+        queue = self._pending.get(message[1])
+        if queue is not None:
+            queue.put_nowait((kind,) + message[2:])
+
+    async def _handle(self, kind, request_id, name, kwargs):
+        try:
+            result = self.handlers[name](**kwargs)
+            if inspect.isasyncgen(result):
+                async for item in result:
+                    self._send(("item", request_id, item))
+                result = None
+            elif inspect.isawaitable(result):
+                result = await result
+            reply = ("result", request_id, result)
+        except Exception as e:
+            reply = ("error", request_id, f"{type(e).__name__}: {e}")
+        if kind == "request" and not self.closed.done():
+            self._send(reply)
+
+    async def stream(self, name, **kwargs):
+        request_id = next(self._ids)
+        queue = self._pending[request_id] = asyncio.Queue()
+        try:
+            self._send(("request", request_id, name, kwargs))
+            while True:
+                kind, *value = await queue.get()
+                if kind == "item":
+                    yield value[0]
+                elif kind == "result":
+                    return
+                else:
+                    raise RuntimeError(value[0])
+        finally:
+            self._pending.pop(request_id, None)
+
+    async def request(self, name, **kwargs):
+        request_id = next(self._ids)
+        queue = self._pending[request_id] = asyncio.Queue()
+        try:
+            self._send(("request", request_id, name, kwargs))
+            kind, value = await queue.get()
+        finally:
+            self._pending.pop(request_id, None)
+        if kind == "error":
+            raise RuntimeError(value)
+        return value
+
+    def notify(self, name, **kwargs):
+        self._send(("notify", None, name, kwargs))
+
+
+class WorkerPool:
+    """
+    Worker processes that each stream to their own share of the peers.
+
+    Every worker runs `target(index, connection, *args)` in a spawned
+    process and talks to this process through a PipeLink on `connection`.
+    `offer` hands a new peer to the worker with the fewest peers; workers
+    report closed peers with the "peer_closed" notification. `handlers`
+    are the functions workers may request from this process, e.g. the
+    stage moves only the main process can make.
+    """
+
+    def __init__(self, count, target, args=(), handlers=None):
+        self.count = count
+        self.target = target
+        self.args = args
+        self.handlers = handlers or {}
+        self.processes = []
+        self.links = []
+        self.peers = []
+
+    def start(self):
+        context = multiprocessing.get_context("spawn")
+        for index in range(self.count):
+            connection, child_connection = context.Pipe()
+            process = context.Process(
+                target=self.target, args=(index, child_connection) + tuple(self.args),
+                name=f"worker-{index}", daemon=True,
+            )
+            process.start()
+            child_connection.close()
+            handlers = dict(self.handlers, peer_closed=functools.partial(self._peer_closed, index))
+            link = PipeLink(connection, handlers)
+            link.start()
+            self.processes.append(process)
+            self.links.append(link)
+            self.peers.append(0)
+        print(f"WorkerPool: started {self.count} worker processes")
+
+    def _peer_closed(self, index):
+        self.peers[index] = max(0, self.peers[index] - 1)
+        print(f"WorkerPool: peer closed on worker {index}, peers per worker: {self.peers}")
+
+    async def offer(self, **kwargs):
+        """Answer a WebRTC offer on the least loaded live worker"""
+        live = [index for index in range(self.count) if not self.links[index].closed.done()]
+        if not live:
+            raise RuntimeError("No worker processes are running")
+        index = min(live, key=lambda i: self.peers[i])
+        # Count the peer right away so concurrent offers spread out
+        self.peers[index] += 1
+        try:
+            answer = await self.links[index].request("offer", **kwargs)
+        except Exception:
+            self.peers[index] -= 1
+            raise
+        print(f"WorkerPool: peer assigned to worker {index}, peers per worker: {self.peers}")
+        return answer
+
+    def broadcast(self, name, **kwargs):
+        """Notify every live worker"""
+        for link in self.links:
+            if not link.closed.done():
+                link.notify(name, **kwargs)
+
+    def stop(self):
+        for link in self.links:
+            link.connection.close()
+        for process in self.processes:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()